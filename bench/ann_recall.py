@@ -0,0 +1,77 @@
+"""
+Recall and latency of the IVF index against exact search on synthetic embeddings.
+
+Vectors are drawn around random topic centres so the data has the clustered shape
+of real chunk embeddings:
+
+    python bench/ann_recall.py --vectors 20000 --queries 200 --k 5
+"""
+from pathlib import Path
+import argparse
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+import numpy as np
+from prepare.index import IVFIndex
+
+
+def make_vectors(count: int, dimensions: int, topics: int, rng) -> np.ndarray:
+    centres = rng.standard_normal((topics, dimensions)).astype(np.float32)
+    vectors = centres[rng.integers(0, topics, count)] + 0.8 * rng.standard_normal((count, dimensions)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def build(vectors: np.ndarray, n_probe: int, exact: bool) -> IVFIndex:
+    index = IVFIndex(vectors.shape[1], n_probe=n_probe, min_train_size=len(vectors) + 1 if exact else 2048)
+    ids = [str(i) for i in range(len(vectors))]
+    # Insert in upload-sized batches, the way Store feeds the index
+    for start in range(0, len(vectors), 500):
+        end = start + 500
+        index.add(ids[start:end], vectors[start:end], np.full(len(ids[start:end]), np.inf),
+                  [{"id": i} for i in ids[start:end]])
+    return index
+
+
+def run(index: IVFIndex, queries: np.ndarray, k: int):
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        hits = index.search(query, k, threshold=-1.0, now=0.0)
+        latencies.append(time.perf_counter() - start)
+        results.append({row for row, _ in hits})
+    return results, np.array(latencies) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vectors", type=int, default=20000)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--topics", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--n-probe", type=int, nargs="+", default=[4, 8, 16, 32])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = make_vectors(args.vectors, args.dimensions, args.topics, rng)
+    queries = vectors[rng.integers(0, len(vectors), args.queries)] + 0.05 * rng.standard_normal(
+        (args.queries, args.dimensions)).astype(np.float32)
+
+    exact, exact_ms = run(build(vectors, 1, exact=True), queries, args.k)
+    print(f"{'exact':12s} recall@{args.k} 1.000  p50 {np.percentile(exact_ms, 50):7.3f} ms  "
+          f"p99 {np.percentile(exact_ms, 99):7.3f} ms")
+
+    for n_probe in args.n_probe:
+        start = time.perf_counter()
+        index = build(vectors, n_probe, exact=False)
+        build_s = time.perf_counter() - start
+        found, ivf_ms = run(index, queries, args.k)
+        recall = np.mean([len(a & b) / len(b) for a, b in zip(found, exact)])
+        print(f"ivf probe {n_probe:<3d} recall@{args.k} {recall:.3f}  p50 {np.percentile(ivf_ms, 50):7.3f} ms  "
+              f"p99 {np.percentile(ivf_ms, 99):7.3f} ms  ({len(index.centroids)} lists, built in {build_s:.1f} s)")
+
+
+if __name__ == "__main__":
+    main()
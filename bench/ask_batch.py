@@ -0,0 +1,138 @@
+"""
+One POST /ask/batch against as many questions sent as concurrent /ask streams.
+
+Uploads generated PDFs through the app of main.py, on a fake Cosmos container and
+the fake OpenAI server, then answers as many questions both ways with the answer
+cache off; the batch asks different ones, so the embedding cache favours neither.
+Reports wall time, embedding requests, Cosmos requests and request units per mode,
+and checks that every question of the batch got a complete answer:
+
+    python bench/ask_batch.py --questions 48 --concurrency 4 --backend exact
+"""
+from pathlib import Path
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+import httpx
+from end_to_end import PASSPHRASE, ask, question, upload
+from fake_cosmos import FakeContainer, FakeConnection
+from fake_openai import create_app
+from samples import make_pdf
+from servers import BackgroundServer
+
+
+async def ask_batch(client: httpx.AsyncClient, texts) -> dict:
+    """Stream one batch; :return: the tokens, completed and failed answers per question index"""
+    tokens = {index: 0 for index in range(len(texts))}
+    done, failed, event = set(), set(), None
+    async with client.stream("POST", "/ask/batch", json={"passphrase": PASSPHRASE, "questions": texts}) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: ") and event in ("token", "done", "error"):
+                data = json.loads(line[len("data: "):])
+                if event == "token":
+                    tokens[data["index"]] += 1
+                elif event == "done":
+                    done.add(data["index"])
+                else:
+                    failed.add(data.get("index"))
+            elif not line:
+                event = None
+    return {"tokens": tokens, "done": done, "failed": failed}
+
+
+async def run(url: str, paths, args, container, openai_app) -> dict:
+    texts = [question(i, args.lines_per_page, args.pages) for i in range(args.questions)]
+    batch_texts = [question(i, args.lines_per_page, args.pages) for i in range(args.questions, 2 * args.questions)]
+    async with httpx.AsyncClient(base_url=url, timeout=600) as client:
+        await asyncio.gather(*(upload(client, path) for path in paths))
+        report = {}
+
+        def counters():
+            return (openai_app.state.requests, container.stats["requests"], container.stats["request_charge"])
+
+        before, start = counters(), time.perf_counter()
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def limited(text):
+            async with semaphore:
+                return await ask(client, text)
+
+        streams = await asyncio.gather(*(limited(text) for text in texts))
+        report["separate"] = (time.perf_counter() - start, counters(), before, sum(stream["tokens"] == 0 for stream in streams))
+
+        before, start = counters(), time.perf_counter()
+        batch = await ask_batch(client, batch_texts)
+        report["batch"] = (time.perf_counter() - start, counters(), before,
+                           sum(count == 0 for count in batch["tokens"].values()))
+        report["batch_complete"] = len(batch["done"]) == len(texts) and not batch["failed"]
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=2)
+    parser.add_argument("--pages", type=int, default=20, help="Pages per file")
+    parser.add_argument("--lines-per-page", type=int, default=45)
+    parser.add_argument("--questions", type=int, default=48)
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent /ask streams, and ASK_BATCH_CONCURRENCY")
+    parser.add_argument("--backend", default="cosmos", choices=["cosmos", "ivf", "exact"])
+    parser.add_argument("--openai-latency", type=float, default=0.02)
+    parser.add_argument("--token-latency", type=float, default=0.005)
+    parser.add_argument("--cosmos-latency", type=float, default=0.005)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    openai_app = create_app(latency=args.openai_latency, token_latency=args.token_latency)
+    with BackgroundServer(openai_app) as openai_server:
+        os.environ.update({
+            "EMBEDDER_OPENAI_API_BASE": openai_server.url,
+            "EMBEDDER_OPENAI_API_KEY": "fake",
+            "EMBEDDER_OPENAI_API_VERSION": "2024-02-01",
+            "LLM_OPENAI_API_BASE": openai_server.url,
+            "LLM_OPENAI_API_KEY": "fake",
+            "LLM_OPENAI_API_VERSION": "2024-02-01",
+            "EMBEDDING_CACHE_PATH": os.path.join(directory, "embedding_cache.sqlite3"),
+            "VECTOR_DIRECTORY": os.path.join(directory, "vectors"),
+            "RETRIEVAL_BACKEND": args.backend,
+            "PARSER_WORKERS": "0",
+            "JANITOR_INTERVAL_SECONDS": "0",
+            "ANSWER_CACHE_MAX_ENTRIES": "0",
+            "ASK_BATCH_CONCURRENCY": str(args.concurrency),
+        })
+        from main import app
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        logging.getLogger("api.routes").setLevel(logging.WARNING)
+        logging.getLogger("prepare").setLevel(logging.WARNING)
+
+        container = FakeContainer(latency=args.cosmos_latency)
+        app.state.cosmos_connection = FakeConnection(container)
+        paths = []
+        for i in range(args.files):
+            paths.append(os.path.join(directory, f"document_{i}.pdf"))
+            make_pdf(paths[-1], pages=args.pages, lines_per_page=args.lines_per_page)
+        with BackgroundServer(app) as server:
+            report = asyncio.run(run(server.url, paths, args, container, openai_app))
+
+    print(f"{'mode':>9s} {'seconds':>8s} {'embedding requests':>19s} {'cosmos requests':>16s} {'RU':>8s} {'empty answers':>14s}")
+    for mode in ("separate", "batch"):
+        seconds, after, before, empty = report[mode]
+        print(f"{mode:>9s} {seconds:8.2f} {after[0] - before[0]:19d} {after[1] - before[1]:16d} "
+              f"{after[2] - before[2]:8.1f} {empty:14d}")
+    if not report["batch_complete"]:
+        print("FAIL: not every question of the batch was answered")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
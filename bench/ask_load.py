@@ -0,0 +1,146 @@
+"""
+Load test for /ask: many concurrent answer streams against the fake chat server.
+
+Runs the app in-process with a fake Cosmos container and the fake OpenAI server,
+fires rounds of concurrent /ask streams and records the process RSS after each
+round. It fails when RSS keeps growing after the warm-up round, or when a stream
+carries tokens of another request's answer:
+
+    python bench/ask_load.py --concurrency 200 --rounds 5
+"""
+from pathlib import Path
+import argparse
+import asyncio
+import datetime as dt
+import gc
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+import httpx
+from fake_cosmos import FakeContainer, FakeConnection
+from fake_openai import create_app, fake_embedding
+from servers import BackgroundServer
+
+PASSPHRASE = "load-test"
+
+
+def rss_mb() -> float:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def topic(i: int) -> str:
+    return f"What does section {i} of the handbook say about topic {i}?"
+
+
+def seed(container: FakeContainer, topics: int):
+    """Store one chunk per topic whose text is the topic question, so every question finds context."""
+    passphrase_hash = hashlib.sha256(PASSPHRASE.encode()).hexdigest()
+    keep_until = (dt.datetime.now() + dt.timedelta(hours=1)).isoformat()
+    partition = container.partitions.setdefault(passphrase_hash, {})
+    for i in range(topics):
+        item_id = str(uuid.uuid4())
+        partition[item_id] = {
+            "id": item_id, "passphrase_hash": passphrase_hash, "content": topic(i),
+            "embedding": fake_embedding(topic(i)).tolist(), "document_name": "/tmp/handbook.pdf",
+            "page": i, "chunk": 0, "keep_until": keep_until, "_ts": int(time.time()),
+        }
+
+
+async def ask(client: httpx.AsyncClient, question: str) -> str:
+    answer = []
+    async with client.stream("GET", "/ask", params={"question": question, "passphrase": PASSPHRASE}) as response:
+        response.raise_for_status()
+        event = None
+        async for line in response.aiter_lines():
+            # The answer is in unnamed events; retrieving, sources and timing are named
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: ") and event is None:
+                answer.append(line[len("data: "):])
+            elif not line:
+                event = None
+    return "".join(answer)
+
+
+async def run_round(client: httpx.AsyncClient, concurrency: int, topics: int, offset: int):
+    questions = [topic((offset + i) % topics) for i in range(concurrency)]
+    start = time.perf_counter()
+    answers = await asyncio.gather(*(ask(client, question) for question in questions))
+    elapsed = time.perf_counter() - start
+    # Every token of a stream must come from its own question's answer
+    mixed = sum(1 for question, answer in zip(questions, answers)
+                if not answer.startswith(f"Answer to {question}") or set(answer.split()) - set(f"Answer to {question}".split()))
+    return elapsed, mixed
+
+
+async def load(url: str, concurrency: int, rounds: int, topics: int):
+    results = []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    for round_number in range(rounds + 1):
+        # A new client per round, so no connection idles past the server's keep-alive timeout
+        async with httpx.AsyncClient(base_url=url, limits=limits, timeout=120) as client:
+            elapsed, mixed = await run_round(client, concurrency, topics, offset=round_number)
+        gc.collect()
+        results.append((round_number, elapsed, mixed, rss_mb()))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=200, help="Concurrent /ask streams per round")
+    parser.add_argument("--rounds", type=int, default=5, help="Measured rounds after one warm-up round")
+    parser.add_argument("--topics", type=int, default=50)
+    parser.add_argument("--tokens", type=int, default=40, help="Tokens per fake answer")
+    parser.add_argument("--max-growth-mb", type=float, default=20.0, help="Allowed RSS growth after warm-up")
+    args = parser.parse_args()
+
+    with BackgroundServer(create_app(latency=0.01, chat_tokens=args.tokens, token_latency=0.005)) as openai_server:
+        os.environ.update({
+            "EMBEDDER_OPENAI_API_BASE": openai_server.url,
+            "EMBEDDER_OPENAI_API_KEY": "fake",
+            "EMBEDDER_OPENAI_API_VERSION": "2024-02-01",
+            "LLM_OPENAI_API_BASE": openai_server.url,
+            "LLM_OPENAI_API_KEY": "fake",
+            "LLM_OPENAI_API_VERSION": "2024-02-01",
+            "EMBEDDING_CACHE_PATH": os.path.join(tempfile.mkdtemp(), "embedding_cache.sqlite3"),
+            # Every stream should reach the chat server
+            "ANSWER_CACHE_MAX_ENTRIES": "0",
+            "RETRIEVAL_BACKEND": "cosmos",
+        })
+        from main import app
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+
+        container = FakeContainer(provisioned_ru_per_second=10**6, latency=0.002)
+        seed(container, args.topics)
+        app.state.cosmos_connection = FakeConnection(container)
+
+        with BackgroundServer(app) as server:
+            results = asyncio.run(load(server.url, args.concurrency, args.rounds, args.topics))
+
+    print(f"{'round':>5s} {'seconds':>8s} {'streams/s':>10s} {'mixed':>6s} {'rss MB':>8s}")
+    for round_number, elapsed, mixed, rss in results:
+        label = "warm" if round_number == 0 else str(round_number)
+        print(f"{label:>5s} {elapsed:8.2f} {args.concurrency / elapsed:10.1f} {mixed:6d} {rss:8.1f}")
+
+    growth = results[-1][3] - results[0][3]
+    mixed = sum(result[2] for result in results)
+    print(f"RSS growth after warm-up: {growth:.1f} MB over {args.rounds * args.concurrency} streams")
+    if mixed or growth > args.max_growth_mb:
+        print("FAIL" + (f": {mixed} streams carried tokens of other answers" if mixed else ": RSS kept growing"))
+        sys.exit(1)
+    print("PASS")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Prompt tokens saved by ContextPacker on simulated retrieval results.
+
+Splits synthetic pages, stores every page twice (under a second document name, the
+way a re-uploaded copy of a file is) and simulates retrievals that return a run of
+neighbouring chunks of one page, the same chunks of the copy and a few unrelated
+chunks. Reports the prompt tokens of the plain "Context: ..." concatenation against
+the packed context, and how long packing takes:
+
+    python bench/context_packing.py --pages 200 --queries 500 --top-k 8
+"""
+from pathlib import Path
+import argparse
+import random
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+import numpy as np
+from langchain.schema import Document
+from prepare.context import ContextPacker, format_context
+from prepare.split import Split
+from prepare.tokens import count_tokens
+from samples import make_text
+
+
+def make_chunks(pages: int, chunk_size: int, chunk_overlap: int):
+    splitter = Split(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    by_page = []
+    for page, text in enumerate(make_text(pages)):
+        for document_name in ("/tmp/report.pdf", "/tmp/report-copy.pdf"):
+            chunks = splitter.split_document(Document(page_content=text, metadata={'source': document_name, 'page': page}))
+            by_page.append([{
+                'content': chunk['page_content'],
+                'document_name': document_name,
+                'page': page,
+                'keep_until': '2999-01-01T00:00:00',
+                'start_index': chunk['metadata']['start_index'],
+                'end_index': chunk['metadata']['end_index'],
+            } for chunk in chunks])
+    return by_page
+
+
+def retrieve(by_page, top_k: int, rng: random.Random):
+    """A run of neighbouring chunks, the copy's version of some of them, then unrelated chunks."""
+    page = rng.randrange(0, len(by_page), 2)
+    original, copy = by_page[page], by_page[page + 1]
+    start = rng.randrange(len(original))
+    run = list(range(start, min(start + rng.randint(1, 4), len(original))))
+    results = [original[i] for i in run] + [copy[i] for i in run[:2]]
+    while len(results) < top_k:
+        results.append(rng.choice(rng.choice(by_page)))
+    rng.shuffle(results)
+    return results[:top_k]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--top-k", type=int, default=8)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--chunk-overlap", type=int, default=200)
+    parser.add_argument("--max-tokens", type=int, nargs="+", default=[3000, 1500, 800])
+    args = parser.parse_args()
+
+    by_page = make_chunks(args.pages, args.chunk_size, args.chunk_overlap)
+    rng = random.Random(0)
+    retrievals = [retrieve(by_page, args.top_k, rng) for _ in range(args.queries)]
+    plain = np.array([count_tokens(format_context(results)) for results in retrievals])
+    print(f"plain context {plain.mean():8.1f} tokens/request")
+
+    for max_tokens in args.max_tokens:
+        packer = ContextPacker(max_tokens=max_tokens)
+        reports, latencies = [], []
+        for results in retrievals:
+            start = time.perf_counter()
+            _, report = packer.pack(results)
+            latencies.append(time.perf_counter() - start)
+            reports.append(report)
+        latencies = np.array(latencies) * 1000
+        tokens = np.mean([report['prompt_tokens'] for report in reports])
+        saved = np.mean([report['prompt_tokens_saved'] for report in reports])
+        counts = {key: np.mean([report[key] for report in reports]) for key in ("duplicates", "merged", "over_budget", "passages")}
+        print(f"budget {max_tokens:5d}  {tokens:8.1f} tokens/request  {saved:7.1f} saved ({saved / plain.mean():5.1%})  "
+              f"{counts['duplicates']:.2f} duplicates {counts['merged']:.2f} merges {counts['over_budget']:.2f} over budget "
+              f"{counts['passages']:.2f} passages  p50 {np.percentile(latencies, 50):.2f} ms p99 {np.percentile(latencies, 99):.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Cosmos write throughput against the in-process Cosmos stand-in.
+
+Compares one upsert_item call per chunk (the old Store.store_embeddings loop) with
+BulkWriter's concurrent transactional batches, and reports items/s and RU/s:
+
+    python bench/cosmos_write.py --items 2000 --ru 20000
+"""
+from pathlib import Path
+import argparse
+import asyncio
+import sys
+import time
+import uuid
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+import numpy as np
+from fake_cosmos import FakeContainer
+
+
+def make_items(count: int, partitions: int, dimensions: int = 1536):
+    rng = np.random.default_rng(0)
+    return [{
+        "id": str(uuid.uuid4()),
+        "passphrase_hash": f"tenant-{i % partitions}",
+        "metadata": {"source": "/tmp/bench.pdf", "page": i // 4, "chunk": i % 4},
+        "embedding": rng.standard_normal(dimensions).astype(np.float32).tolist(),
+        "document_name": "/tmp/bench.pdf",
+        "page": i // 4,
+        "chunk": i % 4,
+        "keep_until": "2999-01-01T00:00:00",
+        "load_time": "2024-01-01T00:00:00",
+        "content": "The quick brown fox jumps over the lazy dog. " * 20,
+    } for i in range(count)]
+
+
+async def serial(container: FakeContainer, items):
+    for item in items:
+        while True:
+            try:
+                await container.upsert_item(item)
+                break
+            except Exception as e:
+                if getattr(e, "status_code", None) != 429:
+                    raise
+                await asyncio.sleep(float(e.headers["x-ms-retry-after-ms"]) / 1000)
+
+
+async def bulk(container: FakeContainer, items, ru_per_second: float, concurrency: int):
+    from prepare.cosmos import BulkWriter
+    from prepare.rate_limit import RequestUnitBudget
+
+    writer = BulkWriter(container, RequestUnitBudget(max_ru_per_second=ru_per_second), max_concurrency=concurrency)
+    return await writer.upsert_items(items)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=2000)
+    parser.add_argument("--partitions", type=int, default=4)
+    parser.add_argument("--ru", type=float, default=20_000, help="Provisioned RU/s of the stand-in")
+    parser.add_argument("--latency", type=float, default=0.005, help="Latency per request (s)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    items = make_items(args.items, args.partitions)
+    for label, run in [
+        ("serial upsert_item", lambda container: serial(container, items)),
+        (f"bulk batches ({args.concurrency} in flight)",
+         lambda container: bulk(container, items, args.ru, args.concurrency)),
+    ]:
+        container = FakeContainer(provisioned_ru_per_second=args.ru, latency=args.latency)
+        start = time.perf_counter()
+        asyncio.run(run(container))
+        elapsed = time.perf_counter() - start
+        assert container.item_count() == len(items)
+        print(f"{label:32s} {elapsed:7.2f} s {len(items) / elapsed:9.1f} items/s "
+              f"{container.stats['request_charge'] / elapsed:10.1f} RU/s "
+              f"{container.stats['requests']:6d} requests {container.stats['throttled']:5d} throttled")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Embedding throughput against the local fake embeddings server.
+
+Compares the old one-chunk-per-request behaviour with batched, concurrent requests:
+
+    python bench/embed_throughput.py --chunks 2000 --latency 0.05
+"""
+from pathlib import Path
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from fake_openai import create_app
+from servers import BackgroundServer
+
+
+def make_chunks(count: int):
+    text = "The quick brown fox jumps over the lazy dog near the riverbank. " * 15
+    return [{"page_content": f"{i} {text}", "metadata": {"source": "bench.pdf", "page": i // 4, "chunk": i % 4}}
+            for i in range(count)]
+
+
+async def run(chunks, max_batch_size: int, max_concurrency: int) -> float:
+    from prepare.embed import Embed
+    from prepare.rate_limit import RateLimiter
+
+    embedder = Embed(
+        max_batch_size=max_batch_size,
+        max_concurrency=max_concurrency,
+        rate_limiter=RateLimiter(tokens_per_minute=10**9, requests_per_minute=10**9)
+    )
+    start = time.perf_counter()
+    embedded = await embedder.embed_documents(chunks)
+    elapsed = time.perf_counter() - start
+    assert len(embedded) == len(chunks)
+    assert all(doc['page_content'] == chunk['page_content'] for doc, chunk in zip(embedded, chunks))
+    await embedder.client.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.05, help="Fake server latency per request (s)")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    chunks = make_chunks(args.chunks)
+    with BackgroundServer(create_app(latency=args.latency)) as server:
+        os.environ["EMBEDDER_OPENAI_API_BASE"] = server.url
+        os.environ["EMBEDDER_OPENAI_API_KEY"] = "fake"
+        os.environ["EMBEDDER_OPENAI_API_VERSION"] = "2024-02-01"
+
+        for label, batch_size, concurrency in [
+            ("sequential (batch 1, 1 in flight)", 1, 1),
+            (f"batched (batch {args.batch_size}, {args.concurrency} in flight)", args.batch_size, args.concurrency),
+        ]:
+            elapsed = asyncio.run(run(chunks, batch_size, concurrency))
+            print(f"{label:45s} {elapsed:8.2f} s {len(chunks) / elapsed:10.1f} chunks/s")
+
+
+if __name__ == "__main__":
+    main()
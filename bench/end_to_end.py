@@ -0,0 +1,272 @@
+"""
+End-to-end load test of the real app against local stand-ins, with a JSON report.
+
+Starts the fake OpenAI server (with optional rate limits) and the FastAPI app of
+main.py on a fake Cosmos container, uploads generated PDFs through /upload and
+waits for their jobs, then asks questions about them as concurrent /ask streams.
+The report has upload throughput, per-job time to first stored chunk, /ask
+throughput, p50/p95/p99 stream latency and time to first token, the Cosmos request
+units and OpenAI requests spent, and the peak RSS of the process (app and fakes;
+parser worker processes are not included):
+
+    python bench/end_to_end.py --files 4 --pages 40 --questions 400 --concurrency 50 --output report.json
+
+Compare a later run with it; the run fails when a metric is more than
+--max-regression worse:
+
+    python bench/end_to_end.py --files 4 --pages 40 --questions 400 --concurrency 50 --compare report.json
+"""
+from pathlib import Path
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+import httpx
+import numpy as np
+from fake_cosmos import FakeContainer, FakeConnection
+from fake_openai import create_app
+from samples import make_pdf
+from servers import BackgroundServer
+
+PASSPHRASE = "end-to-end"
+# Report entries compared between runs, and whether higher is better
+COMPARED = [
+    ("upload.chunks_per_second", True),
+    ("upload.seconds_to_first_stored_chunk.p50", False),
+    ("ask.streams_per_second", True),
+    ("ask.latency_ms.p50", False),
+    ("ask.latency_ms.p95", False),
+    ("ask.latency_ms.p99", False),
+    ("ask.first_token_ms.p50", False),
+    ("ask.first_token_ms.p95", False),
+    ("ask.first_token_ms.p99", False),
+    ("cosmos.request_units", False),
+    ("peak_rss_mb", False),
+]
+
+
+def peak_rss_mb() -> float:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def percentiles(values) -> dict:
+    values = np.asarray(values, dtype=float)
+    if not len(values):
+        return {"p50": None, "p95": None, "p99": None}
+    return {f"p{p}": round(float(np.percentile(values, p)), 2) for p in (50, 95, 99)}
+
+
+def question(i: int, lines_per_page: int, pages: int) -> str:
+    """A question naming the item of one line of the generated PDFs, so keyword search finds its chunk."""
+    page = i % pages
+    line = (i * 7) % lines_per_page
+    return f"What happens to item {page * lines_per_page + line} on page {page}?"
+
+
+async def upload(client: httpx.AsyncClient, path: str, poll_seconds: float = 0.05) -> dict:
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        response = await client.post("/upload", params={"passphrase": PASSPHRASE, "expiration": 1},
+                                     files={"files": (os.path.basename(path), f, "application/pdf")})
+    response.raise_for_status()
+    job_id = response.json()["data"]["job_id"]
+    while True:
+        job = (await client.get(f"/jobs/{job_id}")).json()
+        if job["status"] in ("succeeded", "failed"):
+            job["seconds"] = time.perf_counter() - start
+            return job
+        await asyncio.sleep(poll_seconds)
+
+
+async def ask(client: httpx.AsyncClient, text: str) -> dict:
+    """Stream one answer; :return: latency and time to the first answer token in ms, and whether it came"""
+    start = time.perf_counter()
+    first_token, tokens, event = None, 0, None
+    async with client.stream("GET", "/ask", params={"question": text, "passphrase": PASSPHRASE}) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: ") and event is None:
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                tokens += 1
+            elif not line:
+                event = None
+    return {"latency_ms": (time.perf_counter() - start) * 1000,
+            "first_token_ms": first_token * 1000 if first_token is not None else None,
+            "tokens": tokens}
+
+
+async def run(url: str, paths, args) -> dict:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=600) as client:
+        start = time.perf_counter()
+        jobs = await asyncio.gather(*(upload(client, path) for path in paths))
+        upload_seconds = time.perf_counter() - start
+        chunks = sum(job["chunks_stored"] for job in jobs)
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+        errors = []
+
+        async def limited(i):
+            async with semaphore:
+                try:
+                    return await ask(client, question(i, args.lines_per_page, args.pages))
+                except Exception as e:
+                    errors.append(repr(e))
+                    return None
+
+        start = time.perf_counter()
+        streams = [s for s in await asyncio.gather(*(limited(i) for i in range(args.questions))) if s is not None]
+        ask_seconds = time.perf_counter() - start
+
+    return {
+        "upload": {
+            "files": len(jobs),
+            "failed": sum(job["status"] == "failed" for job in jobs),
+            "chunks": chunks,
+            "seconds": round(upload_seconds, 3),
+            "chunks_per_second": round(chunks / upload_seconds, 1),
+            "seconds_to_first_stored_chunk": percentiles(
+                [job["seconds_to_first_stored_chunk"] for job in jobs if job["seconds_to_first_stored_chunk"] is not None]
+            ),
+        },
+        "ask": {
+            "streams": len(streams),
+            "errors": len(errors),
+            "empty_answers": sum(stream["tokens"] == 0 for stream in streams),
+            "seconds": round(ask_seconds, 3),
+            "streams_per_second": round(len(streams) / ask_seconds, 1),
+            "latency_ms": percentiles([stream["latency_ms"] for stream in streams]),
+            "first_token_ms": percentiles([stream["first_token_ms"] for stream in streams if stream["first_token_ms"] is not None]),
+        },
+    }
+
+
+def lookup(report: dict, path: str):
+    for key in path.split("."):
+        report = report.get(key) if isinstance(report, dict) else None
+    return report
+
+
+def compare(baseline: dict, report: dict, max_regression: float) -> list:
+    """Print each compared metric of both runs; :return: the metrics that got worse by more than max_regression"""
+    regressions = []
+    print(f"{'metric':42s} {'baseline':>10s} {'current':>10s} {'change':>8s}")
+    for path, higher_is_better in COMPARED:
+        before, after = lookup(baseline, path), lookup(report, path)
+        if not before or after is None:
+            continue
+        change = (after - before) / before
+        worse = -change if higher_is_better else change
+        flag = "  worse" if worse > max_regression else ""
+        print(f"{path:42s} {before:10.2f} {after:10.2f} {change:+8.1%}{flag}")
+        if worse > max_regression:
+            regressions.append(path)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--pages", type=int, default=40, help="Pages per file")
+    parser.add_argument("--lines-per-page", type=int, default=45)
+    parser.add_argument("--questions", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=50, help="Concurrent /ask streams")
+    parser.add_argument("--backend", default="cosmos", choices=["cosmos", "ivf", "exact"])
+    parser.add_argument("--parser-workers", type=int, default=0, help="PARSER_WORKERS of the app")
+    parser.add_argument("--answer-cache", action="store_true", help="Keep the answer cache on (off by default so every stream reaches the chat server)")
+    parser.add_argument("--openai-latency", type=float, default=0.02, help="Seconds added to every OpenAI request")
+    parser.add_argument("--token-latency", type=float, default=0.005, help="Seconds between streamed chat tokens")
+    parser.add_argument("--chat-tokens", type=int, default=40)
+    parser.add_argument("--embedding-rpm", type=float, default=None, help="Fake embedding requests per minute quota")
+    parser.add_argument("--embedding-tpm", type=float, default=None, help="Fake embedding tokens per minute quota")
+    parser.add_argument("--cosmos-latency", type=float, default=0.005)
+    parser.add_argument("--cosmos-ru", type=float, default=10_000, help="Provisioned RU/s of the fake container")
+    parser.add_argument("--output", help="Write the JSON report here")
+    parser.add_argument("--compare", help="JSON report of an earlier run to compare with")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="Allowed relative worsening of a compared metric")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    openai_app = create_app(latency=args.openai_latency, chat_tokens=args.chat_tokens, token_latency=args.token_latency,
+                            requests_per_minute=args.embedding_rpm, tokens_per_minute=args.embedding_tpm)
+    with BackgroundServer(openai_app) as openai_server:
+        os.environ.update({
+            "EMBEDDER_OPENAI_API_BASE": openai_server.url,
+            "EMBEDDER_OPENAI_API_KEY": "fake",
+            "EMBEDDER_OPENAI_API_VERSION": "2024-02-01",
+            "LLM_OPENAI_API_BASE": openai_server.url,
+            "LLM_OPENAI_API_KEY": "fake",
+            "LLM_OPENAI_API_VERSION": "2024-02-01",
+            "EMBEDDING_CACHE_PATH": os.path.join(directory, "embedding_cache.sqlite3"),
+            "VECTOR_DIRECTORY": os.path.join(directory, "vectors"),
+            "RETRIEVAL_BACKEND": args.backend,
+            "PARSER_WORKERS": str(args.parser_workers),
+            "JANITOR_INTERVAL_SECONDS": "0",
+        })
+        if not args.answer_cache:
+            os.environ["ANSWER_CACHE_MAX_ENTRIES"] = "0"
+        from main import app
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        logging.getLogger("api.routes").setLevel(logging.WARNING)
+        logging.getLogger("prepare").setLevel(logging.WARNING)
+
+        container = FakeContainer(provisioned_ru_per_second=args.cosmos_ru, latency=args.cosmos_latency)
+        app.state.cosmos_connection = FakeConnection(container)
+        paths = []
+        for i in range(args.files):
+            paths.append(os.path.join(directory, f"document_{i}.pdf"))
+            make_pdf(paths[-1], pages=args.pages, lines_per_page=args.lines_per_page)
+
+        with BackgroundServer(app) as server:
+            report = asyncio.run(run(server.url, paths, args))
+
+        report["cosmos"] = {
+            "request_units": round(container.stats["request_charge"], 1),
+            "requests": container.stats["requests"],
+            "throttled": container.stats["throttled"],
+        }
+        report["openai"] = {
+            "embedding_requests": openai_app.state.requests,
+            "embedding_inputs": openai_app.state.inputs,
+            "embedding_throttled": openai_app.state.throttled,
+            "chat_requests": openai_app.state.chat_requests,
+        }
+    report["peak_rss_mb"] = round(peak_rss_mb(), 1)
+    report["config"] = {key: value for key, value in vars(args).items() if key not in ("output", "compare")}
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    failed = report["upload"]["failed"] or report["ask"]["errors"]
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != report["config"]:
+            print("Warning: the runs were configured differently")
+        regressions = compare(baseline, report, args.max_regression)
+        if regressions:
+            print(f"FAIL: {', '.join(regressions)} worse by more than {args.max_regression:.0%}")
+            sys.exit(1)
+    if failed:
+        print(f"FAIL: {report['upload']['failed']} failed uploads, {report['ask']['errors']} failed streams")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
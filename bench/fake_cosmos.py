@@ -0,0 +1,371 @@
+"""
+In-process stand-in for an azure.cosmos.aio container, for offline benchmarks.
+
+It keeps items in memory per partition key, simulates network latency, charges
+request units roughly the way the service does (a base cost plus a cost per KB
+written) and answers 429 with x-ms-retry-after-ms once the provisioned RU/s are
+used up, so throttling and RU accounting can be exercised without an account.
+
+Queries support the subset of the Cosmos SQL dialect the app uses: SELECT
+[DISTINCT] [TOP n] with field paths, aliases and VectorDistance, WHERE with
+comparisons, AND/OR/NOT and IS_DEFINED, ORDER BY one expression, literals and
+@parameters. They scan the partition (or every partition) in Python.
+"""
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError, CosmosBatchOperationError, CosmosHttpResponseError,
+    CosmosResourceExistsError, CosmosResourceNotFoundError
+)
+import asyncio
+import copy
+import json
+import re
+import time
+import uuid
+import numpy as np
+
+QUERY_PATTERN = re.compile(
+    r"^\s*SELECT\s+(?P<distinct>DISTINCT\s+)?(?:TOP\s+(?P<top>\S+)\s+)?(?P<fields>.*?)\s+FROM\s+c\b"
+    r"(?:\s+WHERE\s+(?P<where>.*?))?(?:\s+ORDER\s+BY\s+(?P<order>.*?))?\s*$",
+    re.S | re.I
+)
+STRING_LITERAL = re.compile(r"('(?:[^'\\]|\\.)*')")
+
+
+def _field(item: dict, path: str):
+    value = item
+    for name in path.split('.'):
+        if not isinstance(value, dict) or name not in value:
+            return None
+        value = value[name]
+    return value
+
+
+def _cosine(a, b) -> float:
+    if a is None or b is None:
+        return None
+    a, b = np.asarray(a, dtype=np.float32), np.asarray(b, dtype=np.float32)
+    return float(a @ b / max(float(np.linalg.norm(a) * np.linalg.norm(b)), 1e-12))
+
+
+def _translate(expression: str) -> str:
+    """Turn a Cosmos SQL expression into an equivalent Python expression over item and params."""
+    parts = STRING_LITERAL.split(expression)
+    for i in range(0, len(parts), 2):
+        part = parts[i]
+        part = re.sub(r"\bVectorDistance\s*\(", "_cosine(", part, flags=re.I)
+        part = re.sub(r"\bIS_DEFINED\s*\(", "(None is not ", part, flags=re.I)
+        part = re.sub(r"\bc((?:\.\w+)+)", lambda m: f"_field(item, '{m.group(1)[1:]}')", part)
+        part = re.sub(r"@(\w+)", r"params['@\1']", part)
+        part = re.sub(r"\bAND\b", "and", part, flags=re.I)
+        part = re.sub(r"\bOR\b", "or", part, flags=re.I)
+        part = re.sub(r"\bNOT\b", "not", part, flags=re.I)
+        part = re.sub(r"\btrue\b", "True", part)
+        part = re.sub(r"\bfalse\b", "False", part)
+        part = re.sub(r"\bnull\b", "None", part)
+        part = part.replace("<>", "!=")
+        part = re.sub(r"(?<![<>!=])=(?!=)", "==", part)
+        parts[i] = part
+    # Parenthesized so the expression may span lines
+    return "(" + "".join(parts) + ")"
+
+
+def _split_top_level(text: str, separator: str = ",") -> list:
+    parts, depth, current, quoted = [], 0, "", False
+    for char in text:
+        if char == "'":
+            quoted = not quoted
+        elif not quoted and char in "([":
+            depth += 1
+        elif not quoted and char in ")]":
+            depth -= 1
+        if char == separator and depth == 0 and not quoted:
+            parts.append(current)
+            current = ""
+        else:
+            current += char
+    parts.append(current)
+    return [part.strip() for part in parts if part.strip()]
+
+
+class ParsedQuery:
+    def __init__(self, query: str):
+        match = QUERY_PATTERN.match(query)
+        if match is None:
+            raise ValueError(f"Unsupported query: {query}")
+        self.distinct = bool(match.group("distinct"))
+        self.top = match.group("top")
+        self.fields = []
+        for field in _split_top_level(match.group("fields")):
+            alias_match = re.match(r"^(.*?)\s+AS\s+(\w+)$", field, re.S | re.I)
+            expression, alias = (alias_match.group(1), alias_match.group(2)) if alias_match else (field, None)
+            if expression == "*":
+                self.fields.append(("*", None))
+                continue
+            alias = alias or expression.split(".")[-1]
+            self.fields.append((alias, compile(_translate(expression), "<select>", "eval")))
+        self.where = compile(_translate(match.group("where")), "<where>", "eval") if match.group("where") else None
+        self.order = None
+        if match.group("order"):
+            order = match.group("order").strip()
+            descending = bool(re.search(r"\s+DESC$", order, re.I))
+            order = re.sub(r"\s+(ASC|DESC)$", "", order, flags=re.I)
+            # VectorDistance orders most similar first
+            descending = descending or order.lower().startswith("vectordistance")
+            self.order = (compile(_translate(order), "<order>", "eval"), descending)
+
+    @staticmethod
+    def evaluate(code, item: dict, params: dict):
+        try:
+            return eval(code, {"_field": _field, "_cosine": _cosine, "item": item, "params": params})
+        except TypeError:
+            # Comparisons with undefined values are false in Cosmos
+            return None
+
+    def run(self, items, params: dict) -> list:
+        if self.where is not None:
+            items = [item for item in items if self.evaluate(self.where, item, params)]
+        if self.order is not None:
+            code, descending = self.order
+            keyed = [(self.evaluate(code, item, params), item) for item in items]
+            keyed = [(key, item) for key, item in keyed if key is not None]
+            keyed.sort(key=lambda pair: pair[0], reverse=descending)
+            items = [item for _, item in keyed]
+        rows = []
+        for item in items:
+            row = {}
+            for alias, code in self.fields:
+                if code is None:
+                    row.update(copy.deepcopy(item))
+                else:
+                    value = self.evaluate(code, item, params)
+                    if value is not None:
+                        row[alias] = value
+            rows.append(row)
+        if self.distinct:
+            unique = {json.dumps(row, sort_keys=True): row for row in rows}
+            rows = list(unique.values())
+        if self.top is not None:
+            top = params[self.top] if self.top.startswith("@") else int(self.top)
+            rows = rows[:int(top)]
+        return rows
+
+
+class FakeContainer:
+    def __init__(
+        self,
+        provisioned_ru_per_second: float = 10_000,
+        latency: float = 0.005,
+        write_base_ru: float = 5.0,
+        write_ru_per_kb: float = 1.0,
+        partition_key: str = "passphrase_hash"
+    ):
+        self.provisioned_ru_per_second = provisioned_ru_per_second
+        self.latency = latency
+        self.write_base_ru = write_base_ru
+        self.write_ru_per_kb = write_ru_per_kb
+        self.partition_key = partition_key
+        self.partitions = {}
+        self.available_ru = provisioned_ru_per_second
+        self.last_refill = time.monotonic()
+        self.stats = {"requests": 0, "throttled": 0, "request_charge": 0.0}
+
+    # Accounting
+
+    def _charge(self, request_units: float) -> dict:
+        """Spend request units or raise a 429 like the service does."""
+        current_time = time.monotonic()
+        self.available_ru = min(
+            self.provisioned_ru_per_second,
+            self.available_ru + (current_time - self.last_refill) * self.provisioned_ru_per_second
+        )
+        self.last_refill = current_time
+        self.stats["requests"] += 1
+        if request_units > self.available_ru:
+            self.stats["throttled"] += 1
+            wait_ms = (request_units - self.available_ru) / self.provisioned_ru_per_second * 1000
+            return {"x-ms-retry-after-ms": str(int(wait_ms) + 1), "x-ms-request-charge": "0"}
+        self.available_ru -= request_units
+        self.stats["request_charge"] += request_units
+        return {"x-ms-request-charge": f"{request_units:.2f}"}
+
+    def _write_charge(self, item: dict) -> float:
+        return self.write_base_ru + self.write_ru_per_kb * len(json.dumps(item)) / 1024
+
+    @staticmethod
+    def _stamp(item: dict) -> dict:
+        """Set the system properties the service maintains on every write."""
+        item["_etag"] = f'"{uuid.uuid4()}"'
+        item["_ts"] = int(time.time())
+        return item
+
+    @staticmethod
+    def _throttled(headers: dict) -> CosmosHttpResponseError:
+        error = CosmosHttpResponseError(status_code=429, message="Request rate is large")
+        error.headers = headers
+        return error
+
+    # Item operations
+
+    async def upsert_item(self, body: dict, response_hook=None, **kwargs) -> dict:
+        await asyncio.sleep(self.latency)
+        return self._put(body, response_hook)
+
+    async def create_item(self, body: dict, response_hook=None, **kwargs) -> dict:
+        await asyncio.sleep(self.latency)
+        if body["id"] in self.partitions.get(body[self.partition_key], {}):
+            raise CosmosResourceExistsError(status_code=409, message="Entity with the specified id already exists")
+        return self._put(body, response_hook)
+
+    async def replace_item(self, item, body: dict, etag=None, match_condition=None, response_hook=None, **kwargs) -> dict:
+        await asyncio.sleep(self.latency)
+        self._check_etag(self.partitions.get(body[self.partition_key], {}).get(item), etag, match_condition)
+        return self._put(body, response_hook)
+
+    def _put(self, body: dict, response_hook) -> dict:
+        # Checks and writes happen without awaiting in between, so they are atomic like on the service
+        headers = self._charge(self._write_charge(body))
+        if "x-ms-retry-after-ms" in headers:
+            raise self._throttled(headers)
+        item = self._stamp(copy.deepcopy(body))
+        self.partitions.setdefault(body[self.partition_key], {})[body["id"]] = item
+        if response_hook:
+            response_hook(headers, item)
+        return copy.deepcopy(item)
+
+    @staticmethod
+    def _check_etag(found, etag, match_condition):
+        if found is None:
+            raise CosmosResourceNotFoundError(status_code=404, message="Entity with the specified id does not exist")
+        if match_condition == MatchConditions.IfNotModified and found.get("_etag") != etag:
+            raise CosmosAccessConditionFailedError(status_code=412, message="Precondition failed")
+
+    async def execute_item_batch(self, batch_operations, partition_key, response_hook=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        partition = self.partitions.setdefault(partition_key, {})
+        charge = 0.0
+        for operation, args, *_ in batch_operations:
+            if operation in ("upsert", "create", "replace"):
+                charge += self._write_charge(args[-1])
+            elif operation == "patch" and args[0] in partition:
+                # Billed like a write of the patched item
+                charge += self._write_charge(partition[args[0]])
+            else:
+                charge += self.write_base_ru
+        headers = self._charge(charge)
+        if "x-ms-retry-after-ms" in headers:
+            raise CosmosBatchOperationError(
+                error_index=0, headers=headers, status_code=429, message="Request rate is large",
+                operation_responses=[{"statusCode": 429}] * len(batch_operations)
+            )
+        # Batches are transactional: a missing item fails the batch before anything is written
+        for index, (operation, args, *_) in enumerate(batch_operations):
+            if operation in ("patch", "delete", "read", "replace") and args[0] not in partition:
+                raise CosmosBatchOperationError(
+                    error_index=index, headers=headers, status_code=404, message="Entity does not exist",
+                    operation_responses=[{"statusCode": 424}] * index + [{"statusCode": 404}]
+                )
+
+        results = []
+        for operation, args, *_ in batch_operations:
+            if operation in ("upsert", "create", "replace"):
+                item = self._stamp(copy.deepcopy(args[-1]))
+                partition[item["id"]] = item
+                results.append({"statusCode": 200, "resourceBody": item})
+            elif operation == "patch":
+                item = partition[args[0]]
+                for patch in args[1]:
+                    item[patch["path"].lstrip("/")] = copy.deepcopy(patch["value"])
+                self._stamp(item)
+                results.append({"statusCode": 200, "resourceBody": item})
+            elif operation == "delete":
+                del partition[args[0]]
+                results.append({"statusCode": 204})
+            elif operation == "read":
+                results.append({"statusCode": 200, "resourceBody": partition.get(args[0])})
+        if response_hook:
+            response_hook(headers, results)
+        return results
+
+    async def read_item(self, item, partition_key, response_hook=None, **kwargs) -> dict:
+        await asyncio.sleep(self.latency)
+        headers = self._charge(1.0)
+        if "x-ms-retry-after-ms" in headers:
+            raise self._throttled(headers)
+        found = self.partitions.get(partition_key, {}).get(item)
+        if found is None:
+            raise CosmosResourceNotFoundError(status_code=404, message="Entity with the specified id does not exist")
+        if response_hook:
+            response_hook(headers, found)
+        return copy.deepcopy(found)
+
+    async def delete_item(self, item, partition_key, etag=None, match_condition=None, response_hook=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        headers = self._charge(self.write_base_ru)
+        if "x-ms-retry-after-ms" in headers:
+            raise self._throttled(headers)
+        self._check_etag(self.partitions.get(partition_key, {}).get(item), etag, match_condition)
+        del self.partitions[partition_key][item]
+        if response_hook:
+            response_hook(headers, None)
+
+    async def delete_all_items_by_partition_key(self, partition_key, response_hook=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        headers = self._charge(self.write_base_ru)
+        if "x-ms-retry-after-ms" in headers:
+            raise self._throttled(headers)
+        self.partitions.pop(partition_key, None)
+        if response_hook:
+            response_hook(headers, None)
+
+    def query_items(self, query: str, parameters=None, partition_key=None, response_hook=None, **kwargs):
+        return self._query(query, parameters or [], partition_key, response_hook)
+
+    async def _query(self, query: str, parameters, partition_key, response_hook):
+        if hasattr(response_hook, "clear"):
+            response_hook.clear()
+        await asyncio.sleep(self.latency)
+        started = time.perf_counter()
+        params = {parameter["name"]: parameter["value"] for parameter in parameters}
+        if partition_key is not None:
+            items = list(self.partitions.get(partition_key, {}).values())
+        else:
+            items = [item for partition in self.partitions.values() for item in partition.values()]
+        rows = ParsedQuery(query).run(items, params)
+        # The SDK retries throttled queries itself, so wait like it would
+        while True:
+            headers = self._charge(2.5 + 0.02 * len(items) + 0.1 * len(rows))
+            if "x-ms-retry-after-ms" not in headers:
+                break
+            await asyncio.sleep(float(headers["x-ms-retry-after-ms"]) / 1000)
+        headers["x-ms-documentdb-query-metrics"] = (
+            f"totalExecutionTimeInMs={(time.perf_counter() - started) * 1000:.2f};"
+            f"retrievedDocumentCount={len(items)};outputDocumentCount={len(rows)}"
+        )
+        if response_hook:
+            response_hook(headers, {"Documents": rows})
+        for row in rows:
+            yield row
+
+    async def read(self, **kwargs) -> dict:
+        await asyncio.sleep(self.latency)
+        return {"id": "fake", "partitionKey": {"paths": [f"/{self.partition_key}"]}}
+
+    def item_count(self) -> int:
+        return sum(len(partition) for partition in self.partitions.values())
+
+
+class FakeConnection:
+    """Stand-in for prepare.cosmos.CosmosConnection around a FakeContainer, for app.state.cosmos_connection."""
+    def __init__(self, container: FakeContainer):
+        self.container = container
+        self.bulk_container = container
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def ready(self, timeout: float = 2.0) -> bool:
+        return True
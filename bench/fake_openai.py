@@ -0,0 +1,156 @@
+"""
+Local stand-in for the Azure OpenAI embeddings and chat completions APIs, for
+offline benchmarks.
+
+Vectors are derived from a hash of the input text, so the same text always gets
+the same unit-length embedding. Chat answers echo the first line of the last user
+message ("Answer to <question> ...") so a client can tell whether it received the
+stream of its own request. With a requests or tokens per minute quota, requests over
+it get a 429 with retry-after-ms, like a deployment at its rate limit.
+"""
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from typing import Optional
+import asyncio
+import base64
+import hashlib
+import json
+import math
+import time
+import numpy as np
+
+
+def fake_embedding(text: str, dimensions: int = 1536) -> np.ndarray:
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def fake_answer(messages: list, tokens: int) -> list:
+    """Tokens of the answer to a chat request: the question's words, repeated up to tokens."""
+    question = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+    words = ["Answer", "to"] + (question.splitlines()[0].split() if question else []) or ["empty"]
+    return [words[i % len(words)] + " " for i in range(max(tokens, len(words)))]
+
+
+class MinuteQuota:
+    """Requests and tokens per minute, refilled continuously; None means unlimited."""
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None):
+        self.limits = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.available = {name: limit for name, limit in self.limits.items() if limit}
+        self.last_refill = time.monotonic()
+
+    def take(self, tokens: int) -> float:
+        """Spend one request and tokens; :return: 0, or the seconds to wait when over the quota"""
+        now = time.monotonic()
+        for name in self.available:
+            self.available[name] = min(self.limits[name], self.available[name] + (now - self.last_refill) * self.limits[name] / 60)
+        self.last_refill = now
+        wanted = {"requests": 1, "tokens": tokens}
+        wait = max((
+            (wanted[name] - self.available[name]) * 60 / self.limits[name]
+            for name in self.available if wanted[name] > self.available[name]
+        ), default=0.0)
+        if wait == 0.0:
+            for name in self.available:
+                self.available[name] -= wanted[name]
+        return wait
+
+
+def rate_limited(wait: float) -> JSONResponse:
+    return JSONResponse(
+        status_code=429,
+        content={"error": {"code": "429", "message": "Requests to this deployment have exceeded the rate limit."}},
+        headers={"retry-after-ms": str(int(wait * 1000) + 1), "retry-after": str(math.ceil(wait))}
+    )
+
+
+def create_app(
+    latency: float = 0.05,
+    latency_per_input: float = 0.001,
+    dimensions: int = 1536,
+    chat_tokens: int = 40,
+    token_latency: float = 0.005,
+    requests_per_minute: Optional[float] = None,
+    tokens_per_minute: Optional[float] = None
+) -> FastAPI:
+    """
+    Build the fake server.
+
+    :param latency: Fixed seconds added to every request
+    :param latency_per_input: Extra seconds per input text in a request
+    :param dimensions: Length of the returned vectors
+    :param chat_tokens: Tokens in every chat answer
+    :param token_latency: Seconds between streamed chat tokens
+    :param requests_per_minute: Embedding requests allowed per minute, unlimited when None
+    :param tokens_per_minute: Embedding input tokens allowed per minute, unlimited when None
+    """
+    app = FastAPI()
+    app.state.requests = 0
+    app.state.inputs = 0
+    app.state.chat_requests = 0
+    app.state.throttled = 0
+    quota = MinuteQuota(requests_per_minute, tokens_per_minute)
+
+    @app.get("/openai/models")
+    async def models():
+        # What the app's warm-up requests ask for; it costs no tokens
+        await asyncio.sleep(latency)
+        return {"object": "list", "data": [{"id": "text-embedding-ada-002", "object": "model"},
+                                           {"id": "gpt-35-turbo", "object": "model"}]}
+
+    @app.post("/openai/deployments/{deployment}/embeddings")
+    async def embeddings(deployment: str, request: Request):
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        tokens = sum(len(str(text)) // 4 + 1 for text in inputs)
+        wait = quota.take(tokens)
+        if wait:
+            app.state.throttled += 1
+            return rate_limited(wait)
+        app.state.requests += 1
+        app.state.inputs += len(inputs)
+        await asyncio.sleep(latency + latency_per_input * len(inputs))
+
+        data = []
+        for i, text in enumerate(inputs):
+            vector = fake_embedding(str(text), dimensions)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.tobytes()).decode()
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+
+        return {
+            "object": "list",
+            "data": data,
+            "model": deployment,
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    @app.post("/openai/deployments/{deployment}/chat/completions")
+    async def chat_completions(deployment: str, request: Request):
+        body = await request.json()
+        app.state.chat_requests += 1
+        await asyncio.sleep(latency)
+        tokens = fake_answer(body["messages"], chat_tokens)
+
+        def completion(**choice):
+            return {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": 0, "model": deployment,
+                    "choices": [{"index": 0, **choice}]}
+
+        if not body.get("stream"):
+            answer = completion(message={"role": "assistant", "content": "".join(tokens)}, finish_reason="stop")
+            answer["object"] = "chat.completion"
+            return answer
+
+        async def stream():
+            for token in tokens:
+                await asyncio.sleep(token_latency)
+                yield f"data: {json.dumps(completion(delta={'role': 'assistant', 'content': token}, finish_reason=None))}\n\n"
+            yield f"data: {json.dumps(completion(delta={}, finish_reason='stop'))}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return app
@@ -0,0 +1,150 @@
+"""
+Hit rate and latency of vector, BM25 keyword and fused (RRF) retrieval.
+
+Builds a synthetic multi-tenant corpus: every chunk belongs to a topic, its
+embedding is drawn around the topic's centre and its text mixes topic words,
+common words and one part number. Two kinds of questions are asked per tenant:
+
+- code: names a chunk's part number plus a few topic words, with an embedding near
+  the topic centre, so every chunk of the topic is about as similar
+- paraphrase: shares no terms with the chunk but has an embedding close to it
+- off-topic: about something the corpus does not cover, sharing only a couple of
+  common words with some chunks, with an unrelated embedding
+
+A question hits when its chunk is in the top k. For off-topic questions, the
+share that get any result is reported instead; it should be 0, so /ask can say it
+found nothing. Also reports how long the inverted indexes take to build and to
+update incrementally, and their size:
+
+    python bench/hybrid_retrieval.py --tenants 20 --chunks 5000 --queries 200 --k 5 --min-coverage 0.4
+"""
+from pathlib import Path
+import argparse
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+import numpy as np
+from prepare.index import IVFIndex
+from prepare.keyword import InvertedIndex, tokenize
+from prepare.retrieve import reciprocal_rank_fusion
+
+SYLLABLES = ["ka", "lo", "mi", "ne", "su", "ta", "ri", "po", "ve", "du", "an", "el", "or", "is", "um"]
+
+
+def make_words(count: int, rng, length: int = 3):
+    return ["".join(rng.choice(SYLLABLES, length)) + str(i) for i in range(count)]
+
+
+class Tenant:
+    def __init__(self, chunks: int, dimensions: int, topics: int, common_words, rng):
+        self.topic_words = [make_words(30, rng) for _ in range(topics)]
+        self.centres = rng.standard_normal((topics, dimensions)).astype(np.float32)
+        self.topics = rng.integers(0, topics, chunks)
+        self.vectors = self.centres[self.topics] + 0.8 * rng.standard_normal((chunks, dimensions)).astype(np.float32)
+        self.vectors /= np.linalg.norm(self.vectors, axis=1, keepdims=True)
+        self.codes = [f"PN-{rng.integers(10000, 99999)}-{chr(65 + i % 26)}" for i in range(chunks)]
+        self.texts = [
+            " ".join(list(rng.choice(self.topic_words[topic], 40)) + list(rng.choice(common_words, 60)) + [code])
+            for topic, code in zip(self.topics, self.codes)
+        ]
+        self.ids = [str(i) for i in range(chunks)]
+        self.payloads = [{'content': text, 'document_name': '/tmp/bench.pdf', 'page': i}
+                         for i, text in enumerate(self.texts)]
+
+
+def questions(tenant: Tenant, count: int, dimensions: int, common_words, rng):
+    """(kind, target row, text, vector) per question; off-topic questions have no target row."""
+    asked = []
+    for row in rng.integers(0, len(tenant.ids), count):
+        topic = tenant.topics[row]
+        near_centre = tenant.centres[topic] + 0.8 * rng.standard_normal(dimensions).astype(np.float32)
+        words = " ".join(rng.choice(tenant.topic_words[topic], 3))
+        asked.append(("code", row, f"what is the rating of {tenant.codes[row]} {words}", near_centre))
+        near_chunk = tenant.vectors[row] + 0.03 * rng.standard_normal(dimensions).astype(np.float32)
+        asked.append(("paraphrase", row, "explain how this works", near_chunk))
+        words = " ".join(rng.choice(common_words, 2))
+        asked.append(("off-topic", None, f"who won the football world cup in 1998 {words}", rng.standard_normal(dimensions).astype(np.float32)))
+    return asked
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tenants", type=int, default=20)
+    parser.add_argument("--chunks", type=int, default=5000, help="Chunks per tenant")
+    parser.add_argument("--dimensions", type=int, default=256)
+    parser.add_argument("--topics", type=int, default=20, help="Topics per tenant")
+    parser.add_argument("--queries", type=int, default=100, help="Questions of each kind per tenant")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--candidate-factor", type=int, default=4)
+    parser.add_argument("--threshold", type=float, default=0.65)
+    parser.add_argument("--min-coverage", type=float, default=0.4, help="KEYWORD_MIN_COVERAGE")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    common_words = make_words(2000, rng)
+    tenants = [Tenant(args.chunks, args.dimensions, args.topics, common_words, rng) for _ in range(args.tenants)]
+
+    build_seconds, index_bytes, keyword_indexes, vector_indexes = 0.0, 0, [], []
+    for tenant in tenants:
+        vector_index = IVFIndex(args.dimensions, min_train_size=len(tenant.ids) + 1)
+        vector_index.add(tenant.ids, tenant.vectors, np.full(len(tenant.ids), np.inf), tenant.payloads)
+        vector_indexes.append(vector_index)
+        start = time.perf_counter()
+        keyword_index = InvertedIndex()
+        # Insert in upload-sized batches, the way Store feeds the backends
+        for offset in range(0, len(tenant.ids), 64):
+            end = offset + 64
+            keyword_index.add(tenant.ids[offset:end], tenant.texts[offset:end], np.full(len(tenant.ids[offset:end]), np.inf),
+                              tenant.payloads[offset:end])
+        build_seconds += time.perf_counter() - start
+        index_bytes += keyword_index.nbytes()
+        keyword_indexes.append(keyword_index)
+    total_chunks = args.tenants * args.chunks
+    print(f"indexed {total_chunks} chunks of {args.tenants} tenants in {build_seconds:.2f} s "
+          f"({total_chunks / build_seconds:.0f} chunks/s), {index_bytes / total_chunks:.0f} bytes/chunk of postings")
+
+    hits = {}
+    latencies = {"vector": [], "keyword": [], "fused": []}
+    candidates = args.k * args.candidate_factor
+    for tenant, vector_index, keyword_index in zip(tenants, vector_indexes, keyword_indexes):
+        for kind, row, text, vector in questions(tenant, args.queries, args.dimensions, common_words, rng):
+            start = time.perf_counter()
+            vector_hits = [vector_index.payloads[r] for r, _ in vector_index.search(vector, candidates, args.threshold, 0.0)]
+            vector_end = time.perf_counter()
+            keyword_hits = [keyword_index.payloads[r] for r, _ in keyword_index.search(tokenize(text), candidates, 0.0, args.min_coverage)]
+            keyword_end = time.perf_counter()
+            fused = reciprocal_rank_fusion([vector_hits, keyword_hits], args.k)
+            fused_end = time.perf_counter()
+            latencies["vector"].append(vector_end - start)
+            latencies["keyword"].append(keyword_end - vector_end)
+            latencies["fused"].append(fused_end - start)
+            for method, results in (("vector", vector_hits[:args.k]), ("keyword", keyword_hits[:args.k]), ("fused", fused)):
+                hit = bool(results) if row is None else any(hit['page'] == row for hit in results)
+                hits.setdefault((kind, method), []).append(hit)
+
+    for kind in ("code", "paraphrase", "off-topic"):
+        measure = "with results" if kind == "off-topic" else f"hit@{args.k}"
+        print(f"{kind:10s} questions {measure:12s}  " + "  ".join(
+            f"{method} {np.mean(hits[(kind, method)]):.3f}" for method in ("vector", "keyword", "fused")))
+    for method, values in latencies.items():
+        values = np.array(values) * 1000
+        print(f"{method:8s} search p50 {np.percentile(values, 50):7.3f} ms  p99 {np.percentile(values, 99):7.3f} ms")
+
+    # Incremental updates: replace and remove a tenth of a tenant's chunks
+    tenant, keyword_index = tenants[0], keyword_indexes[0]
+    changed = tenant.ids[:len(tenant.ids) // 10]
+    start = time.perf_counter()
+    keyword_index.add(changed, [text + " revised" for text in tenant.texts[:len(changed)]],
+                      np.full(len(changed), np.inf), tenant.payloads[:len(changed)])
+    replaced = time.perf_counter() - start
+    start = time.perf_counter()
+    keyword_index.remove(changed)
+    removed = time.perf_counter() - start
+    print(f"replaced {len(changed)} chunks in {replaced * 1000:.1f} ms, removed them in {removed * 1000:.1f} ms "
+          f"({len(keyword_index)} left)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Cost of re-ranking candidates by maximal marginal relevance, in microseconds.
+
+Builds candidate pools of unit-normalized embeddings in which every passage comes
+with a few near-copies, the way a passage repeated across pages or file revisions
+is retrieved several times. Per pool size, it times:
+
+- vectorized: maximal_marginal_relevance, one matrix-vector product per pick
+- full matrix: the pool's whole similarity matrix first, then the same greedy picks
+- python loop: standard MMR written out pair by pair in Python, with cosine
+  similarities from the raw vectors, as an independent reference
+
+The three must pick the same candidates. It also reports how many distinct passages
+make the top k, ranked by relevance only and re-ranked:
+
+    python bench/mmr_rerank.py --pools 20 50 100 200 500 --top-k 5 --lambda 0.7
+"""
+from pathlib import Path
+import argparse
+import math
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+import numpy as np
+from prepare.retrieve import maximal_marginal_relevance
+
+
+def make_pool(size: int, dimensions: int, copies: int, rng: np.random.Generator):
+    """:return: Query, candidate vectors, their relevance and the passage each one copies"""
+    passages = rng.standard_normal((math.ceil(size / copies), dimensions)).astype(np.float32)
+    passage_of = np.arange(size) // copies
+    vectors = passages[passage_of] + 0.1 * rng.standard_normal((size, dimensions)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    query = vectors[:size // 4].mean(axis=0) + rng.standard_normal(dimensions).astype(np.float32) * 0.02
+    query /= np.linalg.norm(query)
+    relevance = vectors @ query
+    relevance /= relevance.max()
+    return query, vectors, relevance, passage_of
+
+
+def full_matrix(relevance: np.ndarray, vectors: np.ndarray, k: int, lambda_mult: float):
+    similarity = vectors @ vectors.T
+    scores = lambda_mult * relevance.astype(np.float32)
+    redundancy = np.full(len(relevance), -np.inf, dtype=np.float32)
+    picked = []
+    for _ in range(min(k, len(relevance))):
+        best = int(np.argmax(scores - (1 - lambda_mult) * redundancy if picked else scores))
+        picked.append(best)
+        scores[best] = -np.inf
+        np.maximum(redundancy, similarity[best], out=redundancy)
+    return picked
+
+
+def python_loop(relevance: np.ndarray, vectors: np.ndarray, k: int, lambda_mult: float):
+    rows = vectors.tolist()
+    relevance = relevance.tolist()
+
+    def cosine(a, b):
+        return sum(x * y for x, y in zip(a, b)) / math.sqrt(sum(x * x for x in a) * sum(y * y for y in b))
+
+    picked = []
+    while len(picked) < min(k, len(rows)):
+        best, best_score = None, -math.inf
+        for i, row in enumerate(rows):
+            if i in picked:
+                continue
+            score = lambda_mult * relevance[i]
+            if picked:
+                score -= (1 - lambda_mult) * max(cosine(row, rows[j]) for j in picked)
+            if score > best_score:
+                best, best_score = i, score
+        picked.append(best)
+    return picked
+
+
+def time_us(function, repeats: int, *args) -> float:
+    """Median microseconds of a call."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pools", type=int, nargs="+", default=[20, 50, 100, 200, 500])
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--lambda", dest="lambda_mult", type=float, default=0.7)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--copies", type=int, default=4, help="Near-copies of each passage in a pool")
+    parser.add_argument("--repeats", type=int, default=200)
+    parser.add_argument("--loop-max-pool", type=int, default=100, help="Largest pool the Python loop is timed on")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'pool':>5s} {'vectorized us':>14s} {'full matrix us':>15s} {'python loop us':>15s} "
+          f"{'distinct top-k':>15s} {'distinct mmr':>13s}")
+    for size in args.pools:
+        _, vectors, relevance, passage_of = make_pool(size, args.dimensions, args.copies, rng)
+        picked = maximal_marginal_relevance(relevance, vectors, args.top_k, args.lambda_mult)
+        assert picked == full_matrix(relevance, vectors, args.top_k, args.lambda_mult), "full matrix picked differently"
+        vectorized = time_us(maximal_marginal_relevance, args.repeats, relevance, vectors, args.top_k, args.lambda_mult)
+        matrix = time_us(full_matrix, max(args.repeats // 10, 3), relevance, vectors, args.top_k, args.lambda_mult)
+        loop = "-"
+        if size <= args.loop_max_pool:
+            assert picked == python_loop(relevance, vectors, args.top_k, args.lambda_mult), "python loop picked differently"
+            loop = f"{time_us(python_loop, 1, relevance, vectors, args.top_k, args.lambda_mult):.0f}"
+        top_k = np.argsort(-relevance)[:args.top_k]
+        print(f"{size:5d} {vectorized:14.1f} {matrix:15.1f} {loop:>15s} "
+              f"{len(set(passage_of[top_k])):15d} {len(set(passage_of[picked])):13d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Document parsing throughput: in the API process versus the parser process pool.
+
+Parses a fixed corpus of generated PDFs and reports pages/s and the worst event
+loop stall while parsing, for parsing in threads of the API process and for
+ParserPool with an increasing number of workers:
+
+    python bench/parse_throughput.py --files 8 --pages 120 --workers 1,2,4
+"""
+from pathlib import Path
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from samples import make_pdf
+
+
+def make_corpus(directory: str, files: int, pages: int):
+    paths = []
+    for i in range(files):
+        # Mixed sizes, from half to one and a half times the requested page count
+        path = os.path.join(directory, f"sample_{i}.pdf")
+        make_pdf(path, pages=max(1, pages * (2 + i % 3) // 4))
+        paths.append(path)
+    return paths
+
+
+async def measure_loop_lag(stop: asyncio.Event, lags: list, interval: float = 0.01):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def parse_corpus(paths, pages_of):
+    stop, lags = asyncio.Event(), []
+    ticker = asyncio.create_task(measure_loop_lag(stop, lags))
+    start = time.perf_counter()
+    counts = await asyncio.gather(*(pages_of(path) for path in paths))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await ticker
+    return sum(counts), elapsed, max(lags, default=0.0)
+
+
+async def run_threads(paths):
+    """The path without a pool: PyPDFLoader in worker threads of the API process."""
+    from prepare.load import Load
+    loader = Load()
+
+    async def pages_of(path):
+        return len(await asyncio.to_thread(loader.load_document, path))
+
+    return await parse_corpus(paths, pages_of)
+
+
+async def run_pool(paths, workers: int, pages_per_task: int):
+    from prepare.load import Load
+    from prepare.parse import ParserPool
+    pool = ParserPool(Load(), workers=workers, pages_per_task=pages_per_task)
+
+    async def pages_of(path):
+        return sum([1 async for _ in pool.iter_pages(path)])
+
+    # Start the workers before timing
+    await asyncio.gather(*(pages_of(paths[0]) for _ in range(workers)))
+    try:
+        return await parse_corpus(paths, pages_of)
+    finally:
+        await pool.stop()
+
+
+async def check_malformed(directory: str, good_path: str):
+    from prepare.load import Load
+    from prepare.parse import ParserPool, ParseError
+    bad_path = os.path.join(directory, "malformed.pdf")
+    with open(bad_path, "wb") as f:
+        f.write(b"%PDF-1.4\n" + os.urandom(4096))
+    pool = ParserPool(Load(), workers=2)
+
+    async def pages_of(path):
+        try:
+            return sum([1 async for _ in pool.iter_pages(path)])
+        except ParseError as e:
+            return e
+
+    try:
+        return await asyncio.gather(pages_of(bad_path), pages_of(good_path))
+    finally:
+        await pool.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=8)
+    parser.add_argument("--pages", type=int, default=120, help="Average pages per file")
+    parser.add_argument("--workers", default="1,2,4", help="Comma-separated worker counts")
+    parser.add_argument("--pages-per-task", type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_corpus(directory, args.files, args.pages)
+        print(f"Corpus: {len(paths)} PDFs, {os.cpu_count()} CPUs")
+        print(f"{'mode':24s} {'pages':>6s} {'seconds':>8s} {'pages/s':>8s} {'max loop stall ms':>18s}")
+
+        runs = [("threads (no pool)", run_threads(paths))]
+        runs += [(f"pool, {w} workers", run_pool(paths, w, args.pages_per_task)) for w in map(int, args.workers.split(","))]
+        for label, run in runs:
+            pages, elapsed, lag = asyncio.run(run)
+            print(f"{label:24s} {pages:6d} {elapsed:8.2f} {pages / elapsed:8.1f} {lag * 1000:18.1f}")
+
+        bad, good = asyncio.run(check_malformed(directory, paths[0]))
+        print(f"Malformed file: {type(bad).__name__}: {bad}; a valid file parsed alongside it: {good} pages")
+
+
+if __name__ == "__main__":
+    main()
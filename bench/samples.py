@@ -0,0 +1,62 @@
+"""Synthetic sample documents for benchmarks, written without any PDF library."""
+from typing import List
+import random
+
+
+def page_lines(page: int, lines: int) -> List[str]:
+    return [f"Page {page} line {line}: the quick brown fox jumps over the lazy dog, item {page * lines + line}."
+            for line in range(lines)]
+
+
+def make_text(pages: int, seed: int = 0) -> List[str]:
+    """
+    Pages of prose-like text: paragraphs of wrapped lines, blank-line runs, headings and
+    the odd long token (URLs, identifiers), so every separator of a recursive splitter is used.
+    """
+    rng = random.Random(seed)
+    words = ("the quick brown fox jumps over lazy dog policy section employee leave request approval "
+             "manager days annual report must within should shall may process document").split()
+    result = []
+    for page in range(pages):
+        paragraphs = [f"Section {page}.{rng.randint(1, 9)}"]
+        for _ in range(rng.randint(3, 8)):
+            lines = []
+            for _ in range(rng.randint(1, 12)):
+                line = [rng.choice(words) for _ in range(rng.randint(6, 16))]
+                if rng.random() < 0.03:
+                    line.append("https://example.com/" + "".join(rng.choice("abcdef0123456789/") for _ in range(rng.randint(40, 1600))))
+                lines.append(" ".join(line))
+            paragraphs.append("\n".join(lines))
+        result.append(("\n" * rng.randint(2, 3)).join(paragraphs))
+    return result
+
+
+def make_pdf(path: str, pages: int, lines_per_page: int = 45):
+    """Write a PDF with pages of Helvetica text lines that pypdf can extract."""
+    objects = {
+        1: "<< /Type /Catalog /Pages 2 0 R >>",
+        3: "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    }
+    kids = []
+    for page in range(pages):
+        page_id, content_id = 4 + 2 * page, 5 + 2 * page
+        text = " ".join(f"({line}) Tj T*" for line in page_lines(page, lines_per_page))
+        stream = f"BT /F1 9 Tf 40 800 Td 11 TL {text} ET"
+        objects[content_id] = f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream"
+        objects[page_id] = (f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents {content_id} 0 R "
+                            f"/Resources << /Font << /F1 3 0 R >> >> >>")
+        kids.append(f"{page_id} 0 R")
+    objects[2] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>"
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = {}
+    for object_id in sorted(objects):
+        offsets[object_id] = len(output)
+        output += f"{object_id} 0 obj\n{objects[object_id]}\nendobj\n".encode()
+    xref = len(output)
+    size = max(objects) + 1
+    output += f"xref\n0 {size}\n0000000000 65535 f \n".encode()
+    output += "".join(f"{offsets[object_id]:010d} 00000 n \n" for object_id in range(1, size)).encode()
+    output += f"trailer\n<< /Size {size} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, "wb") as f:
+        f.write(output)
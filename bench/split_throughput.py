@@ -0,0 +1,81 @@
+"""
+Text splitting throughput: LangChain's RecursiveCharacterTextSplitter versus prepare.split.TextSplitter.
+
+Splits a fixed synthetic corpus page by page (as uploads are split) and as one whole
+document, and reports MB/s and chunk counts for:
+
+- "langchain, newlines replaced": the previous upload path, which replaced every
+  newline with a space before splitting
+- "langchain": RecursiveCharacterTextSplitter on the original text
+- "offsets": TextSplitter on the original text
+
+TextSplitter must produce exactly the chunks of RecursiveCharacterTextSplitter, and
+its offsets must point at them; the script exits non-zero otherwise:
+
+    python bench/split_throughput.py --pages 2000
+"""
+from pathlib import Path
+import argparse
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from prepare.split import TextSplitter
+from samples import make_text
+
+
+def timed(split, texts):
+    start = time.perf_counter()
+    chunks = [split(text) for text in texts]
+    return chunks, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=2000)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--chunk-overlap", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3, help="Best of this many runs")
+    args = parser.parse_args()
+
+    pages = make_text(args.pages)
+    corpora = {"pages": pages, "whole document": ["\n\n".join(pages)]}
+    megabytes = sum(len(page.encode()) for page in pages) / 2**20
+    print(f"Corpus: {len(pages)} pages, {megabytes:.1f} MB")
+
+    langchain = RecursiveCharacterTextSplitter(chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap)
+    offsets = TextSplitter(chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap)
+    splitters = {
+        "langchain, newlines replaced": lambda text: langchain.split_text(text.replace("\n", " ")),
+        "langchain": langchain.split_text,
+        "offsets": offsets.split_text,
+    }
+
+    failures = 0
+    print(f"{'unit':16s} {'splitter':30s} {'chunks':>7s} {'seconds':>8s} {'MB/s':>7s}")
+    for unit, texts in corpora.items():
+        results = {}
+        for name, split in splitters.items():
+            chunks, elapsed = min((timed(split, texts) for _ in range(args.repeat)), key=lambda result: result[1])
+            results[name] = chunks
+            count = sum(len(page_chunks) for page_chunks in chunks)
+            print(f"{unit:16s} {name:30s} {count:7d} {elapsed:8.3f} {megabytes / elapsed:7.1f}")
+
+        if results["offsets"] != results["langchain"]:
+            failures += 1
+            print(f"FAIL: {unit}: offsets chunks differ from langchain chunks")
+        for text in texts:
+            if any(text[start:end] != text[start:end].strip() or not text[start:end] for start, end in offsets.split_spans(text)):
+                failures += 1
+                print(f"FAIL: {unit}: a span is empty or includes surrounding whitespace")
+                break
+
+    if failures:
+        sys.exit(1)
+    print("Chunks identical to RecursiveCharacterTextSplitter: PASS")
+
+
+if __name__ == "__main__":
+    main()
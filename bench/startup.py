@@ -0,0 +1,102 @@
+"""
+Cold-start time of the app: import time, time until it listens and until /ready says 200.
+
+Every run starts a fresh Python process that imports main, starts uvicorn on a fake
+Cosmos container and polls /ready, with the fake OpenAI server running in this
+process. Reports, per run and as medians:
+
+- import: seconds to import main
+- listening: seconds from process start until the server accepts connections
+  (when a liveness probe passes)
+- ready: seconds from process start until /ready returns 200 (when a replica gets
+  traffic); the chat models are created and connections opened in between
+- first ask: seconds of the first /ask stream after ready
+
+    python bench/startup.py --runs 5
+"""
+from pathlib import Path
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH = Path(__file__).resolve().parent
+SRC = BENCH.parent / "src"
+
+
+def child():
+    """One cold start, measured from inside the new process; prints a JSON line."""
+    start = time.perf_counter()
+    sys.path.insert(0, str(SRC))
+    import main
+    imported = time.perf_counter()
+
+    sys.path.insert(0, str(BENCH))
+    import httpx
+    from fake_cosmos import FakeContainer, FakeConnection
+    from servers import BackgroundServer
+    main.app.state.cosmos_connection = FakeConnection(FakeContainer())
+    with BackgroundServer(main.app) as server:
+        listening = time.perf_counter()
+        with httpx.Client(base_url=server.url, timeout=60) as client:
+            while client.get("/ready").status_code != 200:
+                time.sleep(0.02)
+            ready = time.perf_counter()
+            client.get("/ask", params={"question": "What is the leave policy?", "passphrase": "startup"}).raise_for_status()
+            asked = time.perf_counter()
+    print(json.dumps({
+        "import": imported - start,
+        "listening": listening - start,
+        "ready": ready - start,
+        "first_ask": asked - ready,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--openai-latency", type=float, default=0.05, help="Seconds the fake OpenAI server adds per request")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child()
+        return
+
+    sys.path.insert(0, str(BENCH))
+    from fake_openai import create_app
+    from servers import BackgroundServer
+
+    directory = tempfile.mkdtemp()
+    with BackgroundServer(create_app(latency=args.openai_latency)) as openai_server:
+        env = {
+            **os.environ,
+            "EMBEDDER_OPENAI_API_BASE": openai_server.url,
+            "EMBEDDER_OPENAI_API_KEY": "fake",
+            "EMBEDDER_OPENAI_API_VERSION": "2024-02-01",
+            "LLM_OPENAI_API_BASE": openai_server.url,
+            "LLM_OPENAI_API_KEY": "fake",
+            "LLM_OPENAI_API_VERSION": "2024-02-01",
+            "EMBEDDING_CACHE_PATH": os.path.join(directory, "embedding_cache.sqlite3"),
+            "RETRIEVAL_BACKEND": "cosmos",
+            "PARSER_WORKERS": "0",
+            "JANITOR_INTERVAL_SECONDS": "0",
+            "LOG_LEVEL": "WARNING",
+        }
+        runs = []
+        print(f"{'run':>4s} {'import s':>9s} {'listening s':>12s} {'ready s':>8s} {'first ask s':>12s}")
+        for run in range(args.runs):
+            output = subprocess.run([sys.executable, __file__, "--child"], env=env, capture_output=True, text=True, check=True)
+            result = json.loads(output.stdout.strip().splitlines()[-1])
+            runs.append(result)
+            print(f"{run + 1:4d} {result['import']:9.3f} {result['listening']:12.3f} {result['ready']:8.3f} {result['first_ask']:12.3f}")
+
+    medians = {key: statistics.median(result[key] for result in runs) for key in runs[0]}
+    print(f"{'p50':>4s} {medians['import']:9.3f} {medians['listening']:12.3f} {medians['ready']:8.3f} {medians['first_ask']:12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Size, write cost and recall of the embedding encodings.
+
+For each of float32, float16 and int8 it reports the JSON size of a stored chunk and
+the RU Store spends writing them to the in-process Cosmos stand-in, whose write
+charge grows with item size like the service's. It then compares top-k search over
+the decoded embeddings, and MemmapBackend's compact scans with and without float32
+rescoring, against exact float32 search:
+
+    python bench/vector_encoding.py --vectors 20000 --queries 200 --k 5
+"""
+from pathlib import Path
+import argparse
+import asyncio
+import datetime as dt
+import json
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+import numpy as np
+from ann_recall import make_vectors
+from fake_cosmos import FakeContainer
+from prepare.exact import MemmapBackend
+from prepare.rate_limit import RequestUnitBudget
+from prepare.store import Store
+from prepare.vectors import ENCODINGS, decode_embedding, encode_embedding
+
+CONTENT = "The quick brown fox jumps over the lazy dog. " * 20
+
+
+def make_documents(vectors: np.ndarray):
+    return [{
+        'page_content': f"{i} {CONTENT}",
+        'metadata': {'source': '/tmp/bench.pdf', 'page': i // 4, 'chunk': i % 4},
+        'embedding': vector.tolist(),
+        'document_name': '/tmp/bench.pdf',
+        'page': i // 4,
+        'chunk': i % 4,
+    } for i, vector in enumerate(vectors)]
+
+
+async def write(documents, encoding: str, ru_per_second: float):
+    container = FakeContainer(provisioned_ru_per_second=ru_per_second, latency=0.0)
+    store = Store(container, embedding_encoding=encoding)
+    store.ru_budget = store.writer.budget = RequestUnitBudget(max_ru_per_second=ru_per_second)
+    keep_until = dt.datetime.now() + dt.timedelta(hours=6)
+    report = await store.store_embeddings(passphrase="bench", documents=documents, keep_until=keep_until)
+    items = [item for partition in container.partitions.values() for item in partition.values()]
+    return report, items
+
+
+def top_k(matrix: np.ndarray, queries: np.ndarray, k: int):
+    scores = queries @ matrix.T
+    return [set(np.argpartition(-row, k - 1)[:k]) for row in scores]
+
+
+def recall(found, exact) -> float:
+    return float(np.mean([len(a & b) / len(b) for a, b in zip(found, exact)]))
+
+
+def search(backend: MemmapBackend, queries: np.ndarray, k: int):
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        hits = backend.search_partition("bench", query, k, threshold=-1.0, now=0.0)
+        latencies.append(time.perf_counter() - start)
+        results.append({int(hit['content']) for hit in hits})
+    return results, np.array(latencies) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vectors", type=int, default=20000)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--topics", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--write-items", type=int, default=1000, help="Chunks written per encoding")
+    parser.add_argument("--ru", type=float, default=100_000, help="Provisioned RU/s of the stand-in")
+    parser.add_argument("--rescore-factor", type=int, nargs="+", default=[0, 2, 4])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = make_vectors(args.vectors, args.dimensions, args.topics, rng)
+    queries = vectors[rng.integers(0, len(vectors), args.queries)] + 0.05 * rng.standard_normal(
+        (args.queries, args.dimensions)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    exact = top_k(vectors, queries, args.k)
+
+    documents = make_documents(vectors[:args.write_items])
+    for encoding in ENCODINGS:
+        report, items = asyncio.run(write(documents, encoding, args.ru))
+        item_bytes = np.mean([len(json.dumps(item)) for item in items])
+        decoded = np.stack([decode_embedding(encode_embedding(vector.tolist(), encoding)) for vector in vectors])
+        print(f"{encoding:8s} {item_bytes:8.0f} bytes/chunk  {report['request_charge'] / len(items):6.2f} RU/chunk  "
+              f"decoded recall@{args.k} {recall(top_k(decoded, queries, args.k), exact):.3f}")
+
+    items = [{
+        'id': str(i), 'embedding': vector, 'keep_until': '2999-01-01T00:00:00',
+        'content': str(i), 'document_name': '/tmp/bench.pdf', 'page': i // 4,
+    } for i, vector in enumerate(vectors)]
+    for encoding in ENCODINGS:
+        for rescore_factor in (args.rescore_factor if encoding != "float32" else [0]):
+            with tempfile.TemporaryDirectory() as directory:
+                backend = MemmapBackend(None, directory=directory, encoding=encoding, rescore_factor=rescore_factor)
+                backend.add_items("bench", items)
+                scanned = sum(path.stat().st_size for path in Path(directory).glob("*.npy")
+                              if encoding == "float32" or ".codes." in path.name or ".scales." in path.name)
+                found, latencies = search(backend, queries, args.k)
+            label = f"{encoding} scan" + (f", rescore x{rescore_factor}" if rescore_factor else "")
+            print(f"{label:26s} {scanned / len(vectors):6.0f} bytes/vector scanned  recall@{args.k} "
+                  f"{recall(found, exact):.3f}  p50 {np.percentile(latencies, 50):7.3f} ms  "
+                  f"p99 {np.percentile(latencies, 99):7.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
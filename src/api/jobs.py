@@ -0,0 +1,146 @@
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Callable, Awaitable
+import asyncio
+import datetime as dt
+import logging
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    """State and progress of one upload, shared between the worker and the status endpoints."""
+    def __init__(self, passphrase: str, files: List[Dict[str, str]], keep_until: dt.datetime):
+        """
+        :param passphrase: Passphrase the documents are stored under
+        :param files: Spooled uploads, each a dict with 'filename' and 'path'
+        :param keep_until: Expiry time of the stored chunks
+        """
+        self.id = uuid.uuid4().hex
+        self.passphrase = passphrase
+        self.files = files
+        self.keep_until = keep_until
+        self.status = "queued"
+        self.stage = None
+        self.processed_files = []
+        self.chunks_total = 0
+        self.chunks_embedded = 0
+        self.chunks_stored = 0
+        self.chunks_unchanged = 0
+        self.chunks_removed = 0
+        self.error = None
+        self.created_at = dt.datetime.now()
+        self.started_at = None
+        self.first_chunk_stored_at = None
+        self.finished_at = None
+        self.changed = asyncio.Event()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+    @property
+    def seconds_to_first_stored_chunk(self) -> Optional[float]:
+        """Time from the start of processing until the first chunks were stored."""
+        if self.started_at is None or self.first_chunk_stored_at is None:
+            return None
+        return (self.first_chunk_stored_at - self.started_at).total_seconds()
+
+    def update(self, **fields):
+        """Set job fields and wake everyone waiting for progress."""
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self._notify()
+
+    def advance(self, **counters: int):
+        """Add to progress counters such as chunks_embedded and wake waiters."""
+        for name, value in counters.items():
+            setattr(self, name, getattr(self, name) + value)
+        self._notify()
+
+    def _notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "files": [file['filename'] for file in self.files],
+            "processed_files": self.processed_files,
+            "chunks_total": self.chunks_total,
+            "chunks_embedded": self.chunks_embedded,
+            "chunks_stored": self.chunks_stored,
+            "chunks_unchanged": self.chunks_unchanged,
+            "chunks_removed": self.chunks_removed,
+            "error": self.error,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "seconds_to_first_stored_chunk": self.seconds_to_first_stored_chunk,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+class JobQueue:
+    """
+    Bounded queue of jobs processed by a fixed number of worker tasks.
+
+    submit() fails fast with asyncio.QueueFull once max_pending jobs are waiting,
+    which is the backpressure signal for callers. Finished jobs are kept for status
+    lookups until there are more than max_retained of them.
+    """
+    def __init__(
+        self,
+        handler: Callable[[Job], Awaitable[None]],
+        workers: int = 2,
+        max_pending: int = 16,
+        max_retained: int = 1000
+    ):
+        self.handler = handler
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_retained = max_retained
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self.queue: Optional[asyncio.Queue] = None
+        self.tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_pending)
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def submit(self, job: Job):
+        """Queue a job. Raises asyncio.QueueFull when too many jobs are already waiting."""
+        self.queue.put_nowait(job)
+        self.jobs[job.id] = job
+        self._prune()
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.done]
+        for job_id in finished[:max(0, len(finished) - self.max_retained)]:
+            del self.jobs[job_id]
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            job.update(status="running", started_at=dt.datetime.now())
+            try:
+                await self.handler(job)
+                job.update(status="succeeded", stage=None, finished_at=dt.datetime.now())
+            except asyncio.CancelledError:
+                job.update(status="failed", error="Cancelled during shutdown", finished_at=dt.datetime.now())
+                raise
+            except Exception as e:
+                logger.error(f"Error in job {job.id}: {e}")
+                job.update(status="failed", error=str(e), finished_at=dt.datetime.now())
+            finally:
+                self.queue.task_done()
@@ -1,24 +1,40 @@
 import asyncio
 import logging
 from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Form
-from fastapi.responses import JSONResponse, StreamingResponse
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
+from pydantic import BaseModel, Field
 from typing import List, Optional, AsyncGenerator, Dict, Any
 import io
+import json
 import os
+import shutil
+import time
+import uuid
 import aiofiles  # For async file handling
+from contextlib import asynccontextmanager
 from prepare.load import Load
 from prepare.split import Split
 from prepare.embed import Embed
+from prepare.cache import EmbeddingCache
+from prepare.answer_cache import AnswerCache
+from prepare.context import ContextPacker
+from prepare.index import expiry_timestamp
+from prepare.cosmos import CosmosConnection
 from prepare.store import Store
-from prepare.retrieve import Retrieve
-from prepare.llm import LLM
-from langchain.schema import HumanMessage, AIMessage  # Import AIMessage
+from prepare.retrieve import Retrieve, CosmosBackend
+from prepare.llm import LLM, create_chat_model
+from prepare.ingest import Ingest
+from prepare.parse import ParserPool
+from prepare.janitor import Janitor
+from prepare.metrics import REGISTRY, ASK_SECONDS, log_event
+from prepare.tokens import get_encoding
+from api.jobs import Job, JobQueue
+from api.timing import ServerTiming
 import datetime as dt 
 from fastapi import Query
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging; LOG_LEVEL=DEBUG adds one JSON line per retrieval, query and answer
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
 # Define the router
@@ -42,6 +58,16 @@ class DeleteDocumentRequest(BaseModel):
     passphrase: str
     filename: str
 
+# Questions a /ask/batch request may hold, and how many of its answers are generated at once
+ASK_BATCH_MAX_QUESTIONS = int(os.getenv("ASK_BATCH_MAX_QUESTIONS", 64))
+ASK_BATCH_CONCURRENCY = int(os.getenv("ASK_BATCH_CONCURRENCY", 4))
+
+class AskBatchRequest(BaseModel):
+    passphrase: str
+    questions: List[str] = Field(..., min_length=1, max_length=ASK_BATCH_MAX_QUESTIONS)
+    top_k: Optional[int] = Field(None, ge=1, le=50)
+    mmr_lambda: Optional[float] = Field(None, ge=0, le=1)
+
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -51,25 +77,191 @@ logger = logging.getLogger(__name__)
 async def ping():
     return "pong"
 
-# Initialize the processing classes
-loader = Load()
-splitter = Split()
-embedder = Embed()
-storage = Store()
-retriever = Retrieve()
-llm_answer = LLM(system_prompt=f"""
+@router.get('/ready')
+async def ready():
+    """
+    Report whether the service can reach its dependencies, unlike /ping which only shows it is up.
+
+    :return: 200 when start-up pre-warming is done and the Cosmos container is reachable, 503 otherwise.
+    """
+    if prewarm_task is None or not prewarm_task.done():
+        return JSONResponse(status_code=503, content={"status": "warming up"})
+    if prewarm_task.cancelled() or prewarm_task.exception() is not None or not await cosmos.ready():
+        return JSONResponse(status_code=503, content={"status": "unavailable"})
+    return JSONResponse(status_code=200, content={"status": "ready"})
+
+@router.get('/metrics')
+async def metrics():
+    """
+    Stage latencies, Cosmos request units, token counts and cache hits of this worker process.
+
+    :return: The metrics in the Prometheus text exposition format.
+    """
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+ANSWER_PROMPT = """
             You are an AI assistant designed to answer questions based on the provided context and nothing else. 
             Your task is to understand the user's question and generate a relevant, accurate, and helpful response using the following context and nothing else. 
             If the provided context doesn't contain enough information to answer the question fully, make sure to inform the user. 
             Maintain a friendly and helpful tone. 
             """
-        )
-
-llm_sorry = LLM(system_prompt=f"""
+SORRY_PROMPT = """
             You are an AI assistant that informs the user that no relevant information was found, and suggest them rephrase the question. 
             Maintain a friendly and helpful tone. Do not use introductions like "sure!" or "Definitely"" or any other type of polite introduction to your answer.
             """
-            )
+
+UPLOAD_SPOOL_CHUNK_BYTES = 1 << 20
+# Chunks retrieved for an answer unless the request asks for another number
+ASK_TOP_K = 5
+
+# Read from the services' own stats when /metrics is scraped
+REGISTRY.callback(
+    "rag_answer_cache_lookups_total", "counter", "Answer cache lookups by result", ("result",),
+    lambda: {("hit",): answer_cache.stats["hits"], ("miss",): answer_cache.stats["misses"]} if answer_cache is not None else {}
+)
+REGISTRY.callback(
+    "rag_embedding_cache_lookups_total", "counter", "Embedding cache lookups by result", ("result",),
+    lambda: {
+        ("memory_hit",): embedder.cache.stats["memory_hits"],
+        ("disk_hit",): embedder.cache.stats["disk_hits"],
+        ("miss",): embedder.cache.stats["misses"],
+    } if embedder is not None and embedder.cache is not None else {}
+)
+REGISTRY.callback(
+    "rag_janitor_items_removed_total", "counter", "Expired items deleted by the janitor", (),
+    lambda: {(): janitor.stats["items_removed"]} if janitor is not None else {}
+)
+REGISTRY.callback(
+    "rag_ingest_jobs_queued", "gauge", "Upload jobs waiting for a worker", (),
+    lambda: {(): job_queue.queue.qsize()} if job_queue is not None else {}
+)
+
+
+def observe_timing(timing: ServerTiming):
+    """Add a finished /ask request's stage durations to ASK_SECONDS."""
+    for name, milliseconds in timing.durations.items():
+        ASK_SECONDS.observe(milliseconds / 1000, stage=name)
+    log_event(logger, "ask", **{name: round(milliseconds, 1) for name, milliseconds in timing.durations.items()})
+
+# Services, created in lifespan around one shared Cosmos connection; importing this
+# module builds nothing, so a new replica starts listening quickly
+loader: Optional[Load] = None
+splitter: Optional[Split] = None
+embedder: Optional[Embed] = None
+answer_cache: Optional[AnswerCache] = None
+context_packer: Optional[ContextPacker] = None
+cosmos: Optional[CosmosConnection] = None
+storage: Optional[Store] = None
+retriever: Optional[Retrieve] = None
+parser: Optional[ParserPool] = None
+ingest: Optional[Ingest] = None
+job_queue: Optional[JobQueue] = None
+janitor: Optional[Janitor] = None
+# Created by prewarm
+llm_answer: Optional[LLM] = None
+llm_sorry: Optional[LLM] = None
+prewarm_task: Optional[asyncio.Task] = None
+
+
+async def prewarm():
+    """
+    Create the chat models and open connections to Cosmos and both OpenAI endpoints.
+
+    Runs after the server starts listening, while /ready reports 503, so that neither
+    the imports nor the first connections are paid for by a request or hold up startup.
+    """
+    start = time.perf_counter()
+
+    async def warm_chat():
+        global llm_answer, llm_sorry
+        # Importing langchain_openai is CPU-bound and takes about a second
+        chat_model = await asyncio.to_thread(create_chat_model)
+        # Both prompts share one chat model and its connection pool
+        llm_answer = LLM(system_prompt=ANSWER_PROMPT, llm=chat_model)
+        llm_sorry = LLM(system_prompt=SORRY_PROMPT, llm=chat_model)
+        await llm_answer.warm_up()
+
+    try:
+        await asyncio.gather(warm_chat(), embedder.warm_up(), cosmos.ready(), asyncio.to_thread(get_encoding))
+    except Exception as e:
+        logger.error(f"Prewarm failed: {e}")
+        raise
+    logger.info(f"Prewarmed in {time.perf_counter() - start:.2f}s")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """
+    Build the services around the shared Cosmos connection, start the upload workers and pre-warming.
+
+    A connection set on app.state.cosmos_connection beforehand is used instead of one
+    configured from the environment.
+    """
+    global loader, splitter, embedder, answer_cache, context_packer
+    global cosmos, storage, retriever, parser, ingest, job_queue, janitor, prewarm_task
+    loader = Load()
+    splitter = Split()
+    embedder = Embed(
+        cache=EmbeddingCache(
+            path=os.getenv("EMBEDDING_CACHE_PATH", "/tmp/embedding_cache.sqlite3"),
+            max_disk_bytes=int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", 1 << 30))
+        )
+    )
+    answer_cache = AnswerCache(
+        max_distance=float(os.getenv("ANSWER_CACHE_MAX_DISTANCE", 0.05)),
+        max_entries=int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 2048)),
+        ttl_seconds=float(os.getenv("ANSWER_CACHE_TTL_SECONDS", 3600))
+    )
+    context_packer = ContextPacker(
+        max_tokens=int(os.getenv("CONTEXT_MAX_TOKENS", 3000)),
+        duplicate_threshold=float(os.getenv("CONTEXT_DUPLICATE_THRESHOLD", 0.8))
+    )
+    cosmos = getattr(app.state, "cosmos_connection", None) or CosmosConnection.from_env()
+    await cosmos.open()
+    storage = Store(
+        cosmos.container,
+        cosmos.bulk_container,
+        catalog_cache_seconds=float(os.getenv("CATALOG_CACHE_SECONDS", 5)),
+        embedding_encoding=os.getenv("EMBEDDING_ENCODING", "float32")
+    )
+    retriever = Retrieve(cosmos.container)
+    if storage.embedding_encoding != "float32" and isinstance(retriever.backend, CosmosBackend):
+        # VectorDistance only reads float arrays
+        raise ValueError(f"EMBEDDING_ENCODING={storage.embedding_encoding} needs RETRIEVAL_BACKEND ivf or exact")
+    storage.add_observer(retriever.backend)
+    if retriever.keyword is not None:
+        storage.add_observer(retriever.keyword)
+    storage.add_observer(answer_cache)
+    # PARSER_WORKERS=0 parses in threads of the API process instead
+    parser_workers = int(os.getenv("PARSER_WORKERS", os.cpu_count() or 1))
+    parser = ParserPool(
+        loader,
+        workers=parser_workers,
+        timeout=float(os.getenv("PARSER_TIMEOUT_SECONDS", 300)),
+        max_memory_bytes=int(os.getenv("PARSER_MAX_MEMORY_MB", 2048)) << 20
+    ) if parser_workers > 0 else None
+    ingest = Ingest(loader=loader, splitter=splitter, embedder=embedder, storage=storage, parser=parser)
+    job_queue = JobQueue(
+        handler=ingest.run,
+        workers=int(os.getenv("INGEST_WORKERS", 2)),
+        max_pending=int(os.getenv("INGEST_MAX_PENDING_JOBS", 16))
+    )
+    await job_queue.start()
+    janitor = Janitor(storage, interval_seconds=float(os.getenv("JANITOR_INTERVAL_SECONDS", 300)))
+    # JANITOR_INTERVAL_SECONDS=0 leaves expiry to Cosmos ttl and POST /sanitize
+    if janitor.interval_seconds > 0:
+        await janitor.start()
+    prewarm_task = asyncio.create_task(prewarm())
+    try:
+        yield
+    finally:
+        prewarm_task.cancel()
+        await asyncio.gather(prewarm_task, return_exceptions=True)
+        await janitor.stop()
+        await job_queue.stop()
+        if parser is not None:
+            await parser.stop()
+        await cosmos.close()
 
 @router.get('/get-documents')
 async def get_documents(
@@ -82,8 +274,7 @@ async def get_documents(
     :return: JSONResponse containing the list of documents or an error message.
     """
     try:
-        storage.delete_documents_older_than(current_time=dt.datetime.now(), passphrase=passphrase)
-        documents = storage.get_documents(passphrase)
+        documents = await storage.get_documents(passphrase)
         if documents:
             return JSONResponse(status_code=200, content={"documents": documents})
         else:
@@ -103,7 +294,7 @@ async def delete_document(
     :return: JSONResponse indicating the success or failure of the operation.
     """
     try:
-        storage.delete_document(passphrase=request.passphrase, filename=request.filename)
+        await storage.delete_document(passphrase=request.passphrase, filename=request.filename)
         return JSONResponse(status_code=200, content={"message": "Document deleted successfully."})
     except Exception as e:
         logger.error(f"Error during document deletion: {e}")
@@ -113,155 +304,340 @@ async def delete_document(
 @router.post('/sanitize')
 async def sanitize_documents():
     """
-    Sanitize documents older than a specified date.
+    Delete expired documents now instead of waiting for the janitor's next run.
 
-    :return: JSONResponse indicating the success or failure of the operation.
+    :return: JSONResponse with the number of items removed and the request units spent.
     """
     try:
-        # Assuming the keep_until date is passed in the request body
-        storage.delete_documents_older_than(current_time=dt.datetime.now(), passphrase=None)
-        return JSONResponse(status_code=200, content={"message": "Documents sanitized successfully."})
+        report = await janitor.run_once()
+        return JSONResponse(status_code=200, content={
+            "message": "Documents sanitized successfully.",
+            "items_removed": report["items"],
+            "request_charge": report["request_charge"],
+        })
     except Exception as e:
         logger.error(f"Error during sanitization: {e}")
         return JSONResponse(status_code=500, content={"message": "Failed to sanitize documents."})
 
 
+def sse_event(event: str, data: str) -> bytes:
+    """A named server-sent event; clients that only read unnamed data events skip it."""
+    return f"event: {event}\ndata: {data}\n\n".encode('utf-8')
+
+
+def source(item: Dict[str, Any]) -> Dict[str, Any]:
+    """What the sources event tells about a retrieved chunk."""
+    fields = ('document_name', 'page', 'similarity_score', 'keyword_score', 'rrf_score')
+    return {field: item[field] for field in fields if field in item}
+
+
 @router.get('/ask')  # Keep this as GET
 async def ask_question(
     question: str, 
-    passphrase: str = Query(...)
+    passphrase: str = Query(...),
+    top_k: Optional[int] = Query(None, ge=1, le=50),
+    mmr_lambda: Optional[float] = Query(None, ge=0, le=1)
 ):
     """
     Handle incoming questions and provide streaming responses.
 
+    Keyword retrieval starts while the question is being embedded, and the stream
+    starts once the answer cache has been checked. A "retrieving" event comes first,
+    then a "sources" event as soon as the context is packed and a "context" event with
+    the packing report, then the answer as unnamed data events and a final "timing" event. The Server-Timing header holds the stages
+    done before the response started; the timing event has all of them.
+
     :param question: The user's question.
-    :param history: A JSON string of previous messages in the conversation.
+    :param passphrase: Passphrase the documents were uploaded under.
+    :param top_k: Chunks to retrieve, 5 by default.
+    :param mmr_lambda: Relevance weight of the diversity re-ranking, MMR_LAMBDA by default;
+        1 turns it off. Answers to requests that set top_k or mmr_lambda are not cached.
     :return: Streaming response with AI-generated answers.
     """
+    timing = ServerTiming()
+    use_answer_cache = top_k is None and mmr_lambda is None
+    # Served from the embedding cache, or shared with an identical question in flight
+    question_embedding = asyncio.ensure_future(embedder.embed_query(question))
+    search_timings: Dict[str, float] = {}
+    retrieval = asyncio.create_task(
+        retriever.hybrid_search(passphrase, question, question_embedding, top_k=top_k or ASK_TOP_K,
+                                timings=search_timings, mmr_lambda=mmr_lambda)
+    )
+    # A retrieval that is cancelled or fails with the embedding is not waited for
+    retrieval.add_done_callback(lambda task: task.cancelled() or task.exception())
     try:
-        # Parse the history from JSON string to list of dictionaries
-        #chat_history = json.loads(history)
-
-        # Embed the question asynchronously if possible
-        question_embedding = embedder.embed_documents([{"page_content": question, "metadata": {}}])[0]['embedding']
-        
-        # Retrieve similar content from the database
-        similar_content = retriever.vector_search(passphrase, question_embedding, top_k=5)
-
-        if similar_content:
-            # Convert history to LangChain message format
-            #chat_history = [
-            #    AIMessage(content=msg['content']) if msg['role'] == "assistant" else HumanMessage(content=msg['content'])
-            #    for msg in chat_history
-            #]
-            
-            # Update LLM's conversation history
-            #llm.conversation_history = chat_history
-            
-            # Define an async generator to stream responses
-            async def response_stream() -> AsyncGenerator[bytes, None]:
-                try:
-                    async for chunk in llm_answer.generate_response(
-                        question=question, 
-                        context=similar_content
-                        ):
-                        # Yield the data in the correct SSE format
-                        yield f"data: {chunk}\n\n".encode('utf-8')
-                except Exception as e:
-                    logger.error(f"Error during streaming: {e}")
-                    yield f"data: Error during streaming: {str(e)}\n\n".encode('utf-8')
-
-            # Return the streaming response to the client
-            return StreamingResponse(response_stream(), media_type="text/event-stream")
-
-        else:
-            # If no similar content is found, tell the LLM to inform the user
-            #llm.conversation_history = [HumanMessage(content="I'm sorry. I did not find any relevant context in the supplied documents.")]
-            async def response_stream() -> AsyncGenerator[bytes, None]:
-                try:
-                    async for chunk in llm_sorry.generate_response(question="Kindly ask me to rephrase my question", context=[]):
-                        # Yield the data in the correct SSE format
-                        yield f"data: {chunk}\n\n".encode('utf-8')
-                except Exception as e:
-                    logger.error(f"Error during streaming: {e}")
-                    yield f"data: Error during streaming: {str(e)}\n\n".encode('utf-8')
-
-            # Return the streaming response to the client
-            return StreamingResponse(response_stream(), media_type="text/event-stream")
-
+        # A request that arrives before the replica is ready waits for the chat models
+        await asyncio.shield(prewarm_task)
+        with timing.stage("embed"):
+            embedding = await question_embedding
+
+        # Replay the answer to a near-identical earlier question while the documents are unchanged
+        passphrase_hash = retriever._hash_passphrase(passphrase)
+        with timing.stage("answer-cache"):
+            cached_answer = answer_cache.get(passphrase_hash, embedding) if use_answer_cache else None
+        if cached_answer is not None:
+            retrieval.cancel()
+            log_event(logger, "answer_cache_hit", hit_rate=round(answer_cache.hit_rate(), 3))
+
+            async def replay_stream() -> AsyncGenerator[bytes, None]:
+                for chunk in cached_answer:
+                    yield f"data: {chunk}\n\n".encode('utf-8')
+                timing.since_start("total")
+                observe_timing(timing)
+
+            return StreamingResponse(replay_stream(), media_type="text/event-stream",
+                                     headers={"X-Answer-Cache": "hit", "Server-Timing": timing.header()})
     except Exception as e:
+        retrieval.cancel()
         logger.error(f"Error processing question: {e}")
         raise HTTPException(status_code=500, detail=f"Error processing question: {str(e)}")
 
+    async def response_stream() -> AsyncGenerator[bytes, None]:
+        try:
+            yield sse_event("retrieving", "{}")
+            with timing.stage("retrieve"):
+                similar_content = await retrieval
+            for name, seconds in search_timings.items():
+                timing.record(name, seconds)
+            # Drop near-duplicates, merge overlapping chunks and fit the token budget
+            with timing.stage("pack"):
+                context, packing = await asyncio.to_thread(context_packer.pack, similar_content)
+            log_event(logger, "pack", **packing)
+            yield sse_event("sources", json.dumps([source(item) for item in context]))
+            yield sse_event("context", json.dumps(packing))
+
+            if context:
+                answer = llm_answer.generate_response(question=question, context=context)
+            else:
+                # Without relevant context, the LLM asks the user to rephrase
+                answer = llm_sorry.generate_response(question="Kindly ask me to rephrase my question", context=[])
+            chunks = []
+            with timing.stage("generate"):
+                async for chunk in answer:
+                    if not chunks:
+                        timing.since_start("first-token")
+                    chunks.append(chunk)
+                    # Yield the data in the correct SSE format
+                    yield f"data: {chunk}\n\n".encode('utf-8')
+            if context and use_answer_cache:
+                # Only complete answers are cached, and only as long as their sources live
+                answer_cache.put(
+                    passphrase_hash, embedding, chunks,
+                    expires_at=min(expiry_timestamp(item['keep_until']) for item in context)
+                )
+            timing.since_start("total")
+            observe_timing(timing)
+            yield sse_event("timing", timing.header())
+        except Exception as e:
+            logger.error(f"Error during streaming: {e}")
+            yield f"data: Error during streaming: {str(e)}\n\n".encode('utf-8')
+        finally:
+            # The client may leave before retrieval is done
+            retrieval.cancel()
+
+    return StreamingResponse(response_stream(), media_type="text/event-stream",
+                             headers={"Server-Timing": timing.header()})
+
+
+@router.post('/ask/batch')
+async def ask_batch(
+    request: AskBatchRequest
+):
+    """
+    Answer several questions about one passphrase's documents in one stream.
+
+    The questions are embedded in one batched request and retrieved for in one pass,
+    then answered at most ASK_BATCH_CONCURRENCY at a time. Answers from the answer
+    cache come first. Every event but the first "retrieving" and the last "timing"
+    carries the index of its question in questions: "sources" and "context" as in
+    /ask, "token" with each piece of an answer as text, then "done", or "error" with
+    a message when the answer failed.
+
+    :param request: The request body with the passphrase, the questions, and optionally
+        top_k and mmr_lambda as in /ask.
+    :return: Streaming response with the multiplexed answers.
+    """
+    questions = request.questions
+    timing = ServerTiming()
+    use_answer_cache = request.top_k is None and request.mmr_lambda is None
+    try:
+        await asyncio.shield(prewarm_task)
+        with timing.stage("embed"):
+            embeddings = await embedder.embed_texts(questions)
+        passphrase_hash = retriever._hash_passphrase(request.passphrase)
+        with timing.stage("answer-cache"):
+            cached_answers = [
+                answer_cache.get(passphrase_hash, embedding) if use_answer_cache else None
+                for embedding in embeddings
+            ]
+    except Exception as e:
+        logger.error(f"Error processing questions: {e}")
+        raise HTTPException(status_code=500, detail=f"Error processing questions: {str(e)}")
+    pending = [index for index, cached_answer in enumerate(cached_answers) if cached_answer is None]
+
+    async def answer(index: int, similar_content: List[Dict[str, Any]], events: asyncio.Queue, semaphore: asyncio.Semaphore):
+        try:
+            context, packing = await asyncio.to_thread(context_packer.pack, similar_content)
+            await events.put(sse_event("sources", json.dumps({"index": index, "sources": [source(item) for item in context]})))
+            await events.put(sse_event("context", json.dumps({"index": index, **packing})))
+            chunks = []
+            async with semaphore:
+                if context:
+                    answer = llm_answer.generate_response(question=questions[index], context=context)
+                else:
+                    answer = llm_sorry.generate_response(question="Kindly ask me to rephrase my question", context=[])
+                async for chunk in answer:
+                    chunks.append(chunk)
+                    await events.put(sse_event("token", json.dumps({"index": index, "text": chunk})))
+            if context and use_answer_cache:
+                answer_cache.put(
+                    passphrase_hash, embeddings[index], chunks,
+                    expires_at=min(expiry_timestamp(item['keep_until']) for item in context)
+                )
+            await events.put(sse_event("done", json.dumps({"index": index})))
+        except Exception as e:
+            logger.error(f"Error answering question {index}: {e}")
+            await events.put(sse_event("error", json.dumps({"index": index, "message": str(e)})))
+
+    async def response_stream() -> AsyncGenerator[bytes, None]:
+        tasks = []
+        try:
+            for index, cached_answer in enumerate(cached_answers):
+                if cached_answer is not None:
+                    for chunk in cached_answer:
+                        yield sse_event("token", json.dumps({"index": index, "text": chunk}))
+                    yield sse_event("done", json.dumps({"index": index, "cached": True}))
+            if pending:
+                yield sse_event("retrieving", json.dumps({"questions": len(pending)}))
+                search_timings: Dict[str, float] = {}
+                with timing.stage("retrieve"):
+                    results = await retriever.hybrid_search_many(
+                        request.passphrase, [questions[index] for index in pending], [embeddings[index] for index in pending],
+                        top_k=request.top_k or ASK_TOP_K, timings=search_timings, mmr_lambda=request.mmr_lambda
+                    )
+                for name, seconds in search_timings.items():
+                    timing.record(name, seconds)
+
+                # Bounded, so answers wait for a slow client instead of piling up
+                events: asyncio.Queue = asyncio.Queue(maxsize=256)
+                semaphore = asyncio.Semaphore(ASK_BATCH_CONCURRENCY)
+                answers = [asyncio.create_task(answer(index, similar_content, events, semaphore))
+                           for index, similar_content in zip(pending, results)]
+
+                async def close():
+                    await asyncio.gather(*answers)
+                    await events.put(None)
+
+                tasks = answers + [asyncio.create_task(close())]
+                with timing.stage("generate"):
+                    while (event := await events.get()) is not None:
+                        yield event
+            timing.since_start("total")
+            log_event(logger, "ask_batch", questions=len(questions), cached=len(questions) - len(pending),
+                      **{name: round(milliseconds, 1) for name, milliseconds in timing.durations.items()})
+            yield sse_event("timing", timing.header())
+        except Exception as e:
+            logger.error(f"Error during streaming: {e}")
+            yield sse_event("error", json.dumps({"message": str(e)}))
+        finally:
+            # The client may leave before every answer is done
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(response_stream(), media_type="text/event-stream",
+                             headers={"Server-Timing": timing.header()})
+
 
 
 # Document upload endpoint
-@router.post('/upload')
+@router.post('/upload', status_code=202)
 async def upload_documents(
     files: List[UploadFile] = File(...),
     passphrase: str = Query(...),
     expiration: float = Query(...)
     ):
+    """
+    Accept documents for processing and return a job id right away.
+
+    The files are spooled to disk and processed in the background; progress is
+    reported by /jobs/{job_id} and /jobs/{job_id}/progress.
+    """
+    if job_queue.queue.full():
+        raise HTTPException(status_code=503, detail="Too many uploads in progress, try again later.",
+                            headers={"Retry-After": "30"})
+
     expiration_time = dt.datetime.now()+dt.timedelta(hours=expiration)
-    logger.info("Processing uploaded documents")
-    processed_files = []
-    all_embedded_chunks = []
+    upload_directory = f"/tmp/{uuid.uuid4().hex}"
+    os.makedirs(upload_directory)
+    spooled_files = []
     try:
         for file in files:
-            try:
-                contents = await file.read()
-                file_path = f"/tmp/{file.filename}"
-
-                # Save the file temporarily using aiofiles for async file I/O
-                async with aiofiles.open(file_path, "wb") as temp_file:
+            file_path = os.path.join(upload_directory, os.path.basename(file.filename))
+            # Spool the file to disk piece by piece so large uploads are never held in memory
+            async with aiofiles.open(file_path, "wb") as temp_file:
+                while contents := await file.read(UPLOAD_SPOOL_CHUNK_BYTES):
                     await temp_file.write(contents)
-
-                # Load the document
-                documents = loader.load_document(file_path)
-
-                for document in documents: 
-                    document.page_content = document.page_content.replace('\n', ' ')
-
-                # Split the document
-                chunks = splitter.split_documents(documents)
-
-                # Embed the chunks
-                embedded_chunks = embedder.embed_documents(chunks)
-
-                all_embedded_chunks.extend(embedded_chunks)
-                processed_files.append(file.filename)
-
-                # Remove the temporary file safely
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-
-                logger.info(f"Processed document: {file.filename}")
-            except Exception as file_error:
-                logger.error(f"Error processing file {file.filename}: {file_error}")
-                raise HTTPException(status_code=400, detail=f"Error processing file {file.filename}: {str(file_error)}")
-
-        # Store all embedded chunks with a passphrase
-        storage.store_embeddings(
-            passphrase=passphrase, 
-            documents=all_embedded_chunks, 
-            keep_until=expiration_time
-            )
-
-        return JSONResponse(
-            status_code=200,
-            content={
-                "status": "success",
-                "message": "Documents processed and stored successfully",
-                "data": {
-                    "processed_files": processed_files,
-                    "total_chunks": len(all_embedded_chunks)
-                }
-            }
-        )
+            spooled_files.append({"filename": file.filename, "path": file_path})
+
+        job = Job(passphrase=passphrase, files=spooled_files, keep_until=expiration_time)
+        job_queue.submit(job)
+    except asyncio.QueueFull:
+        shutil.rmtree(upload_directory, ignore_errors=True)
+        raise HTTPException(status_code=503, detail="Too many uploads in progress, try again later.",
+                            headers={"Retry-After": "30"})
     except Exception as e:
+        shutil.rmtree(upload_directory, ignore_errors=True)
         logger.error(f"Error in upload process: {e}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
+    logger.info(f"Queued upload job {job.id} with {len(spooled_files)} files")
+    return JSONResponse(
+        status_code=202,
+        content={
+            "status": "accepted",
+            "message": "Documents queued for processing",
+            "data": job.to_dict()
+        }
+    )
+
+
+@router.get('/jobs/{job_id}')
+async def get_job(job_id: str):
+    """
+    Report the status of an upload job.
+
+    :param job_id: Id returned by /upload.
+    :return: JSONResponse with status, current stage and chunk counts.
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return JSONResponse(status_code=200, content=job.to_dict())
+
+
+@router.get('/jobs/{job_id}/progress')
+async def get_job_progress(job_id: str):
+    """
+    Stream the progress of an upload job as server-sent events until it finishes.
+
+    :param job_id: Id returned by /upload.
+    :return: Streaming response with one event per progress update.
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+
+    async def progress_stream() -> AsyncGenerator[bytes, None]:
+        while True:
+            # Take the event before reporting so no update in between is missed
+            changed = job.changed
+            yield f"data: {json.dumps(job.to_dict())}\n\n".encode('utf-8')
+            if job.done:
+                return
+            await changed.wait()
+
+    return StreamingResponse(progress_stream(), media_type="text/event-stream")
+
 
 # List documents endpoint
 @router.get('/documents')
@@ -0,0 +1,36 @@
+from contextlib import contextmanager
+from typing import Dict, Optional, Iterable
+import time
+
+
+class ServerTiming:
+    """
+    Durations of a request's stages, formatted as a Server-Timing header value.
+
+    Stages are recorded in the order they finish. The header can only hold the stages
+    done before the response starts, so streaming responses also send the full value
+    in their last event.
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, seconds: float):
+        self.durations[name] = seconds * 1000
+
+    def since_start(self, name: str):
+        """Record the time from the start of the request until now as a stage."""
+        self.record(name, time.perf_counter() - self.started)
+
+    def header(self, names: Optional[Iterable[str]] = None) -> str:
+        """:return: "embed;dur=12.3, retrieve;dur=40.1" for the given stages, or all of them"""
+        names = self.durations if names is None else [name for name in names if name in self.durations]
+        return ", ".join(f"{name};dur={self.durations[name]:.1f}" for name in names)
@@ -3,7 +3,7 @@ import logging
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from config import get_config
-from api.routes import router
+from api.routes import router, lifespan
 from dotenv import load_dotenv, find_dotenv
 
 # Setting up logging
@@ -21,7 +21,7 @@ docs = os.getenv("DOCS", "true")  # Default to true
 selected_config = get_config(env_node)
 
 # Initialize FastAPI app
-app = FastAPI(docs_url=None if docs!="true" else "/docs")
+app = FastAPI(docs_url=None if docs!="true" else "/docs", lifespan=lifespan)
 
 # Configure CORS
 # Define CORS origins based on the environment
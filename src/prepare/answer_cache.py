@@ -0,0 +1,108 @@
+from collections import OrderedDict
+from typing import List, Optional, Dict, Any, Tuple
+import itertools
+import threading
+import time
+import numpy as np
+
+
+class AnswerCache:
+    """
+    Semantic cache of streamed answers, scoped per passphrase.
+
+    A question hits when its embedding is within max_distance (cosine distance) of a
+    question answered before under the same passphrase. Entries expire after
+    ttl_seconds or when the earliest keep_until of the chunks the answer was based on
+    passes, whichever comes first. A passphrase's entries are dropped whenever its
+    documents change, so register the cache as a Store observer. The least recently
+    used entries are evicted beyond max_entries.
+    """
+    def __init__(self, max_distance: float = 0.05, max_entries: int = 2048, ttl_seconds: float = 3600):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries: "OrderedDict[Tuple[str, int], Dict[str, Any]]" = OrderedDict()
+        # passphrase_hash -> (entry keys, matrix of their question vectors), rebuilt on change
+        self.matrices: Dict[str, Tuple[List[Tuple[str, int]], np.ndarray]] = {}
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, passphrase_hash: str, question_vector: List[float]) -> Optional[List[str]]:
+        """
+        :return: The streamed chunks of a cached answer to a close enough question, or None
+        """
+        query = self._normalize(question_vector)
+        now = time.time()
+        with self.lock:
+            keys, matrix = self._matrix(passphrase_hash)
+            if keys:
+                scores = matrix @ query
+                for row in np.argsort(-scores):
+                    if 1.0 - scores[row] > self.max_distance:
+                        break
+                    entry = self.entries[keys[row]]
+                    if entry['expires_at'] > now:
+                        self.entries.move_to_end(keys[row])
+                        self.stats["hits"] += 1
+                        return entry['chunks']
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, passphrase_hash: str, question_vector: List[float], chunks: List[str], expires_at: Optional[float] = None):
+        """
+        Cache a complete answer.
+
+        :param chunks: The answer as streamed, replayed chunk by chunk on a hit
+        :param expires_at: Epoch seconds after which the answer's sources expire
+        """
+        if self.max_entries <= 0:
+            return
+        expiry = time.time() + self.ttl_seconds
+        if expires_at is not None:
+            expiry = min(expiry, expires_at)
+        with self.lock:
+            key = (passphrase_hash, next(self.ids))
+            self.entries[key] = {'vector': self._normalize(question_vector), 'chunks': chunks, 'expires_at': expiry}
+            self.matrices.pop(passphrase_hash, None)
+            self.stats["stores"] += 1
+            while len(self.entries) > self.max_entries:
+                (evicted_hash, _), _ = self.entries.popitem(last=False)
+                self.matrices.pop(evicted_hash, None)
+                self.stats["evictions"] += 1
+
+    def invalidate(self, passphrase_hash: str):
+        """Drop every answer cached for a passphrase."""
+        with self.lock:
+            keys = [key for key in self.entries if key[0] == passphrase_hash]
+            for key in keys:
+                del self.entries[key]
+            self.matrices.pop(passphrase_hash, None)
+            if keys:
+                self.stats["invalidations"] += 1
+
+    def on_store(self, passphrase_hash: str, items: List[Dict[str, Any]]):
+        self.invalidate(passphrase_hash)
+
+    def on_extend(self, passphrase_hash: str, items: List[Dict[str, Any]]):
+        # Cached answers expire with their chunks' old keep_until
+        self.invalidate(passphrase_hash)
+
+    def on_delete(self, passphrase_hash: str, ids: Optional[List[str]]):
+        self.invalidate(passphrase_hash)
+
+    def hit_rate(self) -> float:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.0
+
+    def _matrix(self, passphrase_hash: str):
+        if passphrase_hash not in self.matrices:
+            keys = [key for key in self.entries if key[0] == passphrase_hash]
+            matrix = np.stack([self.entries[key]['vector'] for key in keys]) if keys else None
+            self.matrices[passphrase_hash] = (keys, matrix)
+        return self.matrices[passphrase_hash]
+
+    @staticmethod
+    def _normalize(vector: List[float]) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
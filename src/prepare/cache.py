@@ -0,0 +1,167 @@
+from collections import OrderedDict
+from typing import List, Optional, Dict
+import hashlib
+import sqlite3
+import threading
+import time
+import numpy as np
+
+
+class EmbeddingCache:
+    """
+    Content-addressed embedding cache with an in-process LRU tier in front of SQLite.
+
+    Entries are keyed by (deployment, hash of the whitespace-normalized text), so the
+    same chunk uploaded under another passphrase or file name is only embedded once.
+    Vectors are stored as float32 bytes. The on-disk tier is trimmed oldest-access-first
+    once it grows past max_disk_bytes.
+    """
+    def __init__(self, path: str, max_memory_items: int = 2048, max_disk_bytes: int = 1 << 30):
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                deployment TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_access REAL NOT NULL
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_deployment ON embeddings (deployment)")
+        self.connection.commit()
+        self.disk_bytes = self.connection.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()[0]
+
+    @staticmethod
+    def key(deployment: str, text: str) -> str:
+        normalized = " ".join(text.split())
+        return deployment + ":" + hashlib.sha256(normalized.encode()).hexdigest()
+
+    def get_many(self, deployment: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        Look up cached embeddings.
+
+        :param deployment: Embedding deployment the vectors must come from
+        :param texts: Texts to look up
+        :return: One embedding per text, or None where the cache has no entry
+        """
+        keys = [self.key(deployment, text) for text in texts]
+        results: List[Optional[np.ndarray]] = [None] * len(keys)
+        with self.lock:
+            missing: Dict[str, List[int]] = {}
+            for i, key in enumerate(keys):
+                vector = self.memory.get(key)
+                if vector is not None:
+                    self.memory.move_to_end(key)
+                    results[i] = vector
+                    self.stats["memory_hits"] += 1
+                else:
+                    missing.setdefault(key, []).append(i)
+
+            if missing:
+                found = self._read_disk(list(missing))
+                for key, vector in found.items():
+                    self._remember(key, vector)
+                    for i in missing[key]:
+                        results[i] = vector
+                    self.stats["disk_hits"] += len(missing[key])
+                self.stats["misses"] += sum(len(missing[key]) for key in missing if key not in found)
+
+        return [vector.tolist() if vector is not None else None for vector in results]
+
+    def put_many(self, deployment: str, texts: List[str], embeddings: List[List[float]]):
+        """Store embeddings for texts in both tiers."""
+        now = time.time()
+        rows = []
+        with self.lock:
+            for text, embedding in zip(texts, embeddings):
+                key = self.key(deployment, text)
+                vector = np.asarray(embedding, dtype=np.float32)
+                self._remember(key, vector)
+                rows.append((key, deployment, vector.tobytes(), now))
+
+            # Replacing an existing key must not count its bytes twice
+            existing = self._read_disk([row[0] for row in rows], touch=False)
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, deployment, vector, last_access) VALUES (?, ?, ?, ?)", rows
+            )
+            self.disk_bytes += sum(len(row[2]) for row in rows) - sum(v.nbytes for v in existing.values())
+            self._evict()
+            self.connection.commit()
+
+    def invalidate(self, deployment: Optional[str] = None):
+        """
+        Drop cached vectors of one deployment, or everything when deployment is None.
+        Used when the embedding model changes and old vectors are no longer comparable.
+        """
+        with self.lock:
+            if deployment is None:
+                self.memory.clear()
+                self.connection.execute("DELETE FROM embeddings")
+            else:
+                prefix = deployment + ":"
+                for key in [key for key in self.memory if key.startswith(prefix)]:
+                    del self.memory[key]
+                self.connection.execute("DELETE FROM embeddings WHERE deployment = ?", (deployment,))
+            self.connection.commit()
+            self.disk_bytes = self.connection.execute(
+                "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+            ).fetchone()[0]
+
+    def hit_rate(self) -> float:
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def _read_disk(self, keys: List[str], touch: bool = True) -> Dict[str, np.ndarray]:
+        found = {}
+        # Stay well below SQLite's limit on bound parameters per statement
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            for key, blob in self.connection.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+            ):
+                found[key] = np.frombuffer(blob, dtype=np.float32)
+        if touch and found:
+            now = time.time()
+            self.connection.executemany(
+                "UPDATE embeddings SET last_access = ? WHERE key = ?", [(now, key) for key in found]
+            )
+            self.connection.commit()
+        return found
+
+    def _evict(self):
+        """Delete least recently used rows until the disk tier is back under 90% of its limit."""
+        if self.disk_bytes <= self.max_disk_bytes:
+            return
+        target = self.max_disk_bytes * 0.9
+        while self.disk_bytes > target:
+            rows = self.connection.execute(
+                "SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_access LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                self.disk_bytes = 0
+                break
+            freed_keys = []
+            for key, size in rows:
+                freed_keys.append((key,))
+                self.disk_bytes -= size
+                if self.disk_bytes <= target:
+                    break
+            self.connection.executemany("DELETE FROM embeddings WHERE key = ?", freed_keys)
+            self.stats["evictions"] += len(freed_keys)
@@ -0,0 +1,140 @@
+from prepare.tokens import count_tokens, truncate_tokens
+from typing import List, Dict, Any, Tuple
+import hashlib
+import re
+
+# Characters of a chunk's start looked up in its neighbour to find their overlap
+OVERLAP_ANCHOR_CHARS = 32
+# Most characters between neighbouring chunks, the whitespace the splitter strips at their edges
+MAX_GAP_CHARS = 8
+WORD = re.compile(r"\w+")
+
+
+def format_context(context: List[Dict[str, Any]]) -> str:
+    """The context as it is put into the prompt after the question."""
+    return "\n\n".join(f"Context: {ctx['content']}" for ctx in context)
+
+
+def shingles(text: str, size: int = 5) -> set:
+    """Hashes of the text's runs of size consecutive lowercased words."""
+    words = WORD.findall(text.lower())
+    if len(words) < size:
+        words = words + [""] * (size - len(words))
+    return {
+        hashlib.blake2b(" ".join(words[i:i + size]).encode(), digest_size=8).digest()
+        for i in range(len(words) - size + 1)
+    }
+
+
+def overlap(first: str, second: str) -> int:
+    """Length of the longest end of first that second starts with, counting only overlaps of a few words or more."""
+    anchor = second[:OVERLAP_ANCHOR_CHARS]
+    if len(anchor) < OVERLAP_ANCHOR_CHARS:
+        return 0
+    position = first.find(anchor)
+    while position != -1:
+        if second.startswith(first[position:]):
+            return len(first) - position
+        position = first.find(anchor, position + 1)
+    return 0
+
+
+class ContextPacker:
+    """
+    Turn ranked retrieval results into the context of a prompt.
+
+    Chunks that are near-duplicates of a more relevant one are dropped: their word
+    shingles are at least duplicate_threshold contained in it. Neighbouring chunks of
+    the same page are merged into one passage, by their start_index and end_index in
+    the page or, for chunks stored without offsets, when their text overlaps, so text
+    repeated by the splitter's chunk_overlap is sent once. Passages then fill
+    max_tokens by relevance; one that does not fit is skipped for a smaller one, and
+    the most relevant is cut to the budget rather than leaving the context empty.
+    """
+    def __init__(self, max_tokens: int = 3000, duplicate_threshold: float = 0.8, shingle_size: int = 5):
+        self.max_tokens = max_tokens
+        self.duplicate_threshold = duplicate_threshold
+        self.shingle_size = shingle_size
+
+    def pack(self, results: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+        """
+        :param results: Retrieved chunks with content, document_name, page and keep_until, most relevant first
+        :return: Passages in the same form, most relevant first (keep_until is the earliest of its
+            chunks'), and a report of chunk counts and of the prompt tokens the packing saved
+        """
+        report = {"chunks": len(results), "duplicates": 0, "merged": 0, "over_budget": 0}
+        kept, kept_shingles = [], []
+        for item in results:
+            item_shingles = shingles(item['content'], self.shingle_size)
+            if any(self._contained(item_shingles, other) for other in kept_shingles):
+                report["duplicates"] += 1
+                continue
+            kept.append(item)
+            kept_shingles.append(item_shingles)
+
+        passages: List[Dict[str, Any]] = []
+        for rank, item in enumerate(kept):
+            passage = {**item, 'rank': rank}
+            # A merged passage can now overlap another one of the page
+            while (merged := self._merge_into(passages, passage)) is not None:
+                passage = merged
+                report["merged"] += 1
+            passages.append(passage)
+        passages.sort(key=lambda passage: passage['rank'])
+
+        context, tokens = [], 0
+        separator_tokens = count_tokens("\n\n")
+        for passage in passages:
+            passage_tokens = count_tokens(format_context([passage])) + (separator_tokens if context else 0)
+            if tokens + passage_tokens <= self.max_tokens:
+                context.append(passage)
+                tokens += passage_tokens
+            elif not context and not report["over_budget"]:
+                content = truncate_tokens(passage['content'], self.max_tokens - count_tokens("Context: "))
+                context.append({**passage, 'content': content})
+                tokens = count_tokens(format_context(context))
+            else:
+                report["over_budget"] += 1
+        for passage in context:
+            passage.pop('rank', None)
+
+        report["passages"] = len(context)
+        report["prompt_tokens"] = tokens
+        plain_tokens = count_tokens(format_context(results)) if results else 0
+        report["prompt_tokens_saved"] = max(plain_tokens - tokens, 0)
+        return context, report
+
+    def _contained(self, item_shingles: set, other: set) -> bool:
+        return len(item_shingles & other) >= self.duplicate_threshold * len(item_shingles)
+
+    def _merge_into(self, passages: List[Dict[str, Any]], passage: Dict[str, Any]):
+        """Take the passage of the same page next to passage out of passages and return the two merged, or None."""
+        for index, other in enumerate(passages):
+            if (other['document_name'], other['page']) != (passage['document_name'], passage['page']):
+                continue
+            merged = self._join(other, passage) or self._join(passage, other)
+            if merged is None:
+                continue
+            del passages[index]
+            # Ranked, and scored, as its more relevant part
+            best = min(other, passage, key=lambda part: part['rank'])
+            return {**best, **merged, 'keep_until': min(other['keep_until'], passage['keep_until'])}
+        return None
+
+    @staticmethod
+    def _join(first: Dict[str, Any], second: Dict[str, Any]):
+        """Content and offsets of first followed by second, or None when second does not continue first."""
+        if None not in (first.get('start_index'), first.get('end_index'), second.get('start_index'), second.get('end_index')):
+            if not first['start_index'] <= second['start_index'] <= first['end_index'] + MAX_GAP_CHARS:
+                return None
+            if second['end_index'] <= first['end_index']:
+                content = first['content']
+            elif second['start_index'] < first['end_index']:
+                content = first['content'] + second['content'][first['end_index'] - second['start_index']:]
+            else:
+                content = first['content'] + "\n" + second['content']
+            return {'content': content, 'start_index': first['start_index'], 'end_index': max(first['end_index'], second['end_index'])}
+        length = overlap(first['content'], second['content'])
+        if not length:
+            return None
+        return {'content': first['content'] + second['content'][length:]}
@@ -0,0 +1,363 @@
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.cosmos import PartitionKey, documents as cosmos_documents
+from azure.cosmos.aio import CosmosClient
+from azure.cosmos.exceptions import CosmosHttpResponseError, CosmosBatchOperationError
+from prepare.metrics import COSMOS_REQUEST_UNITS
+from prepare.rate_limit import RequestUnitBudget
+from typing import List, Dict, Any, Optional, Callable
+import aiohttp
+import asyncio
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def request_charge(headers: Optional[Dict[str, Any]]) -> float:
+    """Request units billed for a call, from its x-ms-request-charge response header."""
+    if not headers:
+        return 0.0
+    return float(headers.get('x-ms-request-charge', 0) or 0)
+
+
+def charge_hook(operation: str) -> Callable[[Dict[str, Any], Any], None]:
+    """response_hook for point operations that counts their charge in COSMOS_REQUEST_UNITS."""
+    return lambda headers, _: COSMOS_REQUEST_UNITS.inc(request_charge(headers), operation=operation)
+
+
+def retry_after(headers: Optional[Dict[str, Any]], default: float = 1.0) -> float:
+    """Seconds the service asked us to wait after a 429, from x-ms-retry-after-ms."""
+    if headers and headers.get('x-ms-retry-after-ms'):
+        return float(headers['x-ms-retry-after-ms']) / 1000
+    return default
+
+
+class CosmosConnection:
+    """
+    The app's Cosmos clients, sharing one pooled aiohttp session.
+
+    container is for queries and point operations and keeps the SDK's throttle
+    retries. bulk_container has them disabled so BulkWriter sees every 429 and can
+    shrink its RU budget. Both clients send their requests through the same
+    connection pool.
+
+    With bootstrap, open() creates the database and container if they are missing;
+    otherwise it only builds the clients, so startup costs no extra round trips.
+    """
+    def __init__(
+        self,
+        endpoint: str,
+        key: str,
+        database_name: str,
+        container_name: str,
+        pool_size: int = 100,
+        bootstrap: bool = False
+    ):
+        self.endpoint = endpoint
+        self.key = key
+        self.database_name = database_name
+        self.container_name = container_name
+        self.pool_size = pool_size
+        self.bootstrap = bootstrap
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.clients: List[CosmosClient] = []
+        self.container = None
+        self.bulk_container = None
+
+    @classmethod
+    def from_env(cls) -> "CosmosConnection":
+        return cls(
+            endpoint=os.getenv("COSMOS_ENDPOINT"),
+            key=os.getenv("COSMOS_KEY"),
+            database_name=os.getenv("COSMOS_DATABASE_NAME"),
+            container_name=os.getenv("COSMOS_CONTAINER_NAME"),
+            pool_size=int(os.getenv("COSMOS_POOL_SIZE", 100)),
+            bootstrap=os.getenv("COSMOS_BOOTSTRAP", "false").lower() == "true",
+        )
+
+    async def open(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.pool_size, ttl_dns_cache=300, keepalive_timeout=60),
+            # azure-core decompresses responses itself
+            auto_decompress=False
+        )
+        client = self._client()
+        connection_policy = cosmos_documents.ConnectionPolicy()
+        connection_policy.RetryOptions = cosmos_documents.RetryOptions(max_retry_attempt_count=0)
+        bulk_client = self._client(connection_policy=connection_policy)
+
+        if self.bootstrap:
+            database = await client.create_database_if_not_exists(id=self.database_name)
+            self.container = await database.create_container_if_not_exists(
+                id=self.container_name,
+                partition_key=PartitionKey(path="/passphrase_hash"),
+                # Time to live on, without a default: items expire by their own ttl field
+                default_ttl=-1,
+                # Embeddings are only read back, never filtered on
+                indexing_policy={
+                    "indexingMode": "consistent",
+                    "includedPaths": [{"path": "/*"}],
+                    "excludedPaths": [
+                        {"path": "/embedding/*"},
+                        {"path": "/embedding_f16/?"},
+                        {"path": "/embedding_i8/?"},
+                        {"path": '/"_etag"/?'},
+                    ],
+                }
+            )
+        else:
+            self.container = client.get_database_client(self.database_name).get_container_client(self.container_name)
+        self.bulk_container = bulk_client.get_database_client(self.database_name).get_container_client(self.container_name)
+
+    async def close(self):
+        for client in self.clients:
+            await client.close()
+        self.clients = []
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def ready(self, timeout: float = 2.0) -> bool:
+        """Whether the container can be reached with the configured credentials within timeout seconds."""
+        if self.container is None:
+            return False
+        try:
+            await asyncio.wait_for(self.container.read(), timeout)
+            return True
+        except Exception as e:
+            logger.warning(f"Cosmos container is not reachable: {e}")
+            return False
+
+    def _client(self, **kwargs) -> CosmosClient:
+        transport = AioHttpTransport(session=self.session, session_owner=False)
+        client = CosmosClient(self.endpoint, self.key, transport=transport, **kwargs)
+        self.clients.append(client)
+        return client
+
+
+def parse_query_metrics(header: Optional[str]) -> Dict[str, float]:
+    """Parse x-ms-documentdb-query-metrics ("totalExecutionTimeInMs=1.2;retrievedDocumentCount=5;...")."""
+    metrics = {}
+    for pair in (header or "").split(';'):
+        name, _, value = pair.partition('=')
+        try:
+            metrics[name.strip()] = float(value)
+        except ValueError:
+            continue
+    return metrics
+
+
+class QueryMetrics:
+    """
+    response_hook for query_items that adds up what a query cost across its pages.
+
+    The SDK calls the hook once per page fetched while the results are iterated, with
+    that page's headers, and clears it before a query starts. Server time comes from
+    totalExecutionTimeInMs when the query ran with populate_query_metrics=True, or
+    from x-ms-request-duration-ms otherwise. Every page's charge is also counted in
+    COSMOS_REQUEST_UNITS under the query's operation name.
+    """
+    def __init__(self, operation: str = "query"):
+        self.operation = operation
+        self.clear()
+
+    def clear(self):
+        self.request_charge = 0.0
+        self.server_milliseconds = 0.0
+        self.pages = 0
+        self.retrieved_documents = 0
+        self.started = time.perf_counter()
+
+    def __call__(self, headers: Dict[str, Any], result):
+        # query_items also calls the hook with the lazy result pager and the headers of
+        # the previous request before anything was fetched
+        if not isinstance(result, dict):
+            return
+        self.pages += 1
+        charge = request_charge(headers)
+        self.request_charge += charge
+        COSMOS_REQUEST_UNITS.inc(charge, operation=self.operation)
+        metrics = parse_query_metrics(headers.get('x-ms-documentdb-query-metrics'))
+        if 'totalExecutionTimeInMs' in metrics:
+            self.server_milliseconds += metrics['totalExecutionTimeInMs']
+            self.retrieved_documents += int(metrics.get('retrievedDocumentCount', 0))
+        else:
+            self.server_milliseconds += float(headers.get('x-ms-request-duration-ms', 0) or 0)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "request_charge": self.request_charge,
+            "server_milliseconds": self.server_milliseconds,
+            "client_milliseconds": (time.perf_counter() - self.started) * 1000,
+            "pages": self.pages,
+            "retrieved_documents": self.retrieved_documents,
+        }
+
+
+class BulkWriter:
+    """
+    Write many items with transactional batches, several in flight at once.
+
+    Items are grouped by partition key and packed into batches under the service
+    limits (100 operations, 2 MB). Every batch reserves its estimated charge from a
+    shared RequestUnitBudget and settles it with the real x-ms-request-charge. 429s
+    are retried after the server's retry-after and shrink the budget.
+
+    The container's client should have its own throttle retries disabled, otherwise
+    the SDK absorbs 429s before the budget can react to them.
+    """
+    def __init__(
+        self,
+        container,
+        budget: Optional[RequestUnitBudget] = None,
+        partition_key: str = "passphrase_hash",
+        max_concurrency: int = 8,
+        max_batch_operations: int = 100,
+        max_batch_bytes: int = 1_800_000,
+        max_retries: int = 10
+    ):
+        self.container = container
+        self.budget = budget or RequestUnitBudget()
+        self.partition_key = partition_key
+        self.max_concurrency = max_concurrency
+        self.max_batch_operations = max_batch_operations
+        self.max_batch_bytes = max_batch_bytes
+        self.max_retries = max_retries
+
+    async def upsert_items(self, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Upsert items in transactional batches per partition key.
+
+        :param items: Items to upsert; each must carry the partition key field
+        :return: Report with item count, total request charge, 429 count and duration
+        """
+        return await self._write("upsert", items)
+
+    async def patch_items(self, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Set fields of existing items without sending the rest of them.
+
+        :param items: Dicts with id, the partition key field and the fields to set
+        :return: Report like upsert_items, where items that no longer existed count as missing
+            and their ids are listed in missing_ids
+        """
+        return await self._write("patch", items)
+
+    async def delete_items(self, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Delete items in transactional batches per partition key.
+
+        :param items: Dicts with id and the partition key field
+        :return: Report like upsert_items, where items that no longer existed count as missing
+        """
+        return await self._write("delete", items)
+
+    async def _write(self, kind: str, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+        report = {"items": len(items), "request_charge": 0.0, "throttled": 0, "missing": 0, "missing_ids": [], "seconds": 0.0}
+        start_time = time.perf_counter()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def write(partition_key_value, batch):
+            async with semaphore:
+                charge, throttled, missing = await self._execute_batch(kind, partition_key_value, batch)
+            report["request_charge"] += charge
+            report["throttled"] += throttled
+            report["items"] -= len(missing)
+            report["missing"] += len(missing)
+            report["missing_ids"] += [item["id"] for item in missing]
+
+        batches = list(self._batches(items))
+        if batches and f"batch_{kind}" not in self.budget.charge_estimates:
+            # Learn what a batch costs before sending several at once on a guess
+            await write(*batches.pop(0))
+        await asyncio.gather(*(write(partition_key_value, batch) for partition_key_value, batch in batches))
+        report["seconds"] = time.perf_counter() - start_time
+        return report
+
+    def _operation(self, kind: str, item: Dict[str, Any]):
+        if kind == "patch":
+            fields = [{"op": "set", "path": f"/{name}", "value": value}
+                      for name, value in item.items() if name not in ("id", self.partition_key)]
+            return ("patch", (item["id"], fields))
+        if kind == "delete":
+            return ("delete", (item["id"],))
+        return (kind, (item,))
+
+    def _batches(self, items: List[Dict[str, Any]]):
+        by_partition: Dict[str, List[Dict[str, Any]]] = {}
+        for item in items:
+            by_partition.setdefault(item[self.partition_key], []).append(item)
+
+        for partition_key_value, partition_items in by_partition.items():
+            batch, batch_bytes = [], 0
+            for item in partition_items:
+                item_bytes = self._estimate_bytes(item)
+                if batch and (len(batch) >= self.max_batch_operations or batch_bytes + item_bytes > self.max_batch_bytes):
+                    yield partition_key_value, batch
+                    batch, batch_bytes = [], 0
+                batch.append(item)
+                batch_bytes += item_bytes
+            if batch:
+                yield partition_key_value, batch
+
+    @staticmethod
+    def _estimate_bytes(item: Dict[str, Any]) -> int:
+        """
+        Upper bound of an item's JSON size without serializing it.
+
+        Serializing a 1536-float embedding just to measure it costs about as much CPU as
+        the SDK's own serialization, so vectors are counted at 25 bytes per float.
+        """
+        size = 0
+        for key, value in item.items():
+            if isinstance(value, list) and value and isinstance(value[0], float):
+                size += len(key) + 25 * len(value)
+            else:
+                size += len(key) + len(json.dumps(value))
+        return size
+
+    async def _execute_batch(self, kind: str, partition_key_value: str, batch: List[Dict[str, Any]]):
+        throttled = 0
+        missing = []
+        charged = 0.0
+        attempt = 0
+        while batch:
+            operations = [self._operation(kind, item) for item in batch]
+            reserved = await self.budget.acquire(self.budget.estimate(f"batch_{kind}", units=len(batch)))
+            response_headers = {}
+            try:
+                await self.container.execute_item_batch(
+                    operations,
+                    partition_key=partition_key_value,
+                    response_hook=lambda headers, _: response_headers.update(headers)
+                )
+            except (CosmosHttpResponseError, CosmosBatchOperationError) as e:
+                charge = request_charge(e.headers)
+                charged += charge
+                COSMOS_REQUEST_UNITS.inc(charge, operation=f"batch_{kind}")
+                self.budget.refund(reserved, charge)
+                if kind in ("delete", "patch") and e.status_code == 404 and isinstance(e, CosmosBatchOperationError):
+                    # Already gone, e.g. expired by TTL since it was queried; the batch
+                    # was rolled back, so retry it without that item
+                    missing.append(batch[e.error_index])
+                    batch = batch[:e.error_index] + batch[e.error_index + 1:]
+                    continue
+                if e.status_code != 429 or attempt == self.max_retries:
+                    raise
+                attempt += 1
+                # A throttled call is not a sample of what the batch costs
+                self.budget.throttled()
+                throttled += 1
+                wait = retry_after(e.headers)
+                logger.info(f"Cosmos throttled a batch of {len(batch)} items, retrying in {wait:.2f}s")
+                await asyncio.sleep(wait)
+                continue
+
+            charge = request_charge(response_headers)
+            charged += charge
+            COSMOS_REQUEST_UNITS.inc(charge, operation=f"batch_{kind}")
+            self.budget.settle(f"batch_{kind}", reserved, charge, units=len(batch))
+            break
+        return charged, throttled, missing
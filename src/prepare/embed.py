@@ -1,66 +1,176 @@
-from langchain_openai import AzureOpenAIEmbeddings
-from typing import List, Dict, Any
+from prepare.cache import EmbeddingCache
+from prepare.metrics import EMBEDDING_TOKENS
+from prepare.rate_limit import RateLimiter
+from prepare.tokens import count_tokens
+from typing import List, Dict, Any, Optional, Tuple, TYPE_CHECKING
+import asyncio
+import logging
 import os
-import time
+
+logger = logging.getLogger(__name__)
+
+if TYPE_CHECKING:
+    from openai import AsyncAzureOpenAI
 
 class Embed:
-    def __init__(self, deployment: str = "text-embedding-ada-002"):
-        self.embeddings = AzureOpenAIEmbeddings(
-            deployment=deployment,
+    def __init__(
+        self,
+        deployment: str = "text-embedding-ada-002",
+        max_batch_size: int = 16,
+        max_batch_tokens: int = 8191,
+        max_concurrency: int = 4,
+        rate_limiter: Optional[RateLimiter] = None,
+        cache: Optional[EmbeddingCache] = None
+    ):
+        self.deployment = deployment
+        self._client: Optional["AsyncAzureOpenAI"] = None
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_concurrency = max_concurrency
+        # Default quota of an ada-002 deployment: 120K tokens and 720 requests per minute
+        self.rate_limiter = rate_limiter or RateLimiter(tokens_per_minute=120_000, requests_per_minute=720)
+        self.cache = cache
+        # Question embeddings being requested, by normalized text
+        self.in_flight: Dict[str, asyncio.Future] = {}
+
+    @property
+    def client(self) -> "AsyncAzureOpenAI":
+        """The OpenAI client, created on first use so that importing openai is not part of startup."""
+        if self._client is None:
+            self._client = self._create_client()
+        return self._client
+
+    def _create_client(self) -> "AsyncAzureOpenAI":
+        from openai import AsyncAzureOpenAI
+        return AsyncAzureOpenAI(
             azure_endpoint=os.getenv("EMBEDDER_OPENAI_API_BASE"),
             api_key=os.getenv("EMBEDDER_OPENAI_API_KEY"),
             api_version=os.getenv("EMBEDDER_OPENAI_API_VERSION"),
-            chunk_size=1
+            max_retries=5  # Retries 429s and honours the retry-after header
         )
-        self.request_count = 0
-        self.last_request_time = time.time()
-        self.max_requests_per_minute = 720
 
-    def embed_documents(self, documents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    async def warm_up(self, timeout: float = 5.0):
+        """Create the client and open a pooled connection to the endpoint with a request that costs no tokens."""
+        client = await asyncio.to_thread(lambda: self.client)
+        try:
+            # Shares the client's connection pool; any response, even an error, leaves the connection open
+            await client.with_options(max_retries=0, timeout=timeout).models.list()
+        except Exception as e:
+            logger.info(f"Embedding endpoint warm-up request failed: {e}")
+
+    async def embed_documents(self, documents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """
         Embed a list of document chunks.
-        
+
         :param documents: List of document dictionaries, each containing 'page_content' and 'metadata'
-        :return: List of document dictionaries with embeddings added
+        :return: List of document dictionaries with embeddings added, in the same order
         """
         texts = [doc['page_content'] for doc in documents]
+        embeddings = await self.embed_texts(texts)
+
         embedded_documents = []
-        for i, text in enumerate(texts):
-            self._rate_limit()
-            embedding = self.embeddings.embed_documents([text])[0]
+        for doc, embedding in zip(documents, embeddings):
             embedded_documents.append({
-                'page_content': documents[i]['page_content'],
-                'metadata': documents[i]['metadata'],
-                'document_name': documents[i]['metadata'].get('source', 'Unknown'),  # Add this line
-                'page': documents[i]['metadata'].get('page', 'Unknown'),  # Add this line
-                'chunk': documents[i]['metadata'].get('chunk', 'Unknown'),  # Add this line
+                'id': doc.get('id'),
+                'page_content': doc['page_content'],
+                'metadata': doc['metadata'],
+                'document_name': doc['metadata'].get('source', 'Unknown'),
+                'page': doc['metadata'].get('page', 'Unknown'),
+                'chunk': doc['metadata'].get('chunk', 'Unknown'),
                 'embedding': embedding,
             })
-        
         return embedded_documents
 
-    def _rate_limit(self):
-        """Implement rate limiting to not exceed 720 requests per minute."""
-        current_time = time.time()
-        if current_time - self.last_request_time >= 60:
-            self.request_count = 0
-            self.last_request_time = current_time
+    async def embed_query(self, text: str) -> List[float]:
+        """
+        Embed one question; concurrent calls for the same text share one cache lookup and request.
+
+        :param text: Text to embed
+        :return: Its embedding
+        """
+        key = " ".join(text.split())
+        future = self.in_flight.get(key)
+        if future is None:
+            future = self.in_flight[key] = asyncio.ensure_future(self.embed_texts([text]))
+            future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        # A caller that goes away must not cancel the request for the others
+        return (await asyncio.shield(future))[0]
+
+    async def embed_texts(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed texts, serving what we can from the cache and embedding the rest.
+
+        :param texts: Texts to embed
+        :return: One embedding per text, in the same order as the input
+        """
+        if self.cache is None:
+            return await self._embed_uncached(texts)
+
+        deployment = self.deployment
+        embeddings = await asyncio.to_thread(self.cache.get_many, deployment, texts)
+
+        # Texts that share a cache key within one call are only sent once
+        missing: Dict[str, List[int]] = {}
+        for i, embedding in enumerate(embeddings):
+            if embedding is None:
+                missing.setdefault(self.cache.key(deployment, texts[i]), []).append(i)
+
+        if missing:
+            missing_texts = [texts[indices[0]] for indices in missing.values()]
+            new_embeddings = await self._embed_uncached(missing_texts)
+            for indices, embedding in zip(missing.values(), new_embeddings):
+                for i in indices:
+                    embeddings[i] = embedding
+            await asyncio.to_thread(self.cache.put_many, deployment, missing_texts, new_embeddings)
+        return embeddings
+
+    async def _embed_uncached(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed texts in token-budgeted batches with several batches in flight at once.
+
+        :param texts: Texts to embed
+        :return: One embedding per text, in the same order as the input
+        """
+        embeddings: List[Optional[List[float]]] = [None] * len(texts)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
 
-        if self.request_count >= self.max_requests_per_minute:
-            sleep_time = 60 - (current_time - self.last_request_time)
-            if sleep_time > 0:
-                time.sleep(sleep_time)
-            self.request_count = 0
-            self.last_request_time = time.time()
+        async def embed_batch(indices: List[int], token_count: int):
+            # The API rejects empty strings, so send a single space instead
+            batch = [texts[i] or " " for i in indices]
+            async with semaphore:
+                await self.rate_limiter.acquire(tokens=token_count)
+                response = await self.client.embeddings.create(input=batch, model=self.deployment)
+            # The service's count when it reports one, otherwise our tiktoken estimate
+            EMBEDDING_TOKENS.inc(response.usage.prompt_tokens if response.usage else token_count)
+            for item in response.data:
+                embeddings[indices[item.index]] = item.embedding
 
-        self.request_count += 1
+        await asyncio.gather(*(
+            embed_batch(indices, token_count) for indices, token_count in self._batch(texts)
+        ))
+        return embeddings
+
+    def _batch(self, texts: List[str]) -> List[Tuple[List[int], int]]:
+        """
+        Pack texts into batches limited by both item count and token count.
+
+        :return: List of (indices into texts, token count of the batch)
+        """
+        batches = []
+        indices, batch_tokens = [], 0
+        for i, text in enumerate(texts):
+            tokens = count_tokens(text) or 1
+            if indices and (len(indices) >= self.max_batch_size or batch_tokens + tokens > self.max_batch_tokens):
+                batches.append((indices, batch_tokens))
+                indices, batch_tokens = [], 0
+            indices.append(i)
+            batch_tokens += tokens
+        if indices:
+            batches.append((indices, batch_tokens))
+        return batches
 
     def set_deployment(self, deployment: str):
-        """Update the embedding model deployment."""
-        self.embeddings = AzureOpenAIEmbeddings(
-            deployment=deployment,
-            azure_endpoint=os.getenv("EMBEDDER_OPENAI_API_BASE"),
-            api_key=os.getenv("EMBEDDER_OPENAI_API_KEY"),
-            api_version=os.getenv("EMBEDDER_OPENAI_API_VERSION"),
-            chunk_size=1
-        )
\ No newline at end of file
+        """Update the embedding model deployment and drop vectors cached from the old one."""
+        if self.cache is not None and deployment != self.deployment:
+            self.cache.invalidate(self.deployment)
+        self.deployment = deployment
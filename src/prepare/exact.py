@@ -0,0 +1,423 @@
+from prepare.index import LocalBackend, expiry_timestamp, extended_fields
+from prepare.vectors import ENCODINGS, quantize_int8
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, Tuple
+import datetime as dt
+import fcntl
+import json
+import os
+import uuid
+import numpy as np
+
+COLUMNS = ('ids', 'keep_until', 'content', 'document_name', 'page', 'start_index', 'end_index')
+# Rows scored per block when scanning a float16 or int8 matrix
+SCAN_BLOCK_ROWS = 4096
+
+
+class Segment:
+    """Rows written together: their mapped matrices and columns, never changed after they are written."""
+    def __init__(self, name: str, columns: Dict[str, list], vectors: np.ndarray, codes: Optional[np.ndarray] = None, scales: Optional[np.ndarray] = None):
+        self.name = name
+        self.columns = columns
+        self.vectors = vectors
+        self.codes = codes
+        self.scales = scales
+        self.rows = {item_id: row for row, item_id in enumerate(columns['ids'])}
+
+    def __len__(self) -> int:
+        return len(self.columns['ids'])
+
+    def scan(self, queries: np.ndarray) -> np.ndarray:
+        """Similarity of every row to each query: exact from the float32 matrix, or approximate from the compact one."""
+        if self.codes is None:
+            return self.vectors @ queries
+        scores = np.empty((len(self.codes), queries.shape[1]), dtype=np.float32)
+        # Convert block by block, so the float32 copy stays small
+        for start in range(0, len(self.codes), SCAN_BLOCK_ROWS):
+            end = start + SCAN_BLOCK_ROWS
+            scores[start:end] = self.codes[start:end].astype(np.float32) @ queries
+        if self.scales is not None:
+            scores *= self.scales[:, None]
+        return scores
+
+
+class PartitionView:
+    """
+    One process's view of a partition: its manifest and segments, rows numbered across them.
+
+    Deleted rows get a keep_until of -inf, so the expiry mask of a search drops them.
+    """
+    def __init__(self, signature, manifest: Dict[str, Any], segments: List[Segment]):
+        self.signature = signature
+        self.manifest = manifest
+        self.segments = segments
+        self.offsets = np.cumsum([0] + [len(segment) for segment in segments])
+        self.deleted = {segment.name: set(manifest['deleted'].get(segment.name, ())) for segment in segments}
+        self.keep_until = np.concatenate(
+            [np.asarray(segment.columns['keep_until'], dtype=np.float64) for segment in segments] or [np.zeros(0)]
+        )
+        for segment, offset in zip(segments, self.offsets):
+            if self.deleted[segment.name]:
+                self.keep_until[offset + np.fromiter(self.deleted[segment.name], dtype=np.int64)] = -np.inf
+        self.compact = any(segment.codes is not None for segment in segments)
+
+    def locate(self, row: int) -> Tuple[Segment, int]:
+        """The segment of a row and the row's index in it."""
+        index = int(np.searchsorted(self.offsets, row, side='right')) - 1
+        return self.segments[index], int(row - self.offsets[index])
+
+    def scan(self, queries: np.ndarray) -> np.ndarray:
+        """:param queries: (dimensions, queries) matrix; :return: (rows, queries) matrix"""
+        if not self.segments:
+            return np.zeros((0, queries.shape[1]), dtype=np.float32)
+        return np.concatenate([segment.scan(queries) for segment in self.segments])
+
+    def vectors(self, rows: np.ndarray) -> np.ndarray:
+        """float32 rows, read from the segments they are in."""
+        if not len(rows):
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack([segment.vectors[row] for segment, row in map(self.locate, rows)]).astype(np.float32)
+
+    def find(self, item_id: str) -> Optional[Tuple[Segment, int]]:
+        """The live row holding an id, or None."""
+        for segment in self.segments:
+            row = segment.rows.get(item_id)
+            if row is not None and row not in self.deleted[segment.name]:
+                return segment, row
+        return None
+
+
+class MemmapBackend(LocalBackend):
+    """
+    Retrieval backend that scores every chunk of a partition exactly.
+
+    A partition is a list of segments in <directory>, one per write batch: a
+    unit-normalized float32 matrix <hash>.<segment>.npy and a <hash>.<segment>.json of
+    its ids, keep_until, content, document_name and page. They are never changed
+    after they are written. The small <hash>.json manifest names the segments and the
+    rows deleted from them, and <hash>.sync.json holds the sync state. Searches
+    memory-map the matrices, so uvicorn workers on one host share their pages instead
+    of each holding a copy. Each segment is scored with one matmul, threshold and
+    expiry are masks and top_k comes from argpartition.
+
+    Writes run under a file lock. They write new segment files, then atomically
+    replace the manifest. Readers notice the new manifest by its inode and mtime and
+    only map and parse the segments they did not have. A batch therefore costs its
+    own rows, not a rewrite of the partition. Deletes and replaced ids only mark rows
+    in the manifest. After a write, the newest segment is merged into the one before
+    it while that one has no more live rows, so there are O(log n) segments and each
+    row is rewritten O(log n) times. Once deleted rows pass a third of all rows,
+    everything is merged into one segment.
+
+    With encoding float16 or int8 (one scale per row), searches scan a second, two or
+    four times smaller matrix instead, so fewer pages have to stay resident. The
+    top_k * rescore_factor best rows are then rescored from the float32 matrix, of which
+    only those rows are read; a rescore_factor of 0 ranks by the approximate scores.
+    """
+    def __init__(
+        self,
+        container,
+        directory: str = "/tmp/vectors",
+        refresh_seconds: float = 30,
+        reload_seconds: float = 600,
+        encoding: str = "float32",
+        rescore_factor: int = 4,
+        max_partitions: int = 1024,
+        idle_seconds: float = 3600
+    ):
+        super().__init__(container, refresh_seconds, reload_seconds, max_partitions, idle_seconds)
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown vector encoding: {encoding}")
+        self.directory = directory
+        self.encoding = encoding
+        self.rescore_factor = rescore_factor
+        os.makedirs(directory, exist_ok=True)
+        self.views: Dict[str, PartitionView] = {}
+
+    def search_partition(
+        self, passphrase_hash: str, query: np.ndarray, top_k: int, threshold: float, now: float, with_embeddings: bool = False
+    ) -> List[Dict[str, Any]]:
+        return self.search_partition_many(passphrase_hash, query[None, :], top_k, threshold, now, with_embeddings)[0]
+
+    def search_partition_many(
+        self, passphrase_hash: str, queries: np.ndarray, top_k: int, threshold: float, now: float, with_embeddings: bool = False
+    ) -> List[List[Dict[str, Any]]]:
+        view = self._open(passphrase_hash)
+        if view is None or not len(view.keep_until):
+            return [[] for _ in queries]
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        live = np.flatnonzero(view.keep_until > now)
+        # One pass over the partition's matrices for all queries
+        scores = view.scan(queries.T)[live]
+        return [
+            self._hits(view, live, column, query, top_k, threshold, with_embeddings)
+            for column, query in zip(scores.T, queries)
+        ]
+
+    def _hits(
+        self, view: PartitionView, rows: np.ndarray, scores: np.ndarray, query: np.ndarray, top_k: int, threshold: float, with_embeddings: bool
+    ) -> List[Dict[str, Any]]:
+        """Results of one query from the scan scores of the live rows."""
+        if view.compact and self.rescore_factor > 0:
+            shortlist = top_k * self.rescore_factor
+            if len(rows) > shortlist:
+                rows = np.sort(rows[np.argpartition(-scores, shortlist - 1)[:shortlist]])
+            scores = view.vectors(rows) @ query if len(rows) else scores[:0]
+        keep = scores > threshold
+        rows, scores = rows[keep], scores[keep]
+        if len(rows) > top_k:
+            best = np.argpartition(-scores, top_k - 1)[:top_k]
+            rows, scores = rows[best], scores[best]
+        order = np.argsort(-scores)
+        rows, scores = rows[order], scores[order]
+        results = []
+        for row, score in zip(rows, scores):
+            segment, local = view.locate(row)
+            columns = segment.columns
+            item = {
+                'content': columns['content'][local],
+                'document_name': columns['document_name'][local],
+                'page': columns['page'][local],
+                'start_index': columns['start_index'][local],
+                'end_index': columns['end_index'][local],
+                'keep_until': dt.datetime.fromtimestamp(columns['keep_until'][local]).isoformat(),
+                'similarity_score': float(score),
+            }
+            if with_embeddings:
+                # Read from the float32 matrix even when the compact one was scanned
+                item['embedding'] = np.array(segment.vectors[local], dtype=np.float32)
+            results.append(item)
+        return results
+
+    def add_items(self, passphrase_hash: str, items: List[Dict[str, Any]]):
+        if not items:
+            return
+        vectors = np.array([item['embedding'] for item in items], dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        columns = {
+            'ids': [item['id'] for item in items],
+            'keep_until': [expiry_timestamp(item['keep_until']) for item in items],
+            'content': [item['content'] for item in items],
+            'document_name': [item['document_name'] for item in items],
+            'page': [item['page'] for item in items],
+            'start_index': [(item.get('metadata') or {}).get('start_index') for item in items],
+            'end_index': [(item.get('metadata') or {}).get('end_index') for item in items],
+        }
+        with self._locked(passphrase_hash):
+            view = self._open(passphrase_hash)
+            manifest = self._copy_manifest(view)
+            # An id already stored is replaced by the new row
+            self._mark_deleted(view, manifest, columns['ids'])
+            self._merge(passphrase_hash, view, manifest, columns, vectors)
+            self._commit(passphrase_hash, view, manifest)
+
+    def remove_items(self, passphrase_hash: str, ids: List[str]):
+        with self._locked(passphrase_hash):
+            view = self._open(passphrase_hash)
+            if view is None:
+                return
+            manifest = self._copy_manifest(view)
+            if self._mark_deleted(view, manifest, ids):
+                self._merge(passphrase_hash, view, manifest)
+                self._commit(passphrase_hash, view, manifest)
+
+    def extend_items(self, passphrase_hash: str, items: List[Dict[str, Any]]):
+        with self._locked(passphrase_hash):
+            view = self._open(passphrase_hash)
+            if view is None:
+                return
+            columns = {column: [] for column in COLUMNS}
+            vectors = []
+            for item in items:
+                found = view.find(item['id'])
+                if found is None:
+                    continue
+                segment, row = found
+                fields = extended_fields(item)
+                values = {**{column: segment.columns[column][row] for column in COLUMNS}, **fields}
+                values['keep_until'] = expiry_timestamp(fields['keep_until'])
+                for column in COLUMNS:
+                    columns[column].append(values[column])
+                vectors.append(segment.vectors[row])
+            if not vectors:
+                return
+            # Segments never change: the rows are marked deleted and written again with the new fields
+            manifest = self._copy_manifest(view)
+            self._mark_deleted(view, manifest, columns['ids'])
+            self._merge(passphrase_hash, view, manifest, columns, np.array(vectors, dtype=np.float32))
+            self._commit(passphrase_hash, view, manifest)
+
+    def clear(self, passphrase_hash: str):
+        with self._locked(passphrase_hash):
+            view = self._open(passphrase_hash)
+            self._commit(passphrase_hash, view, {'segments': [], 'deleted': {}})
+            # Without a sync state, the next search reloads the partition
+            try:
+                os.remove(self._path(f"{passphrase_hash}.sync.json"))
+            except FileNotFoundError:
+                pass
+
+    def evict(self, passphrase_hash: str):
+        # The files stay current for other workers; this process only unmaps them
+        self.views.pop(passphrase_hash, None)
+
+    def sync_state(self, passphrase_hash: str) -> Optional[Dict[str, float]]:
+        try:
+            with open(self._path(f"{passphrase_hash}.sync.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save_sync_state(self, passphrase_hash: str, state: Dict[str, float]):
+        # Its own small file, so a refresh does not rewrite the manifest
+        self._replace(f"{passphrase_hash}.sync.json", lambda f: f.write(json.dumps(state).encode()))
+
+    # Files
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    @contextmanager
+    def _locked(self, passphrase_hash: str):
+        """Serialize writers of a partition across threads and worker processes."""
+        with open(self._path(f"{passphrase_hash}.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _open(self, passphrase_hash: str) -> Optional[PartitionView]:
+        """Current view of a partition, rebuilt when another writer replaced its manifest."""
+        path = self._path(f"{passphrase_hash}.json")
+        for _ in range(3):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                self.views.pop(passphrase_hash, None)
+                return None
+            signature = (stat.st_ino, stat.st_mtime_ns)
+            view = self.views.get(passphrase_hash)
+            if view is not None and view.signature == signature:
+                return view
+            try:
+                with open(path) as f:
+                    manifest = json.load(f)
+                # Segments never change, so those of the previous view are kept
+                known = {segment.name: segment for segment in view.segments} if view is not None else {}
+                segments = [known.get(entry['name']) or self._read_segment(entry) for entry in manifest['segments']]
+            except FileNotFoundError:
+                # A writer replaced the files between the stat and the read
+                continue
+            view = self.views[passphrase_hash] = PartitionView(signature, manifest, segments)
+            return view
+        return self.views.get(passphrase_hash)
+
+    def _read_segment(self, entry: Dict[str, Any]) -> Segment:
+        name = entry['name']
+        with open(self._path(f"{name}.json")) as f:
+            columns = json.load(f)
+        matrices = {key: np.load(self._path(f"{name}.{key}.npy"), mmap_mode='r') if entry.get(key) else None for key in ('codes', 'scales')}
+        return Segment(name, columns, np.load(self._path(f"{name}.npy"), mmap_mode='r'), matrices['codes'], matrices['scales'])
+
+    def _write_segment(self, passphrase_hash: str, columns: Dict[str, list], vectors: np.ndarray) -> Dict[str, Any]:
+        """Write a segment's files; :return: its manifest entry"""
+        name = f"{passphrase_hash}.{uuid.uuid4().hex[:12]}"
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        matrices = {'': vectors}
+        if self.encoding == "float16":
+            matrices['codes'] = vectors.astype(np.float16)
+        elif self.encoding == "int8":
+            matrices['codes'], matrices['scales'] = quantize_int8(vectors)
+        for key, matrix in matrices.items():
+            self._replace(f"{name}.{key}.npy" if key else f"{name}.npy", lambda f: np.save(f, matrix))
+        self._replace(f"{name}.json", lambda f: f.write(json.dumps(columns).encode()))
+        return {'name': name, 'rows': len(vectors), 'codes': 'codes' in matrices, 'scales': 'scales' in matrices}
+
+    @staticmethod
+    def _copy_manifest(view: Optional[PartitionView]) -> Dict[str, Any]:
+        if view is None:
+            return {'segments': [], 'deleted': {}}
+        manifest = view.manifest
+        return {
+            'segments': list(manifest['segments']),
+            'deleted': {name: list(rows) for name, rows in manifest['deleted'].items()},
+        }
+
+    @staticmethod
+    def _mark_deleted(view: Optional[PartitionView], manifest: Dict[str, Any], ids: List[str]) -> bool:
+        """Mark the live rows of ids deleted in manifest; :return: whether any were"""
+        if view is None:
+            return False
+        marked = False
+        for item_id in set(ids):
+            found = view.find(item_id)
+            if found is not None and found[1] not in manifest['deleted'].get(found[0].name, ()):
+                manifest['deleted'].setdefault(found[0].name, []).append(found[1])
+                marked = True
+        return marked
+
+    def _merge(
+        self, passphrase_hash: str, view: Optional[PartitionView], manifest: Dict[str, Any],
+        columns: Optional[Dict[str, list]] = None, vectors: Optional[np.ndarray] = None
+    ):
+        """Append a batch's rows as a segment, merged with segments before it as described in the class docstring."""
+        def live(entry):
+            return entry['rows'] - len(manifest['deleted'].get(entry['name'], ()))
+
+        segments = manifest['segments']
+        pending = len(vectors) if vectors is not None else 0
+        total = sum(entry['rows'] for entry in segments) + pending
+        if total and total - pending - sum(map(live, segments)) > total / 3:
+            merge = len(segments)
+        else:
+            merge, size = 0, pending
+            while pending and merge < len(segments) and live(segments[-merge - 1]) <= size:
+                size += live(segments[-merge - 1])
+                merge += 1
+        merged, kept = segments[len(segments) - merge:], segments[:len(segments) - merge]
+        known = {segment.name: segment for segment in view.segments} if view is not None else {}
+        parts = {column: [] for column in COLUMNS}
+        matrices = []
+        for entry in merged:
+            segment = known.get(entry['name']) or self._read_segment(entry)
+            deleted = set(manifest['deleted'].get(entry['name'], ()))
+            rows = [row for row in range(len(segment)) if row not in deleted]
+            for column in COLUMNS:
+                values = segment.columns[column]
+                parts[column] += [values[row] for row in rows]
+            if rows:
+                matrices.append(np.asarray(segment.vectors[rows], dtype=np.float32))
+        if pending:
+            for column in COLUMNS:
+                parts[column] += columns[column]
+            matrices.append(vectors)
+        # Segments with no live rows are dropped either way
+        manifest['segments'] = [entry for entry in kept if live(entry) > 0]
+        if matrices:
+            manifest['segments'].append(self._write_segment(passphrase_hash, parts, np.concatenate(matrices)))
+        names = {entry['name'] for entry in manifest['segments']}
+        manifest['deleted'] = {name: rows for name, rows in manifest['deleted'].items() if name in names}
+
+    def _commit(self, passphrase_hash: str, view: Optional[PartitionView], manifest: Dict[str, Any]):
+        """Replace the manifest, then remove the files of segments it no longer names."""
+        old = {entry['name']: entry for entry in view.manifest['segments']} if view is not None else {}
+        self._replace(f"{passphrase_hash}.json", lambda f: f.write(json.dumps(manifest).encode()))
+        names = {entry['name'] for entry in manifest['segments']}
+        files = []
+        for name, entry in old.items():
+            if name not in names:
+                files += [f"{name}.npy", f"{name}.json"] + [f"{name}.{key}.npy" for key in ('codes', 'scales') if entry.get(key)]
+        for file_name in files:
+            # Processes that still map the old file keep its pages until they remap
+            try:
+                os.remove(self._path(file_name))
+            except FileNotFoundError:
+                pass
+
+    def _replace(self, name: str, write):
+        path = self._path(name)
+        temporary_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(temporary_path, "wb") as f:
+            write(f)
+        os.replace(temporary_path, path)
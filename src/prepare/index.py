@@ -0,0 +1,497 @@
+from prepare.cosmos import QueryMetrics
+from prepare.retrieve import RetrievalBackend
+from prepare.vectors import with_embeddings
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
+import asyncio
+import datetime as dt
+import logging
+import threading
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def expiry_timestamp(keep_until: str) -> float:
+    """Epoch seconds of a stored keep_until value (naive local time, like dt.datetime.now())."""
+    return dt.datetime.fromisoformat(keep_until).timestamp()
+
+
+def payload(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Fields of a stored item that a search hit returns, with the chunk's offsets in its page when known."""
+    return {'content': item['content'], 'document_name': item['document_name'], **extended_fields(item)}
+
+
+def extended_fields(item: Dict[str, Any]) -> Dict[str, Any]:
+    """The payload fields Store.extend_chunks patches: page, keep_until and the chunk's offsets."""
+    metadata = item.get('metadata') or {}
+    return {
+        'page': item['page'],
+        'keep_until': item['keep_until'],
+        'start_index': metadata.get('start_index'),
+        'end_index': metadata.get('end_index'),
+    }
+
+
+class IVFIndex:
+    """
+    Inverted-file (IVF) approximate nearest neighbour index over one partition.
+
+    Vectors are unit-normalized float32 rows of one contiguous matrix, so cosine
+    similarity is a dot product. Once the partition has min_train_size vectors,
+    spherical k-means splits it into ~4*sqrt(n) lists and a query only scores the
+    rows of the n_probe lists closest to it. Smaller partitions are scanned exactly.
+
+    Inserts are appended and assigned to their nearest list; the lists are retrained
+    when the partition has doubled since the last training. Deletes only set a
+    tombstone; rows are compacted away once tombstones pass a third of the matrix.
+    """
+    def __init__(self, dimensions: int, n_probe: int = 16, min_train_size: int = 2048):
+        self.dimensions = dimensions
+        self.n_probe = n_probe
+        self.min_train_size = min_train_size
+        self.size = 0
+        self.vectors = np.zeros((0, dimensions), dtype=np.float32)
+        self.alive = np.zeros(0, dtype=bool)
+        self.keep_until = np.zeros(0, dtype=np.float64)
+        self.assignments = np.zeros(0, dtype=np.int32)
+        self.ids: List[Optional[str]] = []
+        self.payloads: List[Optional[Dict[str, Any]]] = []
+        self.rows: Dict[str, int] = {}
+        self.tombstones = 0
+        self.centroids: Optional[np.ndarray] = None
+        self.trained_size = 0
+        self.list_rows: Optional[np.ndarray] = None
+        self.list_offsets: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def add(self, ids: List[str], vectors: np.ndarray, keep_until: np.ndarray, payloads: List[Dict[str, Any]]):
+        """
+        Insert or replace vectors.
+
+        :param ids: Item ids; an id already in the index replaces the old row
+        :param vectors: (n, dimensions) array, normalized here
+        :param keep_until: Expiry of each row in epoch seconds
+        :param payloads: Fields returned with a hit, one dict per row
+        """
+        self.remove([item_id for item_id in ids if item_id in self.rows], compact=False)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.maximum(norms, 1e-12)
+
+        count = len(ids)
+        self._reserve(self.size + count)
+        start, end = self.size, self.size + count
+        self.vectors[start:end] = vectors
+        self.alive[start:end] = True
+        self.keep_until[start:end] = keep_until
+        for offset, (item_id, payload) in enumerate(zip(ids, payloads)):
+            self.rows[item_id] = start + offset
+        self.ids.extend(ids)
+        self.payloads.extend(payloads)
+        self.size = end
+
+        if self.centroids is not None:
+            self.assignments[start:end] = np.argmax(vectors @ self.centroids.T, axis=1)
+            self.list_rows = None
+        if len(self.rows) >= self.min_train_size and len(self.rows) >= 2 * self.trained_size:
+            self.train()
+
+    def remove(self, ids: List[str], compact: bool = True):
+        """Tombstone rows by id; unknown ids are ignored."""
+        for item_id in ids:
+            row = self.rows.pop(item_id, None)
+            if row is not None:
+                self.alive[row] = False
+                self.ids[row] = None
+                self.payloads[row] = None
+                self.tombstones += 1
+        if compact and self.tombstones > self.size / 3:
+            self.compact()
+
+    def update(self, ids: List[str], keep_until: np.ndarray, fields: List[Dict[str, Any]]):
+        """Set the expiry and payload fields of rows by id; unknown ids are ignored."""
+        for item_id, expiry, item_fields in zip(ids, keep_until, fields):
+            row = self.rows.get(item_id)
+            if row is not None:
+                self.keep_until[row] = expiry
+                self.payloads[row] = {**self.payloads[row], **item_fields}
+
+    def compact(self):
+        """Drop tombstoned rows and retrain the lists on what is left."""
+        live = np.flatnonzero(self.alive[:self.size])
+        self.vectors = self.vectors[live]
+        self.alive = np.ones(len(live), dtype=bool)
+        self.keep_until = self.keep_until[live]
+        self.assignments = self.assignments[live] if len(self.assignments) else self.assignments
+        self.ids = [self.ids[row] for row in live]
+        self.payloads = [self.payloads[row] for row in live]
+        self.rows = {item_id: row for row, item_id in enumerate(self.ids)}
+        self.size = len(live)
+        self.tombstones = 0
+        self.centroids = None
+        self.trained_size = 0
+        self.list_rows = None
+        if self.size >= self.min_train_size:
+            self.train()
+
+    def train(self, iterations: int = 6, seed: int = 0):
+        """Cluster the live rows with spherical k-means and assign every row to a list."""
+        live = np.flatnonzero(self.alive[:self.size])
+        n_lists = max(1, int(4 * np.sqrt(len(live))))
+        rng = np.random.default_rng(seed)
+        # ~32 rows per list are enough to place the centroids; more only costs time
+        sample = self.vectors[rng.choice(live, size=min(len(live), 32 * n_lists, 16384), replace=False)]
+        centroids = sample[:n_lists].copy()
+
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            order = np.argsort(assignments, kind="stable")
+            counts = np.bincount(assignments, minlength=n_lists)
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            non_empty = counts > 0
+            sums = np.add.reduceat(sample[order], starts[non_empty], axis=0)
+            centroids[non_empty] = sums
+            # Re-seed empty lists from random sample rows
+            empty = np.flatnonzero(~non_empty)
+            if len(empty):
+                centroids[empty] = sample[rng.choice(len(sample), size=len(empty), replace=False)]
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+        self.centroids = centroids
+        self.assignments = np.zeros(len(self.vectors), dtype=np.int32)
+        # Assign in blocks to bound the size of the similarity matrix
+        for start in range(0, self.size, 8192):
+            end = min(start + 8192, self.size)
+            self.assignments[start:end] = np.argmax(self.vectors[start:end] @ centroids.T, axis=1)
+        self.trained_size = len(live)
+        self.list_rows = None
+
+    def search(self, query: np.ndarray, top_k: int, threshold: float, now: float) -> List[Tuple[int, float]]:
+        """
+        Find the top_k live, unexpired rows with cosine similarity above threshold.
+
+        :return: List of (row, similarity), most similar first
+        """
+        return self.search_many(np.asarray(query, dtype=np.float32)[None, :], top_k, threshold, now)[0]
+
+    def search_many(self, queries: np.ndarray, top_k: int, threshold: float, now: float) -> List[List[Tuple[int, float]]]:
+        """
+        search for each row of queries, scoring them all in one matrix product.
+
+        Every query is scored against the rows of the lists any of them probes, so a
+        query of a batch sees at least the candidates it would alone.
+
+        :return: One list of (row, similarity) per query, most similar first
+        """
+        if self.size == 0:
+            return [[] for _ in queries]
+        queries = np.asarray(queries, dtype=np.float32)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+
+        if self.centroids is None:
+            candidates = np.arange(self.size)
+            scores = self.vectors[:self.size] @ queries.T
+        else:
+            candidates = self._probe(queries)
+            scores = self.vectors[candidates] @ queries.T
+
+        live = self.alive[candidates] & (self.keep_until[candidates] > now)
+        results = []
+        for column in scores.T:
+            mask = live & (column > threshold)
+            rows, row_scores = candidates[mask], column[mask]
+            if len(row_scores) > top_k:
+                best = np.argpartition(-row_scores, top_k - 1)[:top_k]
+                rows, row_scores = rows[best], row_scores[best]
+            order = np.argsort(-row_scores)
+            results.append([(int(rows[i]), float(row_scores[i])) for i in order])
+        return results
+
+    def _probe(self, queries: np.ndarray) -> np.ndarray:
+        """Rows of the lists whose centroids are among the n_probe closest to any of the queries."""
+        if self.list_rows is None:
+            assignments = self.assignments[:self.size]
+            self.list_rows = np.argsort(assignments, kind="stable")
+            self.list_offsets = np.concatenate(([0], np.cumsum(np.bincount(assignments, minlength=len(self.centroids)))))
+        n_probe = min(self.n_probe, len(self.centroids))
+        lists = np.unique(np.argpartition(-(queries @ self.centroids.T), n_probe - 1, axis=1)[:, :n_probe])
+        return np.concatenate([self.list_rows[self.list_offsets[i]:self.list_offsets[i + 1]] for i in lists])
+
+    def _reserve(self, capacity: int):
+        if capacity <= len(self.vectors):
+            return
+        new_capacity = max(capacity, 2 * len(self.vectors), 64)
+        grow = new_capacity - len(self.vectors)
+        self.vectors = np.concatenate([self.vectors, np.zeros((grow, self.dimensions), dtype=np.float32)])
+        self.alive = np.concatenate([self.alive, np.zeros(grow, dtype=bool)])
+        self.keep_until = np.concatenate([self.keep_until, np.zeros(grow, dtype=np.float64)])
+        self.assignments = np.concatenate([self.assignments, np.zeros(grow, dtype=np.int32)])
+
+
+class PartitionSync(ABC):
+    """
+    Local copies of Cosmos partitions, kept in sync with Cosmos and Store.
+
+    A passphrase_hash partition is loaded from Cosmos on its first search and then
+    kept current from Store's write and delete notifications. Other replicas write to
+    Cosmos too, so every refresh_seconds a partition catches up on items with a newer
+    _ts, and every reload_seconds it is reloaded to pick up their deletes.
+
+    Partitions not searched for idle_seconds, and the least recently searched ones
+    beyond max_partitions, are evicted and loaded again on their next search.
+
+    Subclasses hold the copies and implement add_items, remove_items, extend_items and
+    clear. Sync bookkeeping is kept per process unless they override sync_state,
+    save_sync_state and evict.
+    """
+    fields = "c.id, c.embedding, c.embedding_f16, c.embedding_i8, c.embedding_scale, c.content, c.document_name, c.page, c.metadata, c.keep_until, c._ts"
+    condition = "(IS_DEFINED(c.embedding) OR IS_DEFINED(c.embedding_f16) OR IS_DEFINED(c.embedding_i8))"
+
+    def __init__(
+        self,
+        container,
+        refresh_seconds: float = 30,
+        reload_seconds: float = 600,
+        max_partitions: int = 1024,
+        idle_seconds: float = 3600
+    ):
+        self.container = container
+        self.refresh_seconds = refresh_seconds
+        self.reload_seconds = reload_seconds
+        self.max_partitions = max_partitions
+        self.idle_seconds = idle_seconds
+        self.sync_states: Dict[str, Dict[str, float]] = {}
+        self.sync_locks: Dict[str, asyncio.Lock] = {}
+        # Partitions by the time of their last search, least recent first
+        self.last_used: "OrderedDict[str, float]" = OrderedDict()
+
+    def on_store(self, passphrase_hash: str, items: List[Dict[str, Any]]):
+        # Partitions nobody searched yet are loaded from Cosmos on first use instead
+        if self.sync_state(passphrase_hash) is not None:
+            self.add_items(passphrase_hash, self._decode(items))
+
+    def on_extend(self, passphrase_hash: str, items: List[Dict[str, Any]]):
+        if self.sync_state(passphrase_hash) is not None:
+            self.extend_items(passphrase_hash, items)
+
+    def on_delete(self, passphrase_hash: str, ids: Optional[List[str]]):
+        if self.sync_state(passphrase_hash) is None:
+            return
+        if ids is None:
+            self.clear(passphrase_hash)
+        else:
+            self.remove_items(passphrase_hash, ids)
+
+    # Storage hooks
+
+    @abstractmethod
+    def add_items(self, passphrase_hash: str, items: List[Dict[str, Any]]):
+        """Insert or replace Cosmos items (with id, keep_until, payload fields and, for vector backends, a float32 embedding)."""
+
+    @abstractmethod
+    def remove_items(self, passphrase_hash: str, ids: List[str]):
+        """Drop held items by id; unknown ids are ignored."""
+
+    @abstractmethod
+    def extend_items(self, passphrase_hash: str, items: List[Dict[str, Any]]):
+        """Apply the fields Store.extend_chunks patched (id, keep_until, page, metadata) to held items."""
+
+    @abstractmethod
+    def clear(self, passphrase_hash: str):
+        """Drop everything held for a partition before it is reloaded."""
+
+    def sync_state(self, passphrase_hash: str) -> Optional[Dict[str, float]]:
+        """:return: loaded_at and synced_at (epoch seconds) and last_ts of a partition, None if never loaded"""
+        return self.sync_states.get(passphrase_hash)
+
+    def save_sync_state(self, passphrase_hash: str, state: Dict[str, float]):
+        self.sync_states[passphrase_hash] = state
+
+    def evict(self, passphrase_hash: str):
+        """Free what this process holds for a partition, so it is loaded again on its next search."""
+        self.clear(passphrase_hash)
+        self.sync_states.pop(passphrase_hash, None)
+
+    @staticmethod
+    def _decode(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Items the backend can hold, in the form add_items takes: decoded float32 embeddings by default."""
+        return with_embeddings(items)
+
+    # Sync with Cosmos
+
+    async def _sync(self, passphrase_hash: str):
+        current_time = time.time()
+        self.last_used[passphrase_hash] = current_time
+        self.last_used.move_to_end(passphrase_hash)
+        await self._evict_unused(current_time)
+        # One load per partition at a time; concurrent searches wait for it
+        async with self.sync_locks.setdefault(passphrase_hash, asyncio.Lock()):
+            state = await asyncio.to_thread(self.sync_state, passphrase_hash)
+            if state is None or current_time - state['loaded_at'] > self.reload_seconds:
+                await asyncio.to_thread(self.clear, passphrase_hash)
+                last_ts = await self._load(passphrase_hash, since=None)
+                state = {'loaded_at': current_time, 'synced_at': current_time, 'last_ts': last_ts}
+            elif current_time - state['synced_at'] > self.refresh_seconds:
+                last_ts = await self._load(passphrase_hash, since=state['last_ts'])
+                state = {**state, 'synced_at': current_time, 'last_ts': max(last_ts, state['last_ts'])}
+            else:
+                return
+            await asyncio.to_thread(self.save_sync_state, passphrase_hash, state)
+
+    async def _evict_unused(self, current_time: float):
+        """Evict the partitions searched least recently, as described in the class docstring."""
+        while self.last_used:
+            passphrase_hash, used_at = next(iter(self.last_used.items()))
+            if len(self.last_used) <= self.max_partitions and current_time - used_at <= self.idle_seconds:
+                return
+            del self.last_used[passphrase_hash]
+            lock = self.sync_locks.get(passphrase_hash)
+            if lock is not None and lock.locked():
+                # Still loading for a search that started before it went idle
+                continue
+            self.sync_locks.pop(passphrase_hash, None)
+            await asyncio.to_thread(self.evict, passphrase_hash)
+            logger.info(f"Evicted the local copy of partition {passphrase_hash[:8]}")
+
+    async def _load(self, passphrase_hash: str, since: Optional[int]) -> int:
+        """Add the partition's items written since the given _ts; returns the newest _ts seen."""
+        query = f"SELECT {self.fields} FROM c WHERE c.passphrase_hash = @hash AND {self.condition}"
+        parameters = [{"name": "@hash", "value": passphrase_hash}]
+        if since is not None:
+            # Inclusive, so writes in the same second as the last sync are not missed
+            query += " AND c._ts >= @since"
+            parameters.append({"name": "@since", "value": since})
+        metrics = QueryMetrics("local_load")
+        items = [item async for item in self.container.query_items(
+            query=query, parameters=parameters, partition_key=passphrase_hash, response_hook=metrics
+        )]
+        items = self._decode(items)
+        if items:
+            # Building or retraining an index is CPU-bound
+            await asyncio.to_thread(self.add_items, passphrase_hash, items)
+        logger.info(
+            f"Loaded {len(items)} items into the local copy of partition {passphrase_hash[:8]} "
+            f"for {metrics.request_charge:.2f} RU"
+        )
+        return max((item.get('_ts', 0) for item in items), default=since or 0)
+
+
+class LocalBackend(PartitionSync, RetrievalBackend):
+    """
+    Base of the retrieval backends that search a local copy of each partition.
+
+    Subclasses implement PartitionSync's storage hooks and search_partition, and
+    score several queries in one pass by overriding search_partition_many.
+    """
+    async def vector_search(
+        self, passphrase_hash: str, query_vector: List[float], top_k: int, threshold: float, with_embeddings: bool = False
+    ) -> List[Dict[str, Any]]:
+        await self._sync(passphrase_hash)
+        query = np.asarray(query_vector, dtype=np.float32)
+        return await asyncio.to_thread(
+            self.search_partition, passphrase_hash, query, top_k, threshold, time.time(), with_embeddings=with_embeddings
+        )
+
+    async def vector_search_many(
+        self, passphrase_hash: str, query_vectors: List[List[float]], top_k: int, threshold: float, with_embeddings: bool = False
+    ) -> List[List[Dict[str, Any]]]:
+        if not query_vectors:
+            return []
+        await self._sync(passphrase_hash)
+        queries = np.asarray(query_vectors, dtype=np.float32)
+        return await asyncio.to_thread(
+            self.search_partition_many, passphrase_hash, queries, top_k, threshold, time.time(), with_embeddings=with_embeddings
+        )
+
+    @abstractmethod
+    def search_partition(
+        self, passphrase_hash: str, query: np.ndarray, top_k: int, threshold: float, now: float, with_embeddings: bool = False
+    ) -> List[Dict[str, Any]]:
+        """:param with_embeddings: Add each hit's embedding as a float32 array"""
+
+    def search_partition_many(
+        self, passphrase_hash: str, queries: np.ndarray, top_k: int, threshold: float, now: float, with_embeddings: bool = False
+    ) -> List[List[Dict[str, Any]]]:
+        """search_partition for each row of queries; subclasses score them in one pass."""
+        return [
+            self.search_partition(passphrase_hash, query, top_k, threshold, now, with_embeddings=with_embeddings)
+            for query in queries
+        ]
+
+
+class IndexBackend(LocalBackend):
+    """Retrieval backend that answers vector searches from in-process IVF indexes."""
+    def __init__(
+        self,
+        container,
+        n_probe: int = 16,
+        refresh_seconds: float = 30,
+        reload_seconds: float = 600,
+        max_partitions: int = 1024,
+        idle_seconds: float = 3600
+    ):
+        super().__init__(container, refresh_seconds, reload_seconds, max_partitions, idle_seconds)
+        self.n_probe = n_probe
+        self.partitions: Dict[str, IVFIndex] = {}
+        # Searches and updates run in worker threads
+        self.lock = threading.Lock()
+
+    def search_partition(
+        self, passphrase_hash: str, query: np.ndarray, top_k: int, threshold: float, now: float, with_embeddings: bool = False
+    ) -> List[Dict[str, Any]]:
+        return self.search_partition_many(passphrase_hash, query[None, :], top_k, threshold, now, with_embeddings)[0]
+
+    def search_partition_many(
+        self, passphrase_hash: str, queries: np.ndarray, top_k: int, threshold: float, now: float, with_embeddings: bool = False
+    ) -> List[List[Dict[str, Any]]]:
+        with self.lock:
+            index = self.partitions.get(passphrase_hash)
+            if index is None:
+                return [[] for _ in queries]
+            results = []
+            for hits in index.search_many(queries, top_k, threshold, now):
+                if with_embeddings:
+                    # Copies, since compaction rewrites the matrix
+                    results.append([{**index.payloads[row], 'similarity_score': score, 'embedding': index.vectors[row].copy()} for row, score in hits])
+                else:
+                    results.append([{**index.payloads[row], 'similarity_score': score} for row, score in hits])
+            return results
+
+    def clear(self, passphrase_hash: str):
+        with self.lock:
+            self.partitions.pop(passphrase_hash, None)
+
+    def remove_items(self, passphrase_hash: str, ids: List[str]):
+        with self.lock:
+            index = self.partitions.get(passphrase_hash)
+            if index is not None:
+                index.remove(ids)
+
+    def extend_items(self, passphrase_hash: str, items: List[Dict[str, Any]]):
+        keep_until = [expiry_timestamp(item['keep_until']) for item in items]
+        with self.lock:
+            index = self.partitions.get(passphrase_hash)
+            if index is not None:
+                index.update([item['id'] for item in items], keep_until, [extended_fields(item) for item in items])
+
+    def add_items(self, passphrase_hash: str, items: List[Dict[str, Any]]):
+        if not items:
+            return
+        vectors = np.array([item['embedding'] for item in items], dtype=np.float32)
+        keep_until = np.array([expiry_timestamp(item['keep_until']) for item in items])
+        with self.lock:
+            index = self.partitions.get(passphrase_hash)
+            if index is None:
+                index = self.partitions[passphrase_hash] = IVFIndex(vectors.shape[1], n_probe=self.n_probe)
+            index.add(
+                ids=[item['id'] for item in items],
+                vectors=vectors,
+                keep_until=keep_until,
+                payloads=[payload(item) for item in items]
+            )
+
@@ -0,0 +1,183 @@
+from collections import Counter
+from prepare.metrics import INGEST_SECONDS
+from typing import List, Dict, Any
+import asyncio
+import datetime as dt
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Ingest:
+    """
+    Load, split, embed and store the files of an upload job as pipelined stages.
+
+    The stages run as separate tasks connected by small bounded queues, so embedding
+    of one batch overlaps with storing the previous one, and a fast stage waits for a
+    slow one instead of piling chunks up in memory. Documents are parsed lazily, one
+    page at a time, in worker processes (or threads without a parser pool), so the
+    first chunks are embedded and stored while the rest of the file is still being
+    parsed.
+
+    Re-uploading a file only embeds and writes its new chunks: chunks already stored
+    under the same deterministic id get their expiry extended, and stored chunks the
+    new revision no longer has are deleted.
+    """
+    def __init__(self, loader, splitter, embedder, storage, batch_size: int = 64, max_queued_batches: int = 2, parser=None):
+        """
+        :param parser: prepare.parse.ParserPool to parse documents in worker processes; without
+            one, documents are parsed with loader in worker threads
+        """
+        self.loader = loader
+        self.parser = parser
+        self.splitter = splitter
+        self.embedder = embedder
+        self.storage = storage
+        self.batch_size = batch_size
+        self.max_queued_batches = max_queued_batches
+
+    async def run(self, job):
+        """
+        Process every file of a job, reporting progress on the job as chunks move through.
+
+        :param job: api.jobs.Job with passphrase, files and keep_until
+        """
+        embed_queue = asyncio.Queue(maxsize=self.max_queued_batches)
+        store_queue = asyncio.Queue(maxsize=self.max_queued_batches)
+        tasks = [
+            asyncio.create_task(self._produce(job, embed_queue)),
+            asyncio.create_task(self._embed(job, embed_queue, store_queue)),
+            asyncio.create_task(self._store(job, store_queue)),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # A failed stage would leave the others blocked on their queues
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            self._remove_files(job)
+
+    async def _produce(self, job, embed_queue: asyncio.Queue):
+        for file in job.files:
+            job.update(stage=f"processing {file['filename']}")
+            # Keep the document name earlier uploads were stored under
+            document_name = f"/tmp/{file['filename']}"
+            size_bytes = os.path.getsize(file['path'])
+            stored_ids = await self.storage.chunk_ids(job.passphrase, document_name)
+            seen_ids = set()
+            occurrences = Counter()
+            pages = 0
+            batch, unchanged = [], []
+            async for document in self._pages(file['path']):
+                pages += 1
+                chunks = await asyncio.to_thread(self._split_page, document, document_name)
+                job.advance(chunks_total=len(chunks))
+                for chunk in chunks:
+                    content = chunk['page_content']
+                    first_id = self.storage.chunk_id(job.passphrase, document_name, content)
+                    occurrence = occurrences[first_id]
+                    occurrences[first_id] += 1
+                    chunk['id'] = self.storage.chunk_id(job.passphrase, document_name, content, occurrence) if occurrence else first_id
+                    seen_ids.add(chunk['id'])
+                    # Chunks stored by an earlier upload of the file only need their expiry moved
+                    (unchanged if chunk['id'] in stored_ids else batch).append(chunk)
+                if len(unchanged) >= self.batch_size:
+                    batch += await self._extend(job, unchanged)
+                    unchanged = []
+                # Hand chunks on as soon as the embedder is idle; while it is busy, fill a batch
+                while len(batch) >= self.batch_size or (batch and embed_queue.empty()):
+                    await embed_queue.put(batch[:self.batch_size])
+                    batch = batch[self.batch_size:]
+            if unchanged:
+                batch += await self._extend(job, unchanged)
+            if batch:
+                await embed_queue.put(batch)
+            removed_ids = stored_ids - seen_ids
+            if removed_ids:
+                await self.storage.delete_chunks(job.passphrase, list(removed_ids))
+                job.advance(chunks_removed=len(removed_ids))
+            # Recorded in the catalog by the store stage, after the file's last chunks
+            await embed_queue.put({
+                'document_name': document_name, 'chunks': len(seen_ids), 'pages': pages, 'size_bytes': size_bytes
+            })
+            job.processed_files.append(file['filename'])
+            logger.info(f"Processed document: {file['filename']}")
+        await embed_queue.put(None)
+
+    async def _extend(self, job, chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Move stored chunks' expiry; :return: those that no longer existed, to be embedded and stored again"""
+        report = await self.storage.extend_chunks(passphrase=job.passphrase, documents=chunks, keep_until=job.keep_until)
+        missing_ids = set(report['missing_ids'])
+        job.advance(chunks_unchanged=len(chunks) - len(missing_ids))
+        return [chunk for chunk in chunks if chunk['id'] in missing_ids]
+
+    async def _pages(self, path: str):
+        """The document's pages, timing how long each one took to load, not counting the time the caller held it."""
+        start = time.perf_counter()
+        async for document in self._parse(path):
+            INGEST_SECONDS.observe(time.perf_counter() - start, stage="load")
+            yield document
+            start = time.perf_counter()
+
+    async def _parse(self, path: str):
+        if self.parser is not None:
+            async for document in self.parser.iter_pages(path):
+                yield document
+            return
+        pages = await asyncio.to_thread(self.loader.lazy_load_document, path)
+        # Parse one page at a time, so memory does not grow with the document
+        while (document := await asyncio.to_thread(next, pages, None)) is not None:
+            yield document
+
+    def _split_page(self, document, document_name: str) -> List[Dict[str, Any]]:
+        document.metadata['source'] = document_name
+        with INGEST_SECONDS.time(stage="split"):
+            return self.splitter.split_document(document)
+
+    async def _embed(self, job, embed_queue: asyncio.Queue, store_queue: asyncio.Queue):
+        while True:
+            chunks = await embed_queue.get()
+            if chunks is None:
+                await store_queue.put(None)
+                return
+            if isinstance(chunks, dict):
+                await store_queue.put(chunks)
+                continue
+            with INGEST_SECONDS.time(stage="embed"):
+                embedded_chunks = await self.embedder.embed_documents(chunks)
+            job.advance(chunks_embedded=len(embedded_chunks))
+            await store_queue.put(embedded_chunks)
+
+    async def _store(self, job, store_queue: asyncio.Queue):
+        while True:
+            embedded_chunks = await store_queue.get()
+            if embedded_chunks is None:
+                return
+            if isinstance(embedded_chunks, dict):
+                await self.storage.record_document(passphrase=job.passphrase, keep_until=job.keep_until, **embedded_chunks)
+                continue
+            with INGEST_SECONDS.time(stage="store"):
+                await self.storage.store_embeddings(
+                    passphrase=job.passphrase,
+                    documents=embedded_chunks,
+                    keep_until=job.keep_until
+                )
+            if job.first_chunk_stored_at is None:
+                job.first_chunk_stored_at = dt.datetime.now()
+                INGEST_SECONDS.observe(job.seconds_to_first_stored_chunk, stage="first_stored_chunk")
+                logger.info(f"Job {job.id} stored its first chunks {job.seconds_to_first_stored_chunk:.2f}s after it started")
+            job.advance(chunks_stored=len(embedded_chunks))
+
+    def _remove_files(self, job):
+        for file in job.files:
+            if os.path.exists(file['path']):
+                os.remove(file['path'])
+        directories = {os.path.dirname(file['path']) for file in job.files}
+        for directory in directories:
+            if os.path.isdir(directory) and not os.listdir(directory):
+                os.rmdir(directory)
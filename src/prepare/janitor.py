@@ -0,0 +1,55 @@
+from typing import Dict, Any, Optional
+import asyncio
+import datetime as dt
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Janitor:
+    """
+    Background task that deletes expired chunks every interval_seconds.
+
+    Chunks expire by their Cosmos ttl, which costs no request units of ours; the
+    janitor removes whatever is past keep_until without having expired that way, so
+    request handlers never have to clean up inline. stats adds up what every run
+    removed and spent.
+    """
+    def __init__(self, storage, interval_seconds: float = 300):
+        """
+        :param storage: prepare.store.Store
+        """
+        self.storage = storage
+        self.interval_seconds = interval_seconds
+        self.stats = {"runs": 0, "items_removed": 0, "request_charge": 0.0, "last_run": None}
+        self.task: Optional[asyncio.Task] = None
+        self.lock = asyncio.Lock()
+
+    async def start(self):
+        self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def run_once(self) -> Dict[str, Any]:
+        """Delete expired chunks now. :return: Delete report of this run"""
+        # A run requested through the API does not overlap a scheduled one
+        async with self.lock:
+            report = await self.storage.delete_documents_older_than(current_time=dt.datetime.now())
+        self.stats["runs"] += 1
+        self.stats["items_removed"] += report["items"]
+        self.stats["request_charge"] += report["request_charge"]
+        self.stats["last_run"] = dt.datetime.now().isoformat()
+        logger.info(f"Janitor removed {report['items']} expired items for {report['request_charge']:.2f} RU")
+        return report
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Janitor run failed: {e}")
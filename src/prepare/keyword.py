@@ -0,0 +1,338 @@
+from prepare.index import PartitionSync, expiry_timestamp, extended_fields, payload
+from collections import Counter
+from typing import List, Dict, Any, Optional, Tuple
+import asyncio
+import re
+import threading
+import time
+import numpy as np
+
+# Words, and codes like "PN-4821/B" or "v2.3.1" kept whole
+TOKEN = re.compile(r"[^\W_]+(?:[-_./:#][^\W_]+)*")
+CODE_SEPARATOR = re.compile(r"[-_./:#]")
+# Words that occur in nearly every question or chunk; a match on them says nothing about relevance
+STOPWORDS = frozenset("""
+a about above after all also am an and any are as at be because been before being between both but by can could
+did do does doing down during each few for from further had has have having he her here hers him his how i if in
+into is it its itself just me more most my no nor not now of off on once only or other our ours out over own please
+same she should so some such than that the their theirs them then there these they this those through to too under
+until up very was we were what when where which while who whom why will with would you your yours
+""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased terms of a text without stopwords; a code is indexed whole and by each of its parts."""
+    terms = []
+    for match in TOKEN.finditer(text.lower()):
+        term = match.group()
+        # Only codes have characters other than letters and digits
+        if term.isalnum():
+            if term not in STOPWORDS:
+                terms.append(term)
+        else:
+            terms.append(term)
+            terms.extend(CODE_SEPARATOR.split(term))
+    return terms
+
+
+class InvertedIndex:
+    """
+    BM25 keyword index over the chunks of one partition.
+
+    Every term has a postings list of (row, term frequency) held in two numpy arrays
+    that grow by doubling, so adding a chunk appends to the lists of its terms instead
+    of rebuilding them. Deletes tombstone the row and take it out of the document
+    frequencies and the length total right away, so scores stay exact; the postings
+    are compacted once tombstones pass a third of the rows.
+    """
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.size = 0
+        self.alive = np.zeros(0, dtype=bool)
+        self.keep_until = np.zeros(0, dtype=np.float64)
+        self.lengths = np.zeros(0, dtype=np.float32)
+        self.ids: List[Optional[str]] = []
+        self.payloads: List[Optional[Dict[str, Any]]] = []
+        # Term ids of each row, to update document frequencies when it is removed
+        self.row_terms: List[Optional[np.ndarray]] = []
+        self.rows: Dict[str, int] = {}
+        self.tombstones = 0
+        self.total_length = 0.0
+        self.terms: Dict[str, int] = {}
+        self.document_frequency = np.zeros(0, dtype=np.int32)
+        self.posting_rows: List[np.ndarray] = []
+        self.posting_counts: List[np.ndarray] = []
+        self.posting_sizes: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def nbytes(self) -> int:
+        """Bytes held by the postings and row arrays, without the payloads."""
+        postings = sum(rows.nbytes + counts.nbytes for rows, counts in zip(self.posting_rows, self.posting_counts))
+        row_terms = sum(terms.nbytes for terms in self.row_terms if terms is not None)
+        return postings + row_terms + self.alive.nbytes + self.keep_until.nbytes + self.lengths.nbytes
+
+    def add(self, ids: List[str], texts: List[str], keep_until: np.ndarray, payloads: List[Dict[str, Any]]):
+        """
+        Insert or replace chunks.
+
+        :param ids: Item ids; an id already in the index replaces the old row
+        :param texts: Text of each chunk
+        :param keep_until: Expiry of each row in epoch seconds
+        :param payloads: Fields returned with a hit, one dict per row
+        """
+        self.remove([item_id for item_id in ids if item_id in self.rows], compact=False)
+        self._reserve_rows(self.size + len(ids))
+        batch_terms, batch_rows, batch_counts = [], [], []
+        for item_id, text, expiry, item_payload in zip(ids, texts, keep_until, payloads):
+            row = self.size
+            counts = Counter(tokenize(text))
+            term_ids = np.fromiter((self._term_id(term) for term in counts), dtype=np.int32, count=len(counts))
+            batch_terms.append(term_ids)
+            batch_rows.append(np.full(len(term_ids), row, dtype=np.int32))
+            batch_counts.append(np.fromiter(counts.values(), dtype=np.int64, count=len(counts)))
+            length = sum(counts.values())
+            self.alive[row] = True
+            self.keep_until[row] = expiry
+            self.lengths[row] = length
+            self.total_length += length
+            self.ids.append(item_id)
+            self.payloads.append(item_payload)
+            self.row_terms.append(term_ids)
+            self.rows[item_id] = row
+            self.size += 1
+        if batch_terms:
+            self._append_postings(np.concatenate(batch_terms), np.concatenate(batch_rows), np.concatenate(batch_counts))
+
+    def remove(self, ids: List[str], compact: bool = True):
+        """Tombstone rows by id; unknown ids are ignored."""
+        for item_id in ids:
+            row = self.rows.pop(item_id, None)
+            if row is not None:
+                self.alive[row] = False
+                self.document_frequency[self.row_terms[row]] -= 1
+                self.total_length -= float(self.lengths[row])
+                self.ids[row] = None
+                self.payloads[row] = None
+                self.row_terms[row] = None
+                self.tombstones += 1
+        if compact and self.tombstones > self.size / 3:
+            self.compact()
+
+    def update(self, ids: List[str], keep_until: List[float], fields: List[Dict[str, Any]]):
+        """Set the expiry and payload fields of rows by id; unknown ids are ignored."""
+        for item_id, expiry, item_fields in zip(ids, keep_until, fields):
+            row = self.rows.get(item_id)
+            if row is not None:
+                self.keep_until[row] = expiry
+                self.payloads[row] = {**self.payloads[row], **item_fields}
+
+    def compact(self):
+        """Drop tombstoned rows from the postings, and terms no live row has."""
+        live = np.flatnonzero(self.alive[:self.size])
+        new_rows = np.full(self.size, -1, dtype=np.int32)
+        new_rows[live] = np.arange(len(live), dtype=np.int32)
+        kept_terms = [term for term, term_id in self.terms.items() if self.document_frequency[term_id] > 0]
+        new_term_ids = np.full(len(self.terms), -1, dtype=np.int32)
+        posting_rows, posting_counts, posting_sizes = [], [], []
+        for new_term_id, term in enumerate(kept_terms):
+            term_id = self.terms[term]
+            new_term_ids[term_id] = new_term_id
+            size = self.posting_sizes[term_id]
+            rows = self.posting_rows[term_id][:size]
+            keep = self.alive[rows]
+            posting_rows.append(new_rows[rows[keep]])
+            posting_counts.append(self.posting_counts[term_id][:size][keep])
+            posting_sizes.append(int(keep.sum()))
+        self.document_frequency = self.document_frequency[[self.terms[term] for term in kept_terms]]
+        self.terms = {term: term_id for term_id, term in enumerate(kept_terms)}
+        self.posting_rows, self.posting_counts, self.posting_sizes = posting_rows, posting_counts, posting_sizes
+        self.alive = np.ones(len(live), dtype=bool)
+        self.keep_until = self.keep_until[live]
+        self.lengths = self.lengths[live]
+        self.ids = [self.ids[row] for row in live]
+        self.payloads = [self.payloads[row] for row in live]
+        self.row_terms = [new_term_ids[self.row_terms[row]] for row in live]
+        self.rows = {item_id: row for row, item_id in enumerate(self.ids)}
+        self.size = len(live)
+        self.tombstones = 0
+
+    def search(self, terms: List[str], top_k: int, now: float, min_coverage: float = 0.0) -> List[Tuple[int, float]]:
+        """
+        Rank live, unexpired rows containing any of the terms by BM25.
+
+        :param min_coverage: Fraction of the query terms' total IDF a row's matched terms
+            must reach. Terms no row has count at the highest IDF, so a row sharing only a
+            common word or two with a question about something else is not a hit.
+        :return: List of (row, score), best first
+        """
+        count = len(self.rows)
+        if count == 0:
+            return []
+        average_length = max(self.total_length / count, 1e-6)
+        unknown_idf = np.log1p((count + 0.5) / 0.5)
+        query_idf = 0.0
+        rows, weights, idfs = [], [], []
+        for term in set(terms):
+            term_id = self.terms.get(term)
+            if term_id is None or self.document_frequency[term_id] == 0:
+                query_idf += unknown_idf
+                continue
+            size = self.posting_sizes[term_id]
+            term_rows = self.posting_rows[term_id][:size]
+            frequency = self.posting_counts[term_id][:size].astype(np.float32)
+            document_frequency = self.document_frequency[term_id]
+            idf = np.log1p((count - document_frequency + 0.5) / (document_frequency + 0.5))
+            query_idf += idf
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[term_rows] / average_length)
+            rows.append(term_rows)
+            weights.append(idf * frequency * (self.k1 + 1) / (frequency + norm))
+            idfs.append(np.full(size, idf))
+        if not rows:
+            return []
+        rows = np.concatenate(rows)
+        scores = np.bincount(rows, weights=np.concatenate(weights), minlength=self.size)
+        candidates = np.flatnonzero(scores > 0)
+        candidates = candidates[self.alive[candidates] & (self.keep_until[candidates] > now)]
+        if min_coverage > 0:
+            matched = np.bincount(rows, weights=np.concatenate(idfs), minlength=self.size)
+            candidates = candidates[matched[candidates] >= min_coverage * query_idf]
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [(int(row), float(scores[row])) for row in candidates]
+
+    def _term_id(self, term: str) -> int:
+        term_id = self.terms.get(term)
+        if term_id is None:
+            term_id = self.terms[term] = len(self.terms)
+            self.posting_rows.append(np.zeros(4, dtype=np.int32))
+            self.posting_counts.append(np.zeros(4, dtype=np.uint16))
+            self.posting_sizes.append(0)
+            if term_id >= len(self.document_frequency):
+                self.document_frequency = np.concatenate([
+                    self.document_frequency, np.zeros(max(term_id + 1, len(self.document_frequency)), dtype=np.int32)
+                ])
+        return term_id
+
+    def _append_postings(self, term_ids: np.ndarray, rows: np.ndarray, counts: np.ndarray):
+        """Append (row, count) pairs to the postings of their terms, one block per term."""
+        self.document_frequency += np.bincount(term_ids, minlength=len(self.document_frequency)).astype(np.int32)
+        order = np.argsort(term_ids, kind="stable")
+        term_ids, rows = term_ids[order], rows[order]
+        counts = np.minimum(counts[order], np.iinfo(np.uint16).max).astype(np.uint16)
+        starts = np.flatnonzero(np.diff(term_ids, prepend=-1))
+        ends = np.append(starts[1:], len(term_ids))
+        for term_id, start, end in zip(term_ids[starts].tolist(), starts.tolist(), ends.tolist()):
+            size = self.posting_sizes[term_id]
+            new_size = size + end - start
+            capacity = len(self.posting_rows[term_id])
+            if new_size > capacity:
+                grow = max(new_size, 2 * capacity) - capacity
+                self.posting_rows[term_id] = np.concatenate([self.posting_rows[term_id], np.zeros(grow, dtype=np.int32)])
+                self.posting_counts[term_id] = np.concatenate([self.posting_counts[term_id], np.zeros(grow, dtype=np.uint16)])
+            self.posting_rows[term_id][size:new_size] = rows[start:end]
+            self.posting_counts[term_id][size:new_size] = counts[start:end]
+            self.posting_sizes[term_id] = new_size
+
+    def _reserve_rows(self, capacity: int):
+        if capacity <= len(self.alive):
+            return
+        grow = max(capacity, 2 * len(self.alive), 64) - len(self.alive)
+        self.alive = np.concatenate([self.alive, np.zeros(grow, dtype=bool)])
+        self.keep_until = np.concatenate([self.keep_until, np.zeros(grow, dtype=np.float64)])
+        self.lengths = np.concatenate([self.lengths, np.zeros(grow, dtype=np.float32)])
+
+
+class KeywordBackend(PartitionSync):
+    """
+    BM25 keyword search over in-process inverted indexes, one per passphrase.
+
+    Loaded from Cosmos and kept current like the vector backends, but it only reads
+    the chunks' text, never their embeddings. Retrieve fuses its results with the
+    vector backend's, so searches for exact part numbers and codes find the chunks
+    that contain them even when their embeddings are not the closest. A chunk must
+    match min_coverage of the question's IDF weight (see InvertedIndex.search), so
+    questions the documents do not cover get no keyword hits either.
+    """
+    fields = "c.id, c.content, c.document_name, c.page, c.metadata, c.keep_until, c._ts"
+    condition = "IS_DEFINED(c.content)"
+
+    def __init__(
+        self,
+        container,
+        refresh_seconds: float = 30,
+        reload_seconds: float = 600,
+        min_coverage: float = 0.4,
+        max_partitions: int = 1024,
+        idle_seconds: float = 3600
+    ):
+        super().__init__(container, refresh_seconds, reload_seconds, max_partitions, idle_seconds)
+        self.min_coverage = min_coverage
+        self.partitions: Dict[str, InvertedIndex] = {}
+        # Searches and updates run in worker threads
+        self.lock = threading.Lock()
+
+    async def keyword_search(self, passphrase_hash: str, query_text: str, top_k: int) -> List[Dict[str, Any]]:
+        """
+        :return: Up to top_k dicts with content, document_name, page, keep_until and keyword_score,
+            best first, only for unexpired chunks matching min_coverage of the query's terms
+        """
+        await self._sync(passphrase_hash)
+        return await asyncio.to_thread(self.search_partition, passphrase_hash, tokenize(query_text), top_k, 0.0, time.time())
+
+    async def keyword_search_many(self, passphrase_hash: str, query_texts: List[str], top_k: int) -> List[List[Dict[str, Any]]]:
+        """keyword_search for several queries of one partition, in one worker thread hop."""
+        if not query_texts:
+            return []
+        await self._sync(passphrase_hash)
+        now = time.time()
+
+        def search_all():
+            return [self.search_partition(passphrase_hash, tokenize(text), top_k, 0.0, now) for text in query_texts]
+
+        return await asyncio.to_thread(search_all)
+
+    def search_partition(self, passphrase_hash: str, query: List[str], top_k: int, threshold: float, now: float) -> List[Dict[str, Any]]:
+        with self.lock:
+            index = self.partitions.get(passphrase_hash)
+            if index is None:
+                return []
+            hits = index.search(query, top_k, now, self.min_coverage)
+            return [{**index.payloads[row], 'keyword_score': score} for row, score in hits if score > threshold]
+
+    def clear(self, passphrase_hash: str):
+        with self.lock:
+            self.partitions.pop(passphrase_hash, None)
+
+    def remove_items(self, passphrase_hash: str, ids: List[str]):
+        with self.lock:
+            index = self.partitions.get(passphrase_hash)
+            if index is not None:
+                index.remove(ids)
+
+    def extend_items(self, passphrase_hash: str, items: List[Dict[str, Any]]):
+        keep_until = [expiry_timestamp(item['keep_until']) for item in items]
+        with self.lock:
+            index = self.partitions.get(passphrase_hash)
+            if index is not None:
+                index.update([item['id'] for item in items], keep_until, [extended_fields(item) for item in items])
+
+    def add_items(self, passphrase_hash: str, items: List[Dict[str, Any]]):
+        if not items:
+            return
+        keep_until = np.array([expiry_timestamp(item['keep_until']) for item in items])
+        with self.lock:
+            index = self.partitions.setdefault(passphrase_hash, InvertedIndex())
+            index.add(
+                ids=[item['id'] for item in items],
+                texts=[item['content'] for item in items],
+                keep_until=keep_until,
+                payloads=[payload(item) for item in items]
+            )
+
+    @staticmethod
+    def _decode(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [item for item in items if item.get('content')]
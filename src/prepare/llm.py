@@ -1,77 +1,110 @@
-from langchain_openai import AzureChatOpenAI
-from langchain.schema import SystemMessage, HumanMessage, AIMessage
-from typing import List, Dict, Any, AsyncGenerator
+from prepare.context import format_context
+from prepare.metrics import LLM_TOKENS, log_event
+from prepare.tokens import count_tokens
+from typing import List, Dict, Any, AsyncGenerator, Optional, TYPE_CHECKING
+import logging
 import os
-from langchain.callbacks.base import BaseCallbackHandler
-import asyncio
 
-class StreamingCallbackHandler(BaseCallbackHandler):
-    def __init__(self):
-        self.content = ""
+logger = logging.getLogger(__name__)
 
-    def on_llm_new_token(self, token: str, **kwargs):
-        """
-        Callback handler to process each new token generated during streaming.
-        This will be called for each token received from the streaming response.
-        """
-        self.content += token
-        print(token, end="", flush=True)  # Optionally print to console, remove if not needed
+if TYPE_CHECKING:
+    from langchain_core.messages import BaseMessage
+    from langchain_openai import AzureChatOpenAI
+
+
+def create_chat_model(deployment: str = "gpt-35-turbo") -> "AzureChatOpenAI":
+    """
+    Build a streaming chat model from the LLM_* environment variables.
+
+    The model owns the HTTP client and its connection pool; share one instance
+    between LLMs instead of creating one per prompt. langchain_openai is imported
+    here, on first use, as it takes about a second.
+    """
+    from langchain_openai import AzureChatOpenAI
+    return AzureChatOpenAI(
+        streaming=True,  # Enable streaming responses
+        deployment_name=deployment,
+        openai_api_version=os.getenv("LLM_OPENAI_API_VERSION"),
+        azure_endpoint=os.getenv("LLM_OPENAI_API_BASE"),
+        openai_api_key=os.getenv("LLM_OPENAI_API_KEY"),
+        max_tokens=2048
+    )
 
 
 class LLM:
-    def __init__(self, system_prompt: str, deployment: str = "gpt-35-turbo"):
-        # Initialize the AzureChatOpenAI model with streaming enabled
-        self.llm = AzureChatOpenAI(
-            stream=True,  # Enable streaming responses
-            deployment_name=deployment,
-            openai_api_version=os.getenv("LLM_OPENAI_API_VERSION"),
-            azure_endpoint=os.getenv("LLM_OPENAI_API_BASE"),
-            openai_api_key=os.getenv("LLM_OPENAI_API_KEY"),
-            max_tokens=2048
-        )
+    def __init__(
+        self,
+        system_prompt: str,
+        deployment: str = "gpt-35-turbo",
+        llm: Optional["AzureChatOpenAI"] = None,
+        max_history_messages: int = 10
+    ):
+        """
+        :param system_prompt: System message sent with every question
+        :param deployment: Chat deployment, used when no llm is given
+        :param llm: Chat model to share with other LLMs, created from the environment when not given
+        :param max_history_messages: Most recent history messages sent along with a question
+
+        An LLM holds no per-conversation state, so one instance can serve any number of
+        concurrent requests; each request passes its own history.
+        """
+        self.llm = llm or create_chat_model(deployment)
         self.system_prompt = system_prompt
-        self.conversation_history = []
+        self.max_history_messages = max_history_messages
 
-    async def generate_response(self, question: str, context: List[Dict[str, Any]]) -> AsyncGenerator[str, None]:
+    async def generate_response(
+        self,
+        question: str,
+        context: List[Dict[str, Any]],
+        history: Optional[List["BaseMessage"]] = None
+    ) -> AsyncGenerator[str, None]:
         """
         Generates an AI response using the LLM model with the provided question and context.
         :param question: The user's question
         :param context: List of dictionaries containing the most similar content
+        :param history: Earlier messages of this conversation, oldest first; only the last
+            max_history_messages are sent
         :return: An async generator that yields chunks of the AI-generated response
         """
-        # Initialize the callback handler for streaming
-        callback_handler = StreamingCallbackHandler()
-
-        # Prepare the conversation with the system prompt, history, and provided context
+        from langchain_core.messages import SystemMessage, HumanMessage
         # Inject the context into the user's question with a clear heading
-        injected_question = question + "\n" + "\n\n".join([f"Context: {ctx['content']}" for ctx in context])
-        conversation = [SystemMessage(content=self.system_prompt)] + [HumanMessage(content=injected_question)]
-        
-            
-        for message in conversation:
-            print('---')
-            print(message)
-
-        # Stream the response using the astream method
-        async for chunk in self.llm.astream(conversation):
-            # Optionally append the chunk to the conversation history for future context
-            self.conversation_history.append(AIMessage(content=chunk.content))
-            yield chunk.content  # Yield each chunk to the async generator
+        injected_question = question + "\n" + format_context(context)
+        recent_history = list(history or [])[-self.max_history_messages:] if self.max_history_messages > 0 else []
+        conversation = [SystemMessage(content=self.system_prompt)] + recent_history + [HumanMessage(content=injected_question)]
 
+        completion, usage = [], None
+        try:
+            # Stream the response using the astream method
+            async for chunk in self.llm.astream(conversation):
+                # Only sent when the model streams usage, in the last chunk
+                usage = getattr(chunk, 'usage_metadata', None) or usage
+                completion.append(chunk.content)
+                yield chunk.content
+        finally:
+            # Counted after the answer, even a cut-short one, so the first token is not delayed
+            if usage:
+                prompt_tokens, completion_tokens = usage['input_tokens'], usage['output_tokens']
+            else:
+                prompt_tokens = sum(count_tokens(message.content) for message in conversation)
+                completion_tokens = count_tokens("".join(completion)) if completion else 0
+            LLM_TOKENS.inc(prompt_tokens, type="prompt")
+            LLM_TOKENS.inc(completion_tokens, type="completion")
+            log_event(logger, "generate", prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                      history_messages=len(recent_history), context_passages=len(context))
 
-    def clear_conversation_history(self):
-        """Clear the conversation history."""
-        self.conversation_history = []
+    async def warm_up(self, timeout: float = 5.0):
+        """Open a pooled connection to the chat endpoint with a request that costs no tokens."""
+        client = getattr(self.llm, 'root_async_client', None)
+        if client is None:
+            return
+        try:
+            await client.with_options(max_retries=0, timeout=timeout).models.list()
+        except Exception as e:
+            logger.info(f"Chat endpoint warm-up request failed: {e}")
 
     def set_deployment(self, deployment: str):
         """Update the LLM model deployment."""
-        self.llm = AzureChatOpenAI(
-            deployment_name=deployment,
-            openai_api_version=os.getenv("LLM_OPENAI_API_VERSION"),
-            azure_endpoint=os.getenv("LLM_OPENAI_API_BASE"),
-            openai_api_key=os.getenv("LLM_OPENAI_API_KEY"),
-            max_tokens=2048
-        )
+        self.llm = create_chat_model(deployment)
 
     def set_system_prompt(self, prompt: str):
         """Update the system prompt."""
@@ -1,34 +1,51 @@
-from langchain_community.document_loaders import (
-    PyPDFLoader,
-    TextLoader,
-    CSVLoader,
-    UnstructuredWordDocumentLoader,
-    UnstructuredPowerPointLoader,
-    UnstructuredExcelLoader
-)
-from typing import List
+from typing import List, Iterator
+import importlib
+
+# Loader class per extension, imported from langchain_community.document_loaders the
+# first time a file of that extension is loaded; importing them all costs about a second
+LOADERS = {
+    'pdf': 'PyPDFLoader',
+    'txt': 'TextLoader',
+    'csv': 'CSVLoader',
+    'doc': 'UnstructuredWordDocumentLoader',
+    'docx': 'UnstructuredWordDocumentLoader',
+    'ppt': 'UnstructuredPowerPointLoader',
+    'pptx': 'UnstructuredPowerPointLoader',
+    'xls': 'UnstructuredExcelLoader',
+    'xlsx': 'UnstructuredExcelLoader'
+}
 
 class Load:
     def __init__(self):
-        self.loaders = {
-            'pdf': PyPDFLoader,
-            'txt': TextLoader,
-            'csv': CSVLoader,
-            'doc': UnstructuredWordDocumentLoader,
-            'docx': UnstructuredWordDocumentLoader,
-            'ppt': UnstructuredPowerPointLoader,
-            'pptx': UnstructuredPowerPointLoader,
-            'xls': UnstructuredExcelLoader,
-            'xlsx': UnstructuredExcelLoader
-        }
+        # Names of langchain_community loaders until they are first used, then their classes
+        self.loaders = dict(LOADERS)
 
-    def load_document(self, file_path: str) -> List:
+    def loader_class(self, file_path: str):
+        """The loader class registered for the file's extension."""
         file_extension = file_path.split('.')[-1].lower()
         if file_extension not in self.loaders:
             raise ValueError(f"Unsupported file type: {file_extension}")
+        loader = self.loaders[file_extension]
+        if isinstance(loader, str):
+            loader = getattr(importlib.import_module("langchain_community.document_loaders"), loader)
+            self.loaders[file_extension] = loader
+        return loader
+
+    def loader_name(self, file_path: str) -> str:
+        """Name of the file's loader class, without importing it."""
+        loader = self.loaders.get(file_path.split('.')[-1].lower())
+        return loader if isinstance(loader, str) or loader is None else loader.__name__
+
+    def load_document(self, file_path: str) -> List:
+        return self.loader_class(file_path)(file_path).load()
+
+    def lazy_load_document(self, file_path: str) -> Iterator:
+        """
+        Yield the document's pages (or other loader units) one at a time as they are parsed.
 
-        loader = self.loaders[file_extension](file_path)
-        return loader.load()
+        :param file_path: Path of the file; its extension selects the loader
+        """
+        return self.loader_class(file_path)(file_path).lazy_load()
 
     def add_loader(self, file_extension: str, loader_class):
-        self.loaders[file_extension.lower()] = loader_class
\ No newline at end of file
+        self.loaders[file_extension.lower()] = loader_class
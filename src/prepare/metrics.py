@@ -0,0 +1,183 @@
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Tuple
+import bisect
+import json
+import logging
+import math
+import threading
+import time
+
+# Seconds, from a cached lookup to a long answer
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    """:return: '{stage="load",le="0.5"}', or "" without labels"""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def log_event(logger: logging.Logger, event: str, **fields):
+    """
+    Log an event as one JSON object at debug level.
+
+    Nothing is formatted unless debug logging is on (LOG_LEVEL=DEBUG), so call sites
+    cost a level check in production.
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(json.dumps({"event": event, **fields}, default=str))
+
+
+class Counter:
+    """A value per label combination that only goes up."""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+        # Observed from the event loop and from worker threads
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def samples(self) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        with self.lock:
+            values = dict(self.values)
+        for key, value in values.items():
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Histogram:
+    """Counts of observations per bucket, with their sum, per label combination."""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label combination: count per bucket (the last one is +Inf), sum of values
+        self.values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bucket] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        with self.lock:
+            values = {key: (list(counts), total[0]) for key, (counts, total) in self.values.items()}
+        for key, (counts, total) in values.items():
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": format_value(bound)}, cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+
+class Callback:
+    """A metric read from somewhere else, such as a cache's stats, when it is collected."""
+    def __init__(self, name: str, kind: str, documentation: str, labelnames: Tuple[str, ...],
+                 read: Callable[[], Dict[Tuple[str, ...], float]]):
+        """
+        :param kind: "counter" or "gauge"
+        :param read: Returns the current value per tuple of label values
+        """
+        self.name = name
+        self.kind = kind
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.read = read
+
+    def samples(self) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        for key, value in self.read().items():
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Registry:
+    """
+    Metrics of this process, rendered in the Prometheus text exposition format.
+
+    Every worker process has its own registry; Prometheus scrapes each worker, or
+    sums them when they sit behind one address.
+    """
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """Add a metric, replacing one registered earlier under its name."""
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name: str, kind: str, documentation: str, labelnames: Tuple[str, ...],
+                 read: Callable[[], Dict[Tuple[str, ...], float]]) -> Callback:
+        return self.register(Callback(name, kind, documentation, labelnames, read))
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+INGEST_SECONDS = REGISTRY.histogram(
+    "rag_ingest_seconds",
+    "Upload pipeline stage durations: load and split per page, embed and store per batch, "
+    "first_stored_chunk per job",
+    ("stage",)
+)
+ASK_SECONDS = REGISTRY.histogram(
+    "rag_ask_seconds",
+    "Durations of /ask stages as in its Server-Timing, including first-token and total stream time",
+    ("stage",)
+)
+COSMOS_REQUEST_UNITS = REGISTRY.counter(
+    "rag_cosmos_request_units_total", "Request units charged by Cosmos DB", ("operation",)
+)
+EMBEDDING_TOKENS = REGISTRY.counter("rag_embedding_tokens_total", "Tokens sent to the embedding deployment")
+LLM_TOKENS = REGISTRY.counter("rag_llm_tokens_total", "Chat tokens by type, prompt or completion", ("type",))
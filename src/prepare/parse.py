@@ -0,0 +1,184 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Dict, Any, Tuple, AsyncIterator, Optional, TYPE_CHECKING
+from collections import deque
+import asyncio
+import logging
+import multiprocessing
+import os
+
+logger = logging.getLogger(__name__)
+
+# How long a task may run past its timeout, stuck where the alarm cannot interrupt it, before its worker exits
+KILL_GRACE_SECONDS = 30
+
+if TYPE_CHECKING:
+    from langchain_core.documents import Document
+
+
+class ParseError(Exception):
+    """A document could not be parsed: it is malformed, took too long or needed too much memory."""
+
+
+class _TaskTimeout(BaseException):
+    """Raised in a worker when its task overruns the timeout; a BaseException, so parsers' except Exception do not swallow it."""
+
+
+# Worker-side functions; they run in the pool's processes and return plain tuples
+
+def _limit_memory(max_memory_bytes: Optional[int]):
+    if max_memory_bytes:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory_bytes, max_memory_bytes))
+
+
+def _on_alarm(signum, frame):
+    raise _TaskTimeout()
+
+
+def _with_deadline(timeout: float, function, *args):
+    """Run function in this worker, raising _TaskTimeout once it has run for timeout seconds."""
+    import faulthandler
+    import signal
+    signal.signal(signal.SIGALRM, _on_alarm)
+    # The alarm only interrupts Python code; a task stuck in C code ends the process instead
+    faulthandler.dump_traceback_later(timeout + KILL_GRACE_SECONDS, exit=True)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return function(*args)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        faulthandler.cancel_dump_traceback_later()
+
+
+def _count_pdf_pages(file_path: str) -> int:
+    import pypdf
+    return len(pypdf.PdfReader(file_path).pages)
+
+
+def _parse_pdf_pages(file_path: str, start: int, stop: int) -> List[Tuple[str, Dict[str, Any]]]:
+    # Same text and metadata as PyPDFLoader, for a range of pages only
+    import pypdf
+    reader = pypdf.PdfReader(file_path)
+    return [(reader.pages[page].extract_text(), {"source": file_path, "page": page}) for page in range(start, stop)]
+
+
+def _parse_file(loader_class, file_path: str) -> List[Tuple[str, Dict[str, Any]]]:
+    return [(document.page_content, document.metadata) for document in loader_class(file_path).lazy_load()]
+
+
+class ParserPool:
+    """
+    Parse documents in worker processes instead of the API process.
+
+    PDFs are split into ranges of pages_per_task pages parsed in parallel, up to one
+    range per worker in flight, and yielded in page order. Other formats are parsed
+    whole by their Load loader in one worker.
+
+    Each task, a range of pages or a whole file, must finish within timeout seconds of
+    starting to run in a worker. The worker enforces this itself with an alarm, so time
+    spent queued behind other tasks, or while the caller is not consuming pages, does
+    not count, and an overdue task frees its worker without touching other files' tasks.
+    A task stuck where the alarm cannot interrupt it ends its worker KILL_GRACE_SECONDS
+    later. Workers run with an address-space limit of max_memory_bytes. A crashed
+    worker restarts the pool; tasks of other files caught in a restart are retried
+    once. Failures raise ParseError.
+    """
+    def __init__(
+        self,
+        loader,
+        workers: int = 2,
+        timeout: float = 300,
+        max_memory_bytes: Optional[int] = 2 << 30,
+        pages_per_task: int = 8
+    ):
+        """
+        :param loader: prepare.load.Load, which chooses the loader for each file type
+        """
+        self.loader = loader
+        self.workers = workers
+        self.timeout = timeout
+        self.max_memory_bytes = max_memory_bytes
+        self.pages_per_task = pages_per_task
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            # Workers fork from a clean server process, not from the threaded API process
+            context = multiprocessing.get_context("forkserver")
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=context,
+                initializer=_limit_memory,
+                initargs=(self.max_memory_bytes,)
+            )
+        return self.executor
+
+    def _restart(self, executor: ProcessPoolExecutor):
+        if self.executor is not executor:
+            return
+        self.executor = None
+        # A hung worker cannot be cancelled, only killed
+        for process in list((executor._processes or {}).values()):
+            process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    async def stop(self):
+        if self.executor is not None:
+            executor, self.executor = self.executor, None
+            await asyncio.to_thread(executor.shutdown, wait=True, cancel_futures=True)
+
+    async def iter_pages(self, file_path: str) -> AsyncIterator["Document"]:
+        """
+        Yield the document's pages in order as the workers finish them.
+
+        :param file_path: Path of the file; its extension selects the loader
+        """
+        from langchain_core.documents import Document
+        # PDFs are read with pypdf in the workers; the API process never imports PyPDFLoader
+        if self.loader.loader_name(file_path) != "PyPDFLoader":
+            loader_class = self.loader.loader_class(file_path)
+            for text, metadata in await self._run(file_path, _parse_file, loader_class, file_path):
+                yield Document(page_content=text, metadata=metadata)
+            return
+
+        page_count = await self._run(file_path, _count_pdf_pages, file_path)
+        pending = deque()
+        try:
+            for start in range(0, page_count, self.pages_per_task):
+                stop = min(start + self.pages_per_task, page_count)
+                pending.append(asyncio.ensure_future(self._run(file_path, _parse_pdf_pages, file_path, start, stop)))
+                if len(pending) < self.workers:
+                    continue
+                for text, metadata in await pending.popleft():
+                    yield Document(page_content=text, metadata=metadata)
+            while pending:
+                for text, metadata in await pending.popleft():
+                    yield Document(page_content=text, metadata=metadata)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _run(self, file_path: str, function, *args):
+        name = os.path.basename(file_path)
+        for attempt in range(2):
+            executor = self._executor()
+            # The worker starts the timeout clock when it starts running the task
+            waiter = asyncio.wrap_future(executor.submit(_with_deadline, self.timeout, function, *args))
+            try:
+                return await waiter
+            except _TaskTimeout:
+                raise ParseError(f"Parsing {name} took longer than {self.timeout:.0f}s")
+            except BrokenProcessPool:
+                self._restart(executor)
+                # The crash may have come from another file's task; give this one more try
+                if attempt:
+                    raise ParseError(f"The parser crashed on {name}")
+                logger.warning(f"Parser pool restarted while parsing {name}, retrying")
+            except MemoryError:
+                raise ParseError(f"Parsing {name} needed more than the parser's memory limit")
+            except asyncio.CancelledError:
+                waiter.cancel()
+                raise
+            except Exception as e:
+                raise ParseError(f"Could not parse {name}: {e}") from e
@@ -0,0 +1,125 @@
+import asyncio
+import time
+
+
+class RateLimiter:
+    """
+    Shared tokens-per-minute and requests-per-minute budget for async callers.
+
+    Both budgets refill continuously instead of resetting once a minute, so a
+    burst at the start of a window does not stall every caller for the rest of it.
+    All callers run on one event loop and nothing is awaited between checking and
+    spending the budget, so no lock is needed.
+    """
+    def __init__(self, tokens_per_minute: int, requests_per_minute: int):
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.available_tokens = float(tokens_per_minute)
+        self.available_requests = float(requests_per_minute)
+        self.last_refill = time.monotonic()
+
+    def _refill(self):
+        current_time = time.monotonic()
+        elapsed_time = current_time - self.last_refill
+        self.last_refill = current_time
+        self.available_tokens = min(
+            self.tokens_per_minute,
+            self.available_tokens + elapsed_time * self.tokens_per_minute / 60
+        )
+        self.available_requests = min(
+            self.requests_per_minute,
+            self.available_requests + elapsed_time * self.requests_per_minute / 60
+        )
+
+    async def acquire(self, tokens: int = 0, requests: int = 1):
+        """
+        Wait until the budget allows a call, then spend it.
+
+        :param tokens: Number of tokens the call will consume
+        :param requests: Number of requests the call counts as
+        """
+        # A single call larger than the whole budget would otherwise wait forever
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            self._refill()
+            if self.available_tokens >= tokens and self.available_requests >= requests:
+                self.available_tokens -= tokens
+                self.available_requests -= requests
+                return
+            sleep_time = max(
+                (tokens - self.available_tokens) * 60 / self.tokens_per_minute,
+                (requests - self.available_requests) * 60 / self.requests_per_minute,
+            )
+            await asyncio.sleep(sleep_time)
+
+
+class RequestUnitBudget:
+    """
+    Adaptive request-unit-per-second budget for Cosmos DB calls.
+
+    Callers reserve an estimated charge before a call and settle it with the real
+    x-ms-request-charge afterwards, so the budget tracks what the service actually
+    billed. Estimates per operation follow the observed charges. A 429 halves the
+    allowed rate, which then climbs back to the maximum over recovery_seconds.
+    """
+    def __init__(self, max_ru_per_second: float = 1000, min_ru_per_second: float = 50, recovery_seconds: float = 5.0):
+        self.max_ru_per_second = max_ru_per_second
+        self.min_ru_per_second = min_ru_per_second
+        self.recovery_seconds = recovery_seconds
+        self.ru_per_second = max_ru_per_second
+        self.available = float(max_ru_per_second)
+        self.last_refill = time.monotonic()
+        self.charge_estimates = {}
+
+    def _refill(self):
+        current_time = time.monotonic()
+        elapsed_time = current_time - self.last_refill
+        self.last_refill = current_time
+        self.ru_per_second = min(
+            self.max_ru_per_second,
+            self.ru_per_second + elapsed_time * self.max_ru_per_second / self.recovery_seconds
+        )
+        self.available = min(self.ru_per_second, self.available + elapsed_time * self.ru_per_second)
+
+    def estimate(self, operation: str, units: int = 1, default: float = 10.0) -> float:
+        """Expected charge of an operation covering `units` items."""
+        return self.charge_estimates.get(operation, default) * units
+
+    async def acquire(self, request_units: float) -> float:
+        """
+        Wait until the budget can cover the reserved request units, then spend them.
+
+        :return: The request units actually reserved, which settle and refund take back
+        """
+        while True:
+            self._refill()
+            # A single call larger than one second of budget would otherwise wait forever
+            reserved = min(request_units, self.ru_per_second)
+            if self.available >= reserved:
+                self.available -= reserved
+                return reserved
+            await asyncio.sleep((reserved - self.available) / self.ru_per_second)
+
+    def refund(self, reserved: float, charged: float):
+        """Replace a reservation with the real charge, without learning from it."""
+        self.available = min(self.ru_per_second, self.available + reserved - charged)
+
+    def settle(self, operation: str, reserved: float, charged: float, units: int = 1):
+        """
+        Replace a reservation with the real charge and learn from it.
+
+        :param operation: Name of the operation kind, e.g. 'batch_upsert'
+        :param reserved: Request units acquire() returned
+        :param charged: Request units reported by x-ms-request-charge
+        :param units: Number of items the call covered
+        """
+        self.refund(reserved, charged)
+        per_unit = charged / max(units, 1)
+        previous = self.charge_estimates.get(operation)
+        self.charge_estimates[operation] = per_unit if previous is None else 0.8 * previous + 0.2 * per_unit
+
+    def throttled(self):
+        """Back off after the service answered 429."""
+        self._refill()
+        self.ru_per_second = max(self.min_ru_per_second, self.ru_per_second / 2)
+        self.available = min(self.available, 0.0)
@@ -1,84 +1,379 @@
-from azure.cosmos import CosmosClient, PartitionKey
-from typing import List, Dict, Any
+from prepare.cosmos import QueryMetrics
+from prepare.metrics import log_event
+from abc import ABC, abstractmethod
+from typing import List, Dict, Any, Optional, Callable, Union, Awaitable
+import asyncio
 import hashlib
+import inspect
+import logging
 import os
 import time
 import numpy as np
 import datetime as dt
 
-class Retrieve:
-    def __init__(self):
-        cosmos_endpoint = os.getenv("COSMOS_ENDPOINT")
-        cosmos_key = os.getenv("COSMOS_KEY")
-        database_name = os.getenv("COSMOS_DATABASE_NAME")
-        container_name = os.getenv("COSMOS_CONTAINER_NAME")
-
-        client = CosmosClient(cosmos_endpoint, cosmos_key)
-        self.database = client.create_database_if_not_exists(id=database_name)
-        self.container = self.database.create_container_if_not_exists(
-            id=container_name, 
-            partition_key=PartitionKey(path="/passphrase_hash")
-        )
+logger = logging.getLogger(__name__)
+
+
+class RetrievalBackend(ABC):
+    """
+    Interface of the vector search backends Retrieve can delegate to.
+
+    Backends that keep their own copy of the vectors also receive Store's write and
+    delete notifications through on_store, on_extend and on_delete, which run in worker threads.
+    """
+    @abstractmethod
+    async def vector_search(
+        self, passphrase_hash: str, query_vector: List[float], top_k: int, threshold: float, with_embeddings: bool = False
+    ) -> List[Dict[str, Any]]:
+        """
+        :param with_embeddings: Also return each chunk's embedding, for re-ranking
+        :return: Up to top_k dicts with content, document_name, page, keep_until, similarity_score and,
+            when stored, the chunk's start_index and end_index in its page; most similar first, only
+            for unexpired chunks scoring above threshold
+        """
+
+    async def vector_search_many(
+        self, passphrase_hash: str, query_vectors: List[List[float]], top_k: int, threshold: float, with_embeddings: bool = False
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        vector_search for several queries of one partition, one result list per query.
+
+        A VectorDistance query ranks by one vector, so by default the searches run
+        concurrently; local backends score all queries in one pass.
+        """
+        return list(await asyncio.gather(*(
+            self.vector_search(passphrase_hash, query_vector, top_k, threshold, with_embeddings=with_embeddings)
+            for query_vector in query_vectors
+        )))
+
+    def on_store(self, passphrase_hash: str, items: List[Dict[str, Any]]):
+        """Called by Store after items were written."""
+
+    def on_extend(self, passphrase_hash: str, items: List[Dict[str, Any]]):
+        """Called by Store after stored items were patched with a new keep_until, page and metadata."""
+
+    def on_delete(self, passphrase_hash: str, ids: Optional[List[str]]):
+        """Called by Store after items were deleted; ids is None when the whole partition was."""
+
+
+class CosmosBackend(RetrievalBackend):
+    """
+    Vector search with VectorDistance queries against the Cosmos container.
+
+    The query vector, passphrase hash and time are sent as parameters rather than
+    pasted into the query text, the query stays within the passphrase's partition and
+    only the returned fields are projected. The similarity threshold is applied to the
+    ranked results here instead of in a second VectorDistance in the WHERE clause;
+    results are ordered by similarity, so the outcome is the same.
+    """
+    query = """
+        SELECT TOP @top_k
+            c.content,
+            c.document_name,
+            c.page,
+            c.keep_until,
+            c.metadata.start_index AS start_index,
+            c.metadata.end_index AS end_index,
+            VectorDistance(c.embedding, @embedding) AS similarity_score
+        FROM c
+        WHERE c.passphrase_hash = @hash
+        AND c.keep_until > @now
+        ORDER BY VectorDistance(c.embedding, @embedding)
+        """
+    # Embeddings make the response about 30 KB per chunk bigger, so they are only projected when asked for
+    embedding_query = query.replace("SELECT TOP @top_k", "SELECT TOP @top_k\n            c.embedding,")
+
+    def __init__(self, container, query_hook: Optional[Callable[[str, Dict[str, Any]], None]] = None):
+        """
+        :param container: Cosmos container holding the chunks
+        :param query_hook: Called after every query with its name and a QueryMetrics report
+            (request charge, server and client time, pages); logs at debug level by default
+        """
+        self.container = container
+        self.query_hook = query_hook or self._log_query
         self.max_ru_per_second = 1000
         self.last_request_time = time.time()
         self.consumed_ru = 0
-        self.default_ru = 5.0
 
-    def _hash_passphrase(self, passphrase: str) -> str:
-        return hashlib.sha256(passphrase.encode()).hexdigest()
-
-    def _rate_limit(self, consumed_ru: float):
+    async def _rate_limit(self, consumed_ru: float):
         self.consumed_ru += consumed_ru
         current_time = time.time()
         elapsed_time = current_time - self.last_request_time
 
         if elapsed_time < 1 and self.consumed_ru > self.max_ru_per_second:
             sleep_time = 1 - elapsed_time
-            time.sleep(sleep_time)
+            await asyncio.sleep(sleep_time)
             self.consumed_ru = 0
             self.last_request_time = time.time()
         elif elapsed_time >= 1:
             self.consumed_ru = 0
             self.last_request_time = current_time
 
-    def vector_search(self, passphrase: str, query_vector: List[float], top_k: int = 10) -> List[Dict[str, Any]]:
-        passphrase_hash = self._hash_passphrase(passphrase)
-        query_vector_str = str(query_vector).replace('[', '').replace(']', '')
-        print('******')
-        print('pass: ', passphrase)
-        print('hash: ', passphrase_hash)
-        query = f"""
-        SELECT TOP {top_k} 
-            c.content, 
-            c.document_name, 
-            c.page, 
-            VectorDistance(c.embedding, [{query_vector_str}]) AS similarity_score
-        FROM c
-        WHERE c.passphrase_hash = '{passphrase_hash}'
-        AND VectorDistance(c.embedding, [{query_vector_str}]) > 0.65
-        AND c.keep_until > '{dt.datetime.now().isoformat()}'
-        ORDER BY VectorDistance(c.embedding, [{query_vector_str}])
+    @staticmethod
+    def _log_query(name: str, report: Dict[str, Any]):
+        log_event(logger, "cosmos_query", query=name, **report)
+
+    async def vector_search(
+        self, passphrase_hash: str, query_vector: List[float], top_k: int, threshold: float, with_embeddings: bool = False
+    ) -> List[Dict[str, Any]]:
+        metrics = QueryMetrics("vector_search")
+        items = [item async for item in self.container.query_items(
+            query=self.embedding_query if with_embeddings else self.query,
+            parameters=[
+                {"name": "@top_k", "value": int(top_k)},
+                # Plain floats, so numpy scalars serialize as JSON numbers
+                {"name": "@embedding", "value": [float(value) for value in query_vector]},
+                {"name": "@hash", "value": passphrase_hash},
+                {"name": "@now", "value": dt.datetime.now().isoformat()},
+            ],
+            partition_key=passphrase_hash,
+            populate_query_metrics=True,
+            response_hook=metrics
+        )]
+        await self._rate_limit(metrics.request_charge)
+        self.query_hook("vector_search", metrics.to_dict())
+        return [item for item in items if item['similarity_score'] > threshold]
+
+
+def create_backend(name: str, container) -> RetrievalBackend:
+    """
+    Build the retrieval backend selected by name.
+
+    :param name: 'cosmos' (VectorDistance queries), 'ivf' (in-process IVF index) or
+        'exact' (memory-mapped matrices scanned in full)
+    :param container: azure.cosmos.aio container holding the chunks
+    """
+    if name == "cosmos":
+        return CosmosBackend(container)
+    if name == "ivf":
+        from prepare.index import IndexBackend
+        return IndexBackend(
+            container,
+            n_probe=int(os.getenv("IVF_N_PROBE", 16)),
+            refresh_seconds=float(os.getenv("INDEX_REFRESH_SECONDS", 30)),
+            max_partitions=int(os.getenv("INDEX_MAX_PARTITIONS", 1024)),
+            idle_seconds=float(os.getenv("INDEX_IDLE_SECONDS", 3600)),
+        )
+    if name == "exact":
+        from prepare.exact import MemmapBackend
+        return MemmapBackend(
+            container,
+            directory=os.getenv("VECTOR_DIRECTORY", "/tmp/vectors"),
+            refresh_seconds=float(os.getenv("INDEX_REFRESH_SECONDS", 30)),
+            encoding=os.getenv("VECTOR_INDEX_ENCODING", "float32"),
+            rescore_factor=int(os.getenv("VECTOR_RESCORE_FACTOR", 4)),
+            max_partitions=int(os.getenv("INDEX_MAX_PARTITIONS", 1024)),
+            idle_seconds=float(os.getenv("INDEX_IDLE_SECONDS", 3600)),
+        )
+    raise ValueError(f"Unsupported retrieval backend: {name}")
+
+
+def reciprocal_rank_fusion(result_lists: List[List[Dict[str, Any]]], top_k: int, k: int = 60) -> List[Dict[str, Any]]:
+    """
+    Merge ranked result lists into one by reciprocal rank.
+
+    A chunk scores the sum of 1 / (k + rank) over the lists it appears in, so chunks
+    ranked high by either list, or found by both, come first. Chunks are matched by
+    document_name, page and content; a chunk found by several lists keeps the fields
+    of all of them, such as similarity_score and keyword_score.
+
+    :return: Up to top_k results with an added rrf_score, best first
+    """
+    fused: Dict[tuple, Dict[str, Any]] = {}
+    for results in result_lists:
+        for rank, item in enumerate(results, start=1):
+            key = (item['document_name'], item['page'], item['content'])
+            entry = fused.setdefault(key, {'rrf_score': 0.0})
+            for field, value in item.items():
+                entry.setdefault(field, value)
+            entry['rrf_score'] += 1 / (k + rank)
+    return sorted(fused.values(), key=lambda item: -item['rrf_score'])[:top_k]
+
+
+def maximal_marginal_relevance(relevance: np.ndarray, vectors: np.ndarray, k: int, lambda_mult: float = 0.7) -> List[int]:
+    """
+    Pick k candidates that are relevant but unlike each other.
+
+    Each pick maximizes lambda_mult * relevance - (1 - lambda_mult) * redundancy, where
+    a candidate's redundancy is its highest cosine similarity to a candidate picked
+    before, negative when it points away from all of them; the first pick is the most
+    relevant candidate. A pick takes one matrix-vector product of the pool with the picked
+    vector and updates every redundancy at once, so k picks cost O(k * n * d) instead
+    of the O(n * n * d) of the full similarity matrix; there is no loop over pairs.
+
+    :param relevance: (n,) relevance of each candidate to the query, higher is better
+    :param vectors: (n, d) candidate embeddings; a zero row, for a candidate without one,
+        has similarity 0 to every other
+    :param lambda_mult: 1 ranks by relevance alone, 0 by diversity alone
+    :return: Indices of the picked candidates in the order they were picked
+    """
+    relevance = np.asarray(relevance, dtype=np.float32)
+    k = min(k, len(relevance))
+    if k <= 0:
+        return []
+    vectors = np.asarray(vectors, dtype=np.float32)
+    # Similarities are scaled by the norms rather than copying the pool normalized
+    norms = np.maximum(np.sqrt(np.einsum('ij,ij->i', vectors, vectors)), 1e-12)
+    scores = lambda_mult * relevance
+    redundancy = None
+    picked = []
+    for _ in range(k):
+        best = int(np.argmax(scores if redundancy is None else scores - (1 - lambda_mult) * redundancy))
+        picked.append(best)
+        # Never picked again
+        scores[best] = -np.inf
+        similarity = (vectors @ vectors[best]) / (norms * norms[best])
+        redundancy = similarity if redundancy is None else np.maximum(redundancy, similarity, out=redundancy)
+    return picked
+
+
+class Retrieve:
+    """
+    Find the chunks of a passphrase's documents that are relevant to a question.
+
+    hybrid_search runs the vector search and, unless HYBRID_SEARCH is false, a BM25
+    keyword search at once, and fuses both result lists with reciprocal-rank fusion.
+    Unless MMR_LAMBDA is 1, it then over-fetches candidates with their embeddings and
+    re-ranks them by maximal marginal relevance, so near-copies of one passage do not
+    fill the top_k.
+    """
+    def __init__(self, container, backend: str = None, hybrid: Optional[bool] = None):
+        """
+        :param container: azure.cosmos.aio container holding the chunks
+        :param backend: Name of the retrieval backend, RETRIEVAL_BACKEND or 'cosmos' by default
+        :param hybrid: Whether to add keyword search, HYBRID_SEARCH or true by default
+        """
+        self.container = container
+        self.backend = create_backend(backend or os.getenv("RETRIEVAL_BACKEND", "cosmos"), self.container)
+        if hybrid is None:
+            hybrid = os.getenv("HYBRID_SEARCH", "true").lower() == "true"
+        self.keyword = None
+        if hybrid:
+            from prepare.keyword import KeywordBackend
+            self.keyword = KeywordBackend(
+                container,
+                refresh_seconds=float(os.getenv("INDEX_REFRESH_SECONDS", 30)),
+                min_coverage=float(os.getenv("KEYWORD_MIN_COVERAGE", 0.4)),
+                max_partitions=int(os.getenv("INDEX_MAX_PARTITIONS", 1024)),
+                idle_seconds=float(os.getenv("INDEX_IDLE_SECONDS", 3600)),
+            )
+        # Each list contributes this many times top_k candidates to the fusion
+        self.candidate_factor = int(os.getenv("HYBRID_CANDIDATE_FACTOR", 4))
+        self.rrf_k = int(os.getenv("HYBRID_RRF_K", 60))
+        self.mmr_lambda = float(os.getenv("MMR_LAMBDA", 0.7))
+
+    def _hash_passphrase(self, passphrase: str) -> str:
+        return hashlib.sha256(passphrase.encode()).hexdigest()
+
+    async def hybrid_search(
+        self,
+        passphrase: str,
+        query_text: str,
+        query_vector: Union[List[float], Awaitable[List[float]]],
+        top_k: int = 10,
+        threshold: float = 0.65,
+        timings: Optional[Dict[str, float]] = None,
+        mmr_lambda: Optional[float] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Vector and keyword results fused into one top_k; only vector results without keyword search.
+
+        :param query_vector: The query's embedding, or an awaitable of it; keyword search
+            does not need it and starts right away
+        :param threshold: Minimum similarity of vector results; keyword results need the
+            keyword backend's min_coverage instead
+        :param timings: Gets the seconds the vector and keyword searches and the re-ranking
+            took, by the names vector, keyword and mmr
+        :param mmr_lambda: Relevance weight of the re-ranking, the instance's mmr_lambda by
+            default; 1 keeps the results in order of relevance and skips it
+        """
+        async def query_vectors():
+            return [await query_vector if inspect.isawaitable(query_vector) else query_vector]
+
+        results = await self.hybrid_search_many(passphrase, [query_text], query_vectors(), top_k, threshold, timings, mmr_lambda)
+        return results[0]
+
+    async def hybrid_search_many(
+        self,
+        passphrase: str,
+        query_texts: List[str],
+        query_vectors: Union[List[List[float]], Awaitable[List[List[float]]]],
+        top_k: int = 10,
+        threshold: float = 0.65,
+        timings: Optional[Dict[str, float]] = None,
+        mmr_lambda: Optional[float] = None
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        hybrid_search for several questions under one passphrase, in one pass.
+
+        The vector searches of all questions are one backend call, and so are their
+        keyword searches; local backends score all questions with one matrix product.
+
+        :param query_vectors: One embedding per question, or an awaitable of them
+        :return: One result list per question, in the order of query_texts
         """
-        print(query)
-        
-        items = list(self.container.query_items(
-            query=query,
-            enable_cross_partition_query=True
-        ))
-        
-        for item in items:
-            self._rate_limit(self.default_ru)  
-        
-        return items
-
-    def delete_embeddings(self, passphrase: str):
         passphrase_hash = self._hash_passphrase(passphrase)
-        query = f"SELECT * FROM c WHERE c.passphrase_hash = '{passphrase_hash}'"
-        items = list(self.container.query_items(
-            query=query,
-            enable_cross_partition_query=True
-        ))
-        
-        for item in items:
-            self.container.delete_item(item=item['id'], partition_key=passphrase_hash)
-            self._rate_limit(self.default_ru)  # Assume a fixed request charge for delete operations
+        timings = {} if timings is None else timings
+        mmr_lambda = self.mmr_lambda if mmr_lambda is None else mmr_lambda
+        rerank = mmr_lambda < 1
+        candidates = top_k * self.candidate_factor if self.keyword is not None or rerank else top_k
+        embeddings = []
+
+        async def vector():
+            vectors = await query_vectors if inspect.isawaitable(query_vectors) else query_vectors
+            embeddings.extend(vectors)
+            start = time.perf_counter()
+            try:
+                return await self.backend.vector_search_many(passphrase_hash, vectors, candidates, threshold, with_embeddings=rerank)
+            finally:
+                timings['vector'] = time.perf_counter() - start
+
+        async def keyword():
+            start = time.perf_counter()
+            try:
+                return await self.keyword.keyword_search_many(passphrase_hash, query_texts, candidates)
+            finally:
+                timings['keyword'] = time.perf_counter() - start
+
+        if self.keyword is None:
+            results = await vector()
+            log_event(logger, "retrieve", passphrase_hash=passphrase_hash[:8], questions=len(query_texts),
+                      vector=sum(map(len, results)),
+                      best_similarity=max((item['similarity_score'] for items in results for item in items), default=None))
+        else:
+            vector_results, keyword_results = await asyncio.gather(vector(), keyword())
+            log_event(logger, "retrieve", passphrase_hash=passphrase_hash[:8], questions=len(query_texts),
+                      vector=sum(map(len, vector_results)), keyword=sum(map(len, keyword_results)),
+                      best_similarity=max((item['similarity_score'] for items in vector_results for item in items), default=None))
+            results = [
+                reciprocal_rank_fusion([vector_items, keyword_items], candidates if rerank else top_k, self.rrf_k)
+                for vector_items, keyword_items in zip(vector_results, keyword_results)
+            ]
+        if not rerank:
+            return results
+        start = time.perf_counter()
+        results = [self.rerank(items, len(embedding), top_k, mmr_lambda) for items, embedding in zip(results, embeddings)]
+        timings['mmr'] = time.perf_counter() - start
+        return results
+
+    @staticmethod
+    def rerank(results: List[Dict[str, Any]], dimensions: int, top_k: int, mmr_lambda: float) -> List[Dict[str, Any]]:
+        """
+        The top_k of results by maximal marginal relevance, without their embeddings.
+
+        Relevance is the rrf_score, or the similarity_score of vector results alone,
+        scaled so the best candidate has 1. Keyword results the vector search did not
+        return have no embedding and count as unlike every other candidate.
+
+        :param dimensions: Length of the embeddings
+        """
+        if not results:
+            return results
+        relevance = np.array([item.get('rrf_score', item.get('similarity_score', 0.0)) for item in results], dtype=np.float32)
+        relevance /= max(float(relevance.max()), 1e-12)
+        vectors = np.zeros((len(results), dimensions), dtype=np.float32)
+        for row, item in enumerate(results):
+            embedding = item.pop('embedding', None)
+            if embedding is not None:
+                vectors[row] = embedding
+        return [results[i] for i in maximal_marginal_relevance(relevance, vectors, top_k, mmr_lambda)]
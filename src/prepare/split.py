@@ -1,35 +1,164 @@
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from typing import List, Dict, Any
+from collections import deque
+from typing import List, Dict, Any, Callable, Optional, Tuple
+import re
+
+# A chunk is a (start, end) span of character offsets into the text it was split from
+Span = Tuple[int, int]
+
+_NON_WHITESPACE = re.compile(r"\S")
+
+
+class TextSplitter:
+    """
+    Recursive character splitter that works on offsets into the text.
+
+    Produces the same chunks as LangChain's RecursiveCharacterTextSplitter with its
+    default separators, but scans for separators with str.find and merges spans, so the
+    only strings created are the final chunks (and the pieces measured when lengths are
+    counted in tokens). Separators are kept at the start of the following piece.
+    """
+    separators = ("\n\n", "\n", " ", "")
+
+    def __init__(self, chunk_size: int = 1000, chunk_overlap: int = 200, length_function: Optional[Callable[[str], int]] = None):
+        """
+        :param chunk_size: Maximum chunk length, in characters or in length_function units
+        :param chunk_overlap: Length of the trailing pieces of a chunk repeated at the start of the next
+        :param length_function: Measures a piece of text, e.g. prepare.tokens.count_tokens; characters when not given
+        """
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.length_function = length_function
+
+    def split_spans(self, text: str) -> List[Span]:
+        """Split text into chunks, returned as (start, end) offsets with surrounding whitespace excluded."""
+        chunks = []
+        self._split(text, 0, len(text), 0, chunks)
+        return chunks
+
+    def split_text(self, text: str) -> List[str]:
+        return [text[start:end] for start, end in self.split_spans(text)]
+
+    def _length(self, text: str, start: int, end: int) -> int:
+        if self.length_function is None:
+            return end - start
+        return self.length_function(text[start:end])
+
+    def _split(self, text: str, start: int, end: int, level: int, chunks: List[Span]):
+        # Use the first separator that occurs in this span; finer ones split oversized pieces
+        separator = ""
+        for level in range(level, len(self.separators)):
+            separator = self.separators[level]
+            if separator == "" or text.find(separator, start, end) != -1:
+                break
+        finer = level + 1 < len(self.separators) and separator != ""
+
+        pieces = []
+        for piece_start, piece_end in self._pieces(text, start, end, separator):
+            length = self._length(text, piece_start, piece_end)
+            if length < self.chunk_size:
+                pieces.append((piece_start, piece_end, length))
+                continue
+            if pieces:
+                self._merge(text, pieces, chunks)
+                pieces = []
+            if finer:
+                self._split(text, piece_start, piece_end, level + 1, chunks)
+            else:
+                self._emit(text, piece_start, piece_end, chunks)
+        if pieces:
+            self._merge(text, pieces, chunks)
+
+    @staticmethod
+    def _pieces(text: str, start: int, end: int, separator: str):
+        if separator == "":
+            yield from ((i, i + 1) for i in range(start, end))
+            return
+        piece_start = start
+        position = text.find(separator, start, end)
+        while position != -1:
+            if position > piece_start:
+                yield piece_start, position
+            piece_start = position
+            position = text.find(separator, position + len(separator), end)
+        if end > piece_start:
+            yield piece_start, end
+
+    def _merge(self, text: str, pieces: List[Tuple[int, int, int]], chunks: List[Span]):
+        # Pieces are adjacent, so a run of them is a single span of the text
+        current = deque()
+        total = 0
+        for piece in pieces:
+            length = piece[2]
+            if total + length > self.chunk_size and current:
+                self._emit(text, current[0][0], current[-1][1], chunks)
+                while total > self.chunk_overlap or (total + length > self.chunk_size and total > 0):
+                    total -= current.popleft()[2]
+            current.append(piece)
+            total += length
+        if current:
+            self._emit(text, current[0][0], current[-1][1], chunks)
+
+    @staticmethod
+    def _emit(text: str, start: int, end: int, chunks: List[Span]):
+        match = _NON_WHITESPACE.search(text, start, end)
+        if match is None:
+            return
+        start = match.start()
+        while text[end - 1].isspace():
+            end -= 1
+        chunks.append((start, end))
+
 
 class Split:
-    def __init__(self, chunk_size: int = 1000, chunk_overlap: int = 200):
-        self.text_splitter = RecursiveCharacterTextSplitter(
+    def __init__(self, chunk_size: int = 1000, chunk_overlap: int = 200, length_unit: str = "characters"):
+        """
+        :param length_unit: "characters", or "tokens" to measure chunk_size and chunk_overlap in
+            cl100k_base tokens
+        """
+        if length_unit not in ("characters", "tokens"):
+            raise ValueError(f"Unknown length unit: {length_unit}")
+        length_function = None
+        if length_unit == "tokens":
+            from prepare.tokens import count_tokens
+            length_function = count_tokens
+        self.text_splitter = TextSplitter(
             chunk_size=chunk_size,
             chunk_overlap=chunk_overlap,
-            length_function=len,
+            length_function=length_function,
         )
 
     def split_documents(self, documents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """
         Split a list of documents into chunks.
-        
+
         :param documents: List of document dictionaries, each containing 'page_content' and 'metadata'
         :return: List of chunked document dictionaries
         """
         chunked_documents = []
         for doc in documents:
-            splits = self.text_splitter.split_text(doc.page_content)
-            for i, split in enumerate(splits):
-                chunked_documents.append({
-                    'page_content': split,
-                    'metadata': {**doc.metadata, 'chunk': i}
-                })
+            chunked_documents.extend(self.split_document(doc))
         return chunked_documents
 
+    def split_document(self, document) -> List[Dict[str, Any]]:
+        """
+        Split one document (e.g. one page) into chunks numbered from 0.
+
+        Each chunk's metadata records its character offsets in the document's text as
+        start_index and end_index.
+
+        :param document: Document with page_content and metadata
+        :return: List of chunked document dictionaries
+        """
+        text = document.page_content
+        return [{
+            'page_content': text[start:end],
+            'metadata': {**document.metadata, 'chunk': i, 'start_index': start, 'end_index': end}
+        } for i, (start, end) in enumerate(self.text_splitter.split_spans(text))]
+
     def set_chunk_size(self, chunk_size: int):
         """Update the chunk size of the text splitter."""
         self.text_splitter.chunk_size = chunk_size
 
     def set_chunk_overlap(self, chunk_overlap: int):
         """Update the chunk overlap of the text splitter."""
-        self.text_splitter.chunk_overlap = chunk_overlap
\ No newline at end of file
+        self.text_splitter.chunk_overlap = chunk_overlap
@@ -1,120 +1,348 @@
-from azure.cosmos import CosmosClient, PartitionKey
-from typing import List, Dict, Any
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError, CosmosResourceExistsError, CosmosResourceNotFoundError
+from prepare.cosmos import BulkWriter, QueryMetrics, charge_hook
+from prepare.metrics import log_event
+from prepare.rate_limit import RequestUnitBudget
+from prepare.vectors import ENCODINGS, encode_embedding
+from collections import Counter
+from typing import List, Dict, Any, Set, Tuple, Callable, Optional
+import asyncio
 import hashlib
-import os
-import uuid
-import time
 import datetime as dt
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+# Id of the per-passphrase item listing its documents, stored in the passphrase's partition
+CATALOG_ID = "catalog"
+
+
+def time_to_live(keep_until: dt.datetime) -> int:
+    """Seconds from now until keep_until, for the Cosmos ttl field; items expire at least a second from now."""
+    return max(1, int((keep_until - dt.datetime.now()).total_seconds()))
+
 
 class Store:
-    def __init__(self):
-        cosmos_endpoint = os.getenv("COSMOS_ENDPOINT")
-        cosmos_key = os.getenv("COSMOS_KEY")
-        database_name = os.getenv("COSMOS_DATABASE_NAME")
-        container_name = os.getenv("COSMOS_CONTAINER_NAME")
-
-        client = CosmosClient(cosmos_endpoint, cosmos_key)
-        self.database = client.create_database_if_not_exists(id=database_name)
-        self.container = self.database.create_container_if_not_exists(
-            id=container_name, 
-            partition_key=PartitionKey(path="/passphrase_hash")
-        )
-        self.max_ru_per_second = 1000
-        self.last_request_time = time.time()
-        self.consumed_ru = 0
-        self.assumed_request_charge = 1.0  # This value may need adjustment based on actual usage patterns
+    """
+    Chunks and the document catalog of each passphrase in the Cosmos container.
+
+    Besides its chunks, every passphrase partition holds one catalog item that maps
+    document names to their chunk count, page count, size, upload time and expiry, so
+    listing documents is a point read instead of a scan over the chunks. Catalog
+    updates are read-modify-write with the item's etag and are redone when another
+    writer changed it in between. Reads are cached for catalog_cache_seconds, so other
+    workers' changes show up after at most that long.
+    """
+    def __init__(self, container, bulk_container=None, catalog_cache_seconds: float = 5, embedding_encoding: str = "float32"):
+        """
+        :param container: azure.cosmos.aio container for queries and deletes
+        :param bulk_container: Same container from a client without throttle retries, for
+            bulk writes; container is used when not given
+        :param catalog_cache_seconds: How long a catalog read is served from memory
+        :param embedding_encoding: How embeddings are written, one of prepare.vectors.ENCODINGS;
+            float16 and int8 are several times smaller but only local retrieval backends can search them
+        """
+        if embedding_encoding not in ENCODINGS:
+            raise ValueError(f"Unknown embedding encoding: {embedding_encoding}")
+        self.embedding_encoding = embedding_encoding
+        self.container = container
+        self.ru_budget = RequestUnitBudget(max_ru_per_second=1000)
+        self.writer = BulkWriter(bulk_container or container, self.ru_budget)
+        self.observers = []
+        self.catalog_cache_seconds = catalog_cache_seconds
+        self.catalog_cache: Dict[str, Tuple[float, Dict[str, Dict[str, Any]]]] = {}
+
+    def add_observer(self, observer):
+        """
+        Register an object to be told about writes and deletes, e.g. a local retrieval index.
+
+        :param observer: Object with on_store(passphrase_hash, items), on_extend(passphrase_hash, items)
+            and on_delete(passphrase_hash, ids), where ids is None when the whole partition was deleted;
+            they are called in a worker thread
+        """
+        self.observers.append(observer)
+
+    async def _notify(self, event: str, passphrase_hash: str, payload: List[Any]):
+        for observer in self.observers:
+            await asyncio.to_thread(getattr(observer, event), passphrase_hash, payload)
 
     def _hash_passphrase(self, passphrase: str) -> str:
         return hashlib.sha256(passphrase.encode()).hexdigest()
 
-    def _rate_limit(self, consumed_ru: float):
-        self.consumed_ru += consumed_ru
-        current_time = time.time()
-        elapsed_time = current_time - self.last_request_time
-
-        if elapsed_time < 1 and self.consumed_ru > self.max_ru_per_second:
-            sleep_time = 1 - elapsed_time
-            time.sleep(sleep_time)
-            self.consumed_ru = 0
-            self.last_request_time = time.time()
-        elif elapsed_time >= 1:
-            self.consumed_ru = 0
-            self.last_request_time = current_time
-
-    def store_embeddings(self, passphrase: str, documents: List[Dict[str, Any]], keep_until=None):
+    def chunk_id(self, passphrase: str, document_name: str, content: str, occurrence: int = 0) -> str:
+        """
+        Deterministic id of a chunk, so re-uploading a document maps unchanged chunks to their stored items.
+
+        :param occurrence: How many chunks with the same content came earlier in the document
+        """
+        content_hash = hashlib.sha256(content.encode()).hexdigest()
+        key = f"{self._hash_passphrase(passphrase)}\0{document_name}\0{content_hash}\0{occurrence}"
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    async def chunk_ids(self, passphrase: str, document_name: str) -> Set[str]:
+        """Ids of the stored chunks of a document."""
+        passphrase_hash = self._hash_passphrase(passphrase)
+        items = self.container.query_items(
+            query="SELECT c.id FROM c WHERE c.passphrase_hash = @hash AND c.document_name = @document_name",
+            parameters=[
+                {"name": "@hash", "value": passphrase_hash},
+                {"name": "@document_name", "value": document_name},
+            ],
+            partition_key=passphrase_hash,
+            response_hook=QueryMetrics("chunk_ids")
+        )
+        return {item['id'] async for item in items}
+
+    async def extend_chunks(self, passphrase: str, documents: List[Dict[str, Any]], keep_until) -> Dict[str, Any]:
+        """
+        Keep stored chunks until keep_until, updating their position in the document but not their content or embedding.
+
+        :param documents: Chunks with id and metadata, as produced by the splitter
+        :return: Write report like store_embeddings, with the ids of chunks that no longer
+            existed, e.g. expired since they were listed, in missing_ids; they need to be stored again
+        """
+        passphrase_hash = self._hash_passphrase(passphrase)
+        items = [{
+            'id': doc['id'],
+            'passphrase_hash': passphrase_hash,
+            'metadata': doc['metadata'],
+            'page': doc['metadata'].get('page', 'Unknown'),
+            'chunk': doc['metadata'].get('chunk', 'Unknown'),
+            'keep_until': keep_until.isoformat(),
+            'ttl': time_to_live(keep_until),
+        } for doc in documents]
+        report = await self.writer.patch_items(items)
+        missing_ids = set(report['missing_ids'])
+        await self._notify("on_extend", passphrase_hash, [item for item in items if item['id'] not in missing_ids])
+        return report
+
+    async def delete_chunks(self, passphrase: str, ids: List[str]) -> Dict[str, Any]:
+        """
+        Delete stored chunks by id.
+
+        :return: Write report like store_embeddings
+        """
+        passphrase_hash = self._hash_passphrase(passphrase)
+        report = await self.writer.delete_items([{'id': id, 'passphrase_hash': passphrase_hash} for id in ids])
+        await self._notify("on_delete", passphrase_hash, list(ids))
+        return report
+
+    async def store_embeddings(self, passphrase: str, documents: List[Dict[str, Any]], keep_until=None) -> Dict[str, Any]:
+        """
+        Store embedded chunks with bounded-concurrency transactional batches.
+
+        :param passphrase: Passphrase the chunks are stored under
+        :param documents: Embedded chunks as returned by Embed.embed_documents; chunks without
+            an id get one from chunk_id, counting repeated content within the call
+        :param keep_until: Expiry time of the chunks, six hours from now by default
+        :return: Write report with item count, request charge, 429 count and duration
+        """
         if keep_until is None:
             keep_until = dt.datetime.now() + dt.timedelta(hours=6)
 
         passphrase_hash = self._hash_passphrase(passphrase)
+        occurrences = Counter()
+        items = []
         for doc in documents:
-            item = {
-                'id': str(uuid.uuid4()),
+            chunk_id = doc.get('id')
+            if chunk_id is None:
+                key = (doc['document_name'], doc['page_content'])
+                chunk_id = self.chunk_id(passphrase, *key, occurrence=occurrences[key])
+                occurrences[key] += 1
+            items.append({
+                'id': chunk_id,
                 'passphrase_hash': passphrase_hash,
                 'metadata': doc['metadata'],
-                'embedding': doc['embedding'],
+                **encode_embedding(doc['embedding'], self.embedding_encoding),
                 'document_name': doc['document_name'],  # Add this line
                 'page': doc['page'],  # Add this line
                 'chunk': doc['chunk'],  # Add this line
                 'keep_until': keep_until.isoformat(),
+                'ttl': time_to_live(keep_until),
                 'load_time': dt.datetime.now().isoformat(),
                 'content': doc['page_content'],
-                
-            }
-            response = self.container.upsert_item(item)
-            # Assume a fixed request charge for upsert operations
-            self._rate_limit(self.assumed_request_charge)
+            })
+        report = await self.writer.upsert_items(items)
+        await self._notify("on_store", passphrase_hash, items)
+        return report
 
-    def get_documents(self, passphrase: str) -> List[Dict[str, Any]]:
-        passphrase_hash = self._hash_passphrase(passphrase)
-        query = f"""
-            SELECT DISTINCT 
-                c.document_name
-            FROM c WHERE c.passphrase_hash = '{passphrase_hash}'
-            """
-        print(query)
-        items = list(self.container.query_items(
-            query=query,
-            enable_cross_partition_query=True,
-            max_item_count=1
-        ))
-        
+    async def get_documents(self, passphrase: str) -> Optional[List[Dict[str, Any]]]:
+        """
+        Unexpired documents stored under a passphrase, from its catalog.
+
+        :return: Dicts with document_name, chunks, pages, size_bytes, uploaded_at and keep_until,
+            or None when there are none
+        """
+        now = dt.datetime.now().isoformat()
+        documents = await self.read_catalog(passphrase)
+        items = [{'document_name': name, **entry} for name, entry in sorted(documents.items()) if entry['keep_until'] > now]
+        log_event(logger, "get_documents", passphrase_hash=self._hash_passphrase(passphrase)[:8],
+                  documents=len(items), expired=len(documents) - len(items))
         if items:
             return items
         return None
 
-    def delete_embeddings(self, passphrase: str):
+    async def read_catalog(self, passphrase: str) -> Dict[str, Dict[str, Any]]:
+        """The passphrase's catalog entries by document name, including expired ones."""
+        passphrase_hash = self._hash_passphrase(passphrase)
+        cached = self.catalog_cache.get(passphrase_hash)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        try:
+            catalog = await self.container.read_item(CATALOG_ID, partition_key=passphrase_hash,
+                                                     response_hook=charge_hook("catalog_read"))
+            documents = catalog['documents']
+        except CosmosResourceNotFoundError:
+            # Written from the chunks when the partition has documents from before the catalog existed
+            await self._update_catalog(passphrase_hash, lambda documents: None)
+            return self.catalog_cache[passphrase_hash][1]
+        self._cache_catalog(passphrase_hash, documents)
+        return documents
+
+    async def record_document(self, passphrase: str, document_name: str, chunks: int, pages: int, size_bytes: int, keep_until):
+        """
+        Add or replace a document's catalog entry once all of its chunks are stored.
+
+        :param chunks: Number of chunks the document has now
+        :param pages: Number of pages parsed from it
+        :param size_bytes: Size of the uploaded file
+        """
+        entry = {
+            'chunks': chunks,
+            'pages': pages,
+            'size_bytes': size_bytes,
+            'uploaded_at': dt.datetime.now().isoformat(),
+            'keep_until': keep_until.isoformat(),
+        }
+        await self._update_catalog(self._hash_passphrase(passphrase), lambda documents: documents.update({document_name: entry}))
+
+    def _cache_catalog(self, passphrase_hash: str, documents: Dict[str, Dict[str, Any]]):
+        self.catalog_cache[passphrase_hash] = (time.monotonic() + self.catalog_cache_seconds, documents)
+
+    async def _update_catalog(self, passphrase_hash: str, update: Callable[[Dict[str, Dict[str, Any]]], Any], attempts: int = 10):
+        """
+        Apply update to the catalog's documents and write it back unless someone changed it meanwhile.
+
+        Expired entries are dropped on every write. The catalog's ttl follows its latest
+        keep_until, and it is deleted once no entries are left. A partition without a
+        catalog starts from the entries _scan_documents finds in its chunks.
+        """
+        written = charge_hook("catalog_write")
+        for attempt in range(attempts):
+            try:
+                catalog = await self.container.read_item(CATALOG_ID, partition_key=passphrase_hash,
+                                                         response_hook=charge_hook("catalog_read"))
+            except CosmosResourceNotFoundError:
+                catalog = None
+            documents = dict(catalog['documents']) if catalog else await self._scan_documents(passphrase_hash)
+            update(documents)
+            now = dt.datetime.now().isoformat()
+            documents = {name: entry for name, entry in documents.items() if entry['keep_until'] > now}
+            unchanged = {'etag': catalog['_etag'], 'match_condition': MatchConditions.IfNotModified} if catalog else {}
+            body = {
+                'id': CATALOG_ID,
+                'passphrase_hash': passphrase_hash,
+                'documents': documents,
+                'ttl': time_to_live(dt.datetime.fromisoformat(max(entry['keep_until'] for entry in documents.values())))
+            } if documents else None
+            try:
+                if body is None:
+                    if catalog is not None:
+                        await self.container.delete_item(CATALOG_ID, partition_key=passphrase_hash, response_hook=written, **unchanged)
+                elif catalog is None:
+                    await self.container.create_item(body, response_hook=written)
+                else:
+                    await self.container.replace_item(CATALOG_ID, body, response_hook=written, **unchanged)
+            except (CosmosAccessConditionFailedError, CosmosResourceExistsError, CosmosResourceNotFoundError):
+                # Another writer changed the catalog since we read it; back off so writers spread out
+                if attempt == attempts - 1:
+                    raise
+                await asyncio.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+                continue
+            self._cache_catalog(passphrase_hash, documents)
+            return
+
+    async def _scan_documents(self, passphrase_hash: str) -> Dict[str, Dict[str, Any]]:
+        """
+        Catalog entries of the unexpired documents found in a partition's chunks.
+
+        For partitions written before the catalog existed; their size_bytes is unknown and left None.
+        """
+        metrics = QueryMetrics("catalog_scan")
+        documents, pages = {}, {}
+        async for item in self.container.query_items(
+            query="SELECT c.document_name, c.page, c.keep_until, c.load_time FROM c WHERE c.passphrase_hash = @hash AND c.keep_until > @now",
+            parameters=[
+                {"name": "@hash", "value": passphrase_hash},
+                {"name": "@now", "value": dt.datetime.now().isoformat()},
+            ],
+            partition_key=passphrase_hash,
+            response_hook=metrics
+        ):
+            name = item['document_name']
+            entry = documents.setdefault(name, {'chunks': 0, 'pages': 0, 'size_bytes': None, 'uploaded_at': '', 'keep_until': ''})
+            entry['chunks'] += 1
+            entry['uploaded_at'] = max(entry['uploaded_at'], item.get('load_time', ''))
+            entry['keep_until'] = max(entry['keep_until'], item['keep_until'])
+            pages.setdefault(name, set()).add(item.get('page'))
+        for name, entry in documents.items():
+            entry['pages'] = len(pages[name])
+        log_event(logger, "catalog_scan", passphrase_hash=passphrase_hash[:8], documents=len(documents),
+                  request_charge=round(metrics.request_charge, 2))
+        return documents
+
+    async def delete_embeddings(self, passphrase: str):
+        """Delete everything stored under a passphrase with one delete-by-partition-key request."""
         passphrase_hash = self._hash_passphrase(passphrase)
-        response = self.container.delete_item(item=passphrase_hash, partition_key=passphrase_hash)
+        await self.container.delete_all_items_by_partition_key(passphrase_hash, response_hook=charge_hook("delete_partition"))
+        self.catalog_cache.pop(passphrase_hash, None)
+        await self._notify("on_delete", passphrase_hash, None)
+
+    async def delete_documents_older_than(self, current_time, passphrase: str = None) -> Dict[str, Any]:
+        """
+        Delete chunks whose keep_until has passed, in transactional batches per partition.
+
+        Items normally expire by their ttl; this catches items written without one or in a
+        container that has time to live turned off.
 
-    def delete_documents_older_than(self, current_time, passphrase: str=None):
-        # Format current_time to ISO format for the query
-        current_time_str = current_time.isoformat()
-        query_parts = []
-        query_parts.append(f"SELECT c.id FROM c WHERE '{current_time_str}' > c.keep_until")
+        :param passphrase: Only look in this passphrase's partition; all partitions when not given
+        :return: Delete report like store_embeddings, with the query's charge included
+        """
+        query = "SELECT c.id, c.passphrase_hash FROM c WHERE c.keep_until < @now"
+        parameters = [{"name": "@now", "value": current_time.isoformat()}]
+        partition = {}
         if passphrase:
-            passphrase_hash = self._hash_passphrase(passphrase)
-            query_parts.append(f"""AND c.passphrase_hash = '{passphrase_hash}'""")
-        
-        query = " ".join(query_parts)
-        
-        items = list(self.container.query_items(
-            query=query,
-            enable_cross_partition_query=True
-        ))
-        print('='*100)
-        print(items)
-        
+            partition = {"partition_key": self._hash_passphrase(passphrase)}
+        metrics = QueryMetrics("expired_chunks")
+        items = [item async for item in self.container.query_items(
+            query=query, parameters=parameters, response_hook=metrics, **partition
+        )]
+
+        report = await self.writer.delete_items(items)
+        report["request_charge"] += metrics.request_charge
+        deleted = {}
         for item in items:
-            self.container.delete_item(item=item['id'], partition_key=item['id'])  # Use item['passphrase_hash']
+            deleted.setdefault(item['passphrase_hash'], []).append(item['id'])
+        for passphrase_hash, ids in deleted.items():
+            # Drop the catalog entries of expired documents
+            await self._update_catalog(passphrase_hash, lambda documents: None)
+            await self._notify("on_delete", passphrase_hash, ids)
+        return report
 
-    def delete_document(self, passphrase, filename ):
-        # Format current_time to ISO format for the query
+    async def delete_document(self, passphrase: str, filename: str) -> Dict[str, Any]:
+        """Delete every chunk of a document."""
         passphrase_hash = self._hash_passphrase(passphrase)
-        query = f"SELECT c.id FROM c WHERE c.passphrase_hash = '{passphrase_hash}' and c.document_name = '{filename}'"
-        items = list(self.container.query_items(
-            query=query,
-            enable_cross_partition_query=True
-        ))
-        
-        for item in items:
-            self.container.delete_item(item=item['id'], partition_key=item['id'])  # Fixed partition key
+        items = [item async for item in self.container.query_items(
+            query="SELECT c.id FROM c WHERE c.passphrase_hash = @hash AND c.document_name = @document_name",
+            parameters=[
+                {"name": "@hash", "value": passphrase_hash},
+                {"name": "@document_name", "value": filename},
+            ],
+            partition_key=passphrase_hash,
+            response_hook=QueryMetrics("chunk_ids")
+        )]
+        report = await self.delete_chunks(passphrase, [item['id'] for item in items])
+        await self._update_catalog(passphrase_hash, lambda documents: documents.pop(filename, None))
+        return report
@@ -0,0 +1,43 @@
+import logging
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+_encoding = None
+_encoding_loaded = False
+
+
+def get_encoding():
+    """
+    Return the cl100k_base encoding used by ada-002 and gpt-35-turbo, or None.
+
+    tiktoken downloads the encoding on first use. Without network access (offline
+    benchmarks, locked-down containers) we fall back to an estimate instead of failing.
+    """
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logger.warning(f"tiktoken encoding unavailable, estimating token counts: {e}")
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """Count tokens in text, or estimate ~4 characters per token when tiktoken is unavailable."""
+    encoding = get_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode_ordinary(text))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """The start of text that fits in max_tokens tokens (~4 characters each when tiktoken is unavailable)."""
+    encoding = get_encoding()
+    if encoding is None:
+        return text[:max(max_tokens - 1, 0) * 4]
+    tokens = encoding.encode_ordinary(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
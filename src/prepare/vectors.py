@@ -0,0 +1,62 @@
+from typing import List, Dict, Any, Optional, Tuple
+import base64
+import numpy as np
+
+# How embeddings are written to Cosmos items:
+# - float32: 'embedding' as a JSON list of floats, which VectorDistance queries need
+# - float16: 'embedding_f16', base64 of the little-endian float16 values
+# - int8: 'embedding_i8', base64 of int8 codes, and 'embedding_scale' to multiply them by
+ENCODINGS = ("float32", "float16", "int8")
+
+
+def quantize_int8(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Scalar-quantize rows to int8 with one scale per row.
+
+    :return: int8 codes and float32 scales with vectors ≈ codes * scales[:, None]
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = np.abs(vectors).max(axis=-1) / 127
+    scales = np.where(scales > 0, scales, 1.0).astype(np.float32)
+    codes = np.clip(np.rint(vectors / scales[..., None]), -127, 127).astype(np.int8)
+    return codes, scales
+
+
+def encode_embedding(embedding: List[float], encoding: str = "float32") -> Dict[str, Any]:
+    """
+    Item fields holding an embedding in the given encoding.
+
+    :param encoding: One of ENCODINGS
+    """
+    if encoding == "float32":
+        return {'embedding': embedding}
+    vector = np.asarray(embedding, dtype=np.float32)
+    if encoding == "float16":
+        return {'embedding_f16': base64.b64encode(vector.astype('<f2').tobytes()).decode()}
+    if encoding == "int8":
+        codes, scale = quantize_int8(vector)
+        return {'embedding_i8': base64.b64encode(codes.tobytes()).decode(), 'embedding_scale': float(scale)}
+    raise ValueError(f"Unknown embedding encoding: {encoding}")
+
+
+def decode_embedding(item: Dict[str, Any]) -> Optional[np.ndarray]:
+    """The float32 embedding of an item in any encoding, or None when it has none."""
+    if item.get('embedding'):
+        return np.asarray(item['embedding'], dtype=np.float32)
+    if item.get('embedding_f16'):
+        return np.frombuffer(base64.b64decode(item['embedding_f16']), dtype='<f2').astype(np.float32)
+    if item.get('embedding_i8'):
+        codes = np.frombuffer(base64.b64decode(item['embedding_i8']), dtype=np.int8)
+        return codes.astype(np.float32) * np.float32(item['embedding_scale'])
+    return None
+
+
+def with_embeddings(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Items that have an embedding, with it decoded into 'embedding' and the encoded fields dropped."""
+    decoded = []
+    for item in items:
+        embedding = decode_embedding(item)
+        if embedding is not None:
+            item = {key: value for key, value in item.items() if key not in ('embedding_f16', 'embedding_i8', 'embedding_scale')}
+            decoded.append({**item, 'embedding': embedding})
+    return decoded
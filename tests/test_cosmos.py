@@ -0,0 +1,121 @@
+import asyncio
+import datetime as dt
+
+import pytest
+from azure.cosmos.exceptions import CosmosBatchOperationError
+from fake_cosmos import FakeContainer
+from prepare.cosmos import BulkWriter
+from prepare.rate_limit import RequestUnitBudget
+from prepare.store import Store
+
+
+class ThrottlingContainer:
+    """Fails the first `throttles` batches with a 429, records the size of every batch it is sent."""
+    def __init__(self, container: FakeContainer, throttles: int):
+        self.container = container
+        self.throttles = throttles
+        self.batch_sizes = []
+
+    async def execute_item_batch(self, batch_operations, partition_key, response_hook=None, **kwargs):
+        self.batch_sizes.append(len(batch_operations))
+        if self.throttles:
+            self.throttles -= 1
+            raise CosmosBatchOperationError(
+                error_index=0, headers={"x-ms-retry-after-ms": "1", "x-ms-request-charge": "0.5"}, status_code=429,
+                message="Request rate is large", operation_responses=[{"statusCode": 429}] * len(batch_operations)
+            )
+        return await self.container.execute_item_batch(batch_operations, partition_key, response_hook=response_hook, **kwargs)
+
+
+def items(count: int, partition: str = "p"):
+    return [{"id": f"item{i}", "passphrase_hash": partition, "content": f"text {i}"} for i in range(count)]
+
+
+def test_patch_skips_items_that_no_longer_exist():
+    container = FakeContainer(latency=0)
+    writer = BulkWriter(container)
+    asyncio.run(writer.upsert_items(items(5)))
+    del container.partitions["p"]["item1"], container.partitions["p"]["item3"]
+
+    report = asyncio.run(writer.patch_items([{"id": f"item{i}", "passphrase_hash": "p", "page": 7} for i in range(5)]))
+
+    assert report["items"] == 3 and report["missing"] == 2
+    assert sorted(report["missing_ids"]) == ["item1", "item3"]
+    assert {item_id: item.get("page") for item_id, item in container.partitions["p"].items()} == {"item0": 7, "item2": 7, "item4": 7}
+
+
+def test_delete_counts_items_that_no_longer_exist():
+    container = FakeContainer(latency=0)
+    writer = BulkWriter(container)
+    asyncio.run(writer.upsert_items(items(4)))
+    del container.partitions["p"]["item2"]
+
+    report = asyncio.run(writer.delete_items([{"id": f"item{i}", "passphrase_hash": "p"} for i in range(4)]))
+
+    assert report["items"] == 3 and report["missing_ids"] == ["item2"]
+    assert container.partitions["p"] == {}
+
+
+def test_throttled_batches_are_retried_and_slow_the_budget():
+    container = ThrottlingContainer(FakeContainer(latency=0), throttles=2)
+    budget = RequestUnitBudget(max_ru_per_second=1000)
+    writer = BulkWriter(container, budget)
+
+    report = asyncio.run(writer.upsert_items(items(10)))
+
+    assert report["throttled"] == 2 and report["items"] == 10
+    assert len(container.container.partitions["p"]) == 10
+    assert budget.ru_per_second < 1000
+    # Throttled attempts are not samples of what a batch costs
+    assert budget.charge_estimates["batch_upsert"] > 0.5 / 10
+
+
+def test_throttling_beyond_max_retries_raises():
+    container = ThrottlingContainer(FakeContainer(latency=0), throttles=100)
+    writer = BulkWriter(container, max_retries=2)
+
+    with pytest.raises(CosmosBatchOperationError):
+        asyncio.run(writer.upsert_items(items(3)))
+    assert len(container.batch_sizes) == 3
+
+
+def test_batches_stay_within_limits_and_partitions():
+    container = ThrottlingContainer(FakeContainer(latency=0), throttles=0)
+    writer = BulkWriter(container, max_batch_operations=100)
+
+    report = asyncio.run(writer.upsert_items(items(250, "a") + items(30, "b")))
+
+    assert report["items"] == 280
+    assert sorted(container.batch_sizes) == [30, 50, 100, 100]
+    assert all(len(container.container.partitions[key]) == count for key, count in (("a", 250), ("b", 30)))
+
+
+class Recorder:
+    def __init__(self):
+        self.events = []
+
+    def on_store(self, passphrase_hash, items):
+        self.events.append(("store", [item["id"] for item in items]))
+
+    def on_extend(self, passphrase_hash, items):
+        self.events.append(("extend", [(item["id"], item["keep_until"]) for item in items]))
+
+    def on_delete(self, passphrase_hash, ids):
+        self.events.append(("delete", ids))
+
+
+def test_extend_chunks_reports_missing_chunks_and_notifies_observers():
+    container = FakeContainer(latency=0)
+    store = Store(container)
+    recorder = Recorder()
+    store.add_observer(recorder)
+    documents = [{"id": f"c{i}", "metadata": {"page": 0}, "embedding": [0.1, 0.2], "document_name": "/tmp/a.pdf",
+                  "page": 0, "chunk": i, "page_content": f"chunk {i}"} for i in range(3)]
+    asyncio.run(store.store_embeddings("secret", documents))
+    del container.partitions[store._hash_passphrase("secret")]["c1"]
+    keep_until = dt.datetime.now() + dt.timedelta(days=1)
+
+    report = asyncio.run(store.extend_chunks("secret", [{"id": f"c{i}", "metadata": {"page": 0}} for i in range(3)], keep_until))
+
+    assert report["missing_ids"] == ["c1"]
+    assert recorder.events[-1] == ("extend", [("c0", keep_until.isoformat()), ("c2", keep_until.isoformat())])
@@ -0,0 +1,150 @@
+import json
+import os
+
+import numpy as np
+import pytest
+from prepare.exact import MemmapBackend
+
+DIMENSIONS = 16
+PARTITION = "p"
+FOREVER = "2999-01-01T00:00:00"
+
+
+def items(start, count, rng, keep_until=FOREVER, content="chunk"):
+    vectors = rng.standard_normal((count, DIMENSIONS)).astype(np.float32)
+    return [
+        {"id": str(start + i), "embedding": vector, "content": f"{content} {start + i}", "document_name": "/tmp/a.pdf",
+         "page": start + i, "metadata": {"start_index": 0, "end_index": 10}, "keep_until": keep_until}
+        for i, vector in enumerate(vectors)
+    ]
+
+
+def normalized(item):
+    return item["embedding"] / np.linalg.norm(item["embedding"])
+
+
+def search(backend, query, top_k=5, threshold=-1.0, now=0.0):
+    return [hit["page"] for hit in backend.search_partition(PARTITION, query, top_k, threshold, now)]
+
+
+def manifest(backend):
+    with open(os.path.join(backend.directory, f"{PARTITION}.json")) as f:
+        return json.load(f)
+
+
+def segment_files(backend):
+    return {name.split(".")[1] for name in os.listdir(backend.directory) if name.count(".") >= 2 and not name.endswith(".tmp")
+            and not name.endswith(".sync.json")}
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return MemmapBackend(None, directory=str(tmp_path))
+
+
+def test_search_ranks_exactly_and_returns_payloads(backend):
+    rng = np.random.default_rng(0)
+    stored = items(0, 50, rng)
+    backend.add_items(PARTITION, stored)
+    vectors = np.array([normalized(item) for item in stored])
+    for query in vectors[:10]:
+        assert search(backend, query) == list(np.argsort(-(vectors @ query))[:5])
+    hit = backend.search_partition(PARTITION, vectors[3], 1, 0.5, 0.0, with_embeddings=True)[0]
+    assert hit["content"] == "chunk 3" and hit["keep_until"] == FOREVER
+    assert (hit["start_index"], hit["end_index"]) == (0, 10)
+    assert hit["similarity_score"] == pytest.approx(1.0, abs=1e-5)
+    np.testing.assert_allclose(hit["embedding"], vectors[3], atol=1e-6)
+
+
+def test_batches_are_merged_into_few_segments_without_leaking_files(backend):
+    rng = np.random.default_rng(1)
+    for start in range(0, 320, 10):
+        backend.add_items(PARTITION, items(start, 10, rng))
+        names = [entry["name"] for entry in manifest(backend)["segments"]]
+        assert len(names) <= 6
+        assert segment_files(backend) == {name.split(".")[1] for name in names}
+    assert sum(entry["rows"] for entry in manifest(backend)["segments"]) == 320
+
+
+def test_replaced_ids_and_removed_rows_are_not_returned(backend):
+    rng = np.random.default_rng(2)
+    backend.add_items(PARTITION, items(0, 20, rng))
+    replacement = items(5, 1, rng, content="new")
+    backend.add_items(PARTITION, replacement)
+    hits = backend.search_partition(PARTITION, normalized(replacement[0]), 20, -1.0, 0.0)
+    assert [hit["content"] for hit in hits].count("new 5") == 1
+    assert "chunk 5" not in [hit["content"] for hit in hits]
+
+    backend.remove_items(PARTITION, ["1", "2", "unknown"])
+    assert sorted(search(backend, normalized(replacement[0]), top_k=20)) == [i for i in range(20) if i not in (1, 2)]
+
+
+def test_deleting_a_third_compacts_into_one_segment(backend):
+    rng = np.random.default_rng(3)
+    for start in range(0, 60, 10):
+        backend.add_items(PARTITION, items(start, 10, rng))
+    backend.remove_items(PARTITION, [str(i) for i in range(21)])
+    segments = manifest(backend)["segments"]
+    assert len(segments) == 1 and segments[0]["rows"] == 39
+    assert manifest(backend)["deleted"] == {}
+    assert segment_files(backend) == {segments[0]["name"].split(".")[1]}
+    assert sorted(search(backend, rng.standard_normal(DIMENSIONS), top_k=60)) == list(range(21, 60))
+
+
+def test_expired_rows_are_skipped(backend):
+    rng = np.random.default_rng(4)
+    backend.add_items(PARTITION, items(0, 3, rng, keep_until="2000-01-01T00:00:00") + items(3, 3, rng))
+    now = np.datetime64("2020-01-01").astype("datetime64[s]").astype(float)
+    assert sorted(search(backend, rng.standard_normal(DIMENSIONS), now=now)) == [3, 4, 5]
+
+
+def test_extend_items_rewrites_the_patched_fields(backend):
+    rng = np.random.default_rng(5)
+    stored = items(0, 4, rng)
+    backend.add_items(PARTITION, stored)
+    backend.extend_items(PARTITION, [
+        {"id": "1", "keep_until": "2500-01-01T00:00:00", "page": 40, "metadata": {"start_index": 3, "end_index": 7}},
+        {"id": "missing", "keep_until": FOREVER, "page": 0, "metadata": {}},
+    ])
+    hit = backend.search_partition(PARTITION, normalized(stored[1]), 1, 0.5, 0.0)[0]
+    assert (hit["page"], hit["keep_until"], hit["start_index"], hit["end_index"]) == (40, "2500-01-01T00:00:00", 3, 7)
+    assert hit["content"] == "chunk 1"
+    assert sorted(search(backend, normalized(stored[0]), top_k=10)) == [0, 2, 3, 40]
+
+
+def test_other_workers_see_writes(backend, tmp_path):
+    rng = np.random.default_rng(6)
+    other = MemmapBackend(None, directory=str(tmp_path))
+    backend.add_items(PARTITION, items(0, 5, rng))
+    query = rng.standard_normal(DIMENSIONS)
+    assert sorted(search(other, query)) == [0, 1, 2, 3, 4]
+    backend.remove_items(PARTITION, ["0"])
+    backend.add_items(PARTITION, items(5, 1, rng))
+    assert sorted(search(other, query)) == [1, 2, 3, 4, 5]
+
+
+def test_clear_removes_the_partition_and_its_sync_state(backend):
+    rng = np.random.default_rng(7)
+    backend.add_items(PARTITION, items(0, 5, rng))
+    backend.save_sync_state(PARTITION, {"loaded": 1.0})
+    backend.clear(PARTITION)
+    assert backend.sync_state(PARTITION) is None
+    assert search(backend, rng.standard_normal(DIMENSIONS)) == []
+    assert segment_files(backend) == set()
+
+
+@pytest.mark.parametrize("encoding", ["float16", "int8"])
+def test_compact_encodings_rescore_to_the_exact_ranking(tmp_path, encoding):
+    rng = np.random.default_rng(9)
+    stored = items(0, 200, rng)
+    exact = MemmapBackend(None, directory=str(tmp_path / "exact"))
+    compact = MemmapBackend(None, directory=str(tmp_path / encoding), encoding=encoding)
+    exact.add_items(PARTITION, stored)
+    compact.add_items(PARTITION, stored)
+    for query in rng.standard_normal((10, DIMENSIONS)):
+        assert search(compact, query) == search(exact, query)
+
+
+def test_unknown_encoding_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        MemmapBackend(None, directory=str(tmp_path), encoding="bfloat16")
@@ -0,0 +1,152 @@
+import numpy as np
+import pytest
+from prepare.index import IndexBackend, IVFIndex, LocalBackend
+
+DIMENSIONS = 32
+FOREVER = np.inf
+
+
+def clustered(count, rng, centers=40):
+    """Unit vectors around a few random directions, like embeddings of related passages."""
+    directions = rng.standard_normal((centers, DIMENSIONS))
+    vectors = directions[rng.integers(centers, size=count)] + 0.3 * rng.standard_normal((count, DIMENSIONS))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def build(vectors, **kwargs):
+    index = IVFIndex(DIMENSIONS, **kwargs)
+    ids = [str(i) for i in range(len(vectors))]
+    index.add(ids, vectors, np.full(len(vectors), FOREVER), [{"content": item_id} for item_id in ids])
+    return index
+
+
+def exact(vectors, query, top_k):
+    return [str(row) for row in np.argsort(-(vectors @ query))[:top_k]]
+
+
+def hit_ids(index, hits):
+    return [index.ids[row] for row, _ in hits]
+
+
+def test_small_partitions_are_scanned_exactly():
+    rng = np.random.default_rng(0)
+    vectors = clustered(500, rng)
+    index = build(vectors)
+    assert index.centroids is None
+    for query in vectors[:20]:
+        assert hit_ids(index, index.search(query, 5, -1.0, 0.0)) == exact(vectors, query, 5)
+
+
+def test_trained_index_finds_most_exact_neighbours():
+    rng = np.random.default_rng(1)
+    vectors = clustered(4000, rng)
+    index = build(vectors, min_train_size=2048)
+    assert index.centroids is not None
+    queries = clustered(50, rng)
+    found = sum(len(set(hit_ids(index, index.search(query, 10, -1.0, 0.0))) & set(exact(vectors, query, 10)))
+                for query in queries)
+    assert found / (10 * len(queries)) >= 0.9
+
+
+def test_search_many_matches_single_searches_on_an_untrained_index():
+    rng = np.random.default_rng(2)
+    index = build(clustered(300, rng))
+    queries = clustered(8, rng)
+    for hits, query in zip(index.search_many(queries, 4, 0.2, 0.0), queries):
+        alone = index.search(query, 4, 0.2, 0.0)
+        assert [row for row, _ in hits] == [row for row, _ in alone]
+        assert [score for _, score in hits] == pytest.approx([score for _, score in alone], rel=1e-5)
+
+
+def test_threshold_and_expiry_filter_hits():
+    index = IVFIndex(2)
+    index.add(["a", "b", "c"], np.array([[1, 0], [1, 1], [0, 1]]), np.array([10.0, 100.0, 100.0]), [{}] * 3)
+    assert hit_ids(index, index.search(np.array([1, 0]), 5, 0.5, now=0.0)) == ["a", "b"]
+    assert hit_ids(index, index.search(np.array([1, 0]), 5, 0.5, now=50.0)) == ["b"]
+
+
+def test_adding_an_existing_id_replaces_its_row():
+    index = IVFIndex(2)
+    index.add(["a", "b"], np.array([[1, 0], [0, 1]]), np.full(2, FOREVER), [{"v": 1}, {"v": 1}])
+    index.add(["a"], np.array([[0, 1]]), np.full(1, FOREVER), [{"v": 2}])
+    assert len(index) == 2
+    hits = index.search(np.array([0, 1]), 5, 0.5, 0.0)
+    assert sorted(hit_ids(index, hits)) == ["a", "b"]
+    assert index.payloads[index.rows["a"]] == {"v": 2}
+
+
+def test_removed_rows_are_not_returned_and_are_compacted_past_a_third():
+    rng = np.random.default_rng(3)
+    vectors = clustered(90, rng)
+    index = build(vectors)
+    index.remove([str(i) for i in range(30)])
+    assert index.tombstones == 30 and index.size == 90
+    assert all(int(item_id) >= 30 for item_id in hit_ids(index, index.search(vectors[0], 90, -1.0, 0.0)))
+
+    index.remove(["30", "unknown"])
+    assert index.tombstones == 0 and index.size == 59 == len(index)
+    assert index.ids == [str(i) for i in range(31, 90)]
+    assert all(index.ids[row] == item_id for item_id, row in index.rows.items())
+    for query in vectors[31:40]:
+        hits = index.search(query, 5, -1.0, 0.0)
+        assert [int(item_id) for item_id in hit_ids(index, hits)] == [
+            31 + row for row in np.argsort(-(vectors[31:] @ query))[:5]]
+
+
+def test_compaction_retrains_large_partitions_and_drops_small_ones_to_a_scan():
+    rng = np.random.default_rng(4)
+    index = build(clustered(3000, rng), min_train_size=2048)
+    assert index.centroids is not None
+    index.remove([str(i) for i in range(1100)])
+    assert index.size == 1900 and index.centroids is None
+    index.add([f"n{i}" for i in range(200)], clustered(200, rng), np.full(200, FOREVER), [{}] * 200)
+    assert index.centroids is not None and index.trained_size == 2100
+    assert len(index.assignments) >= index.size
+
+
+def test_inserts_after_training_are_assigned_and_found():
+    rng = np.random.default_rng(5)
+    index = build(clustered(2500, rng), min_train_size=2048)
+    new = clustered(10, rng)
+    index.add([f"n{i}" for i in range(10)], new, np.full(10, FOREVER), [{}] * 10)
+    for i, vector in enumerate(new):
+        assert hit_ids(index, index.search(vector, 1, -1.0, 0.0)) == [f"n{i}"]
+
+
+def test_update_sets_expiry_and_merges_payload_fields():
+    index = IVFIndex(2)
+    index.add(["a"], np.array([[1, 0]]), np.array([100.0]), [{"content": "x", "page": 1}])
+    index.update(["a", "unknown"], np.array([10.0, 10.0]), [{"page": 2}, {"page": 3}])
+    assert index.payloads[index.rows["a"]] == {"content": "x", "page": 2}
+    assert index.search(np.array([1, 0]), 1, 0.0, now=50.0) == []
+
+
+def test_empty_index_returns_no_hits():
+    index = IVFIndex(DIMENSIONS)
+    assert index.search_many(np.ones((2, DIMENSIONS)), 3, 0.0, 0.0) == [[], []]
+    index.add(["a"], np.ones((1, DIMENSIONS)), np.full(1, FOREVER), [{}])
+    index.remove(["a"])
+    assert index.search(np.ones(DIMENSIONS), 3, -1.0, 0.0) == []
+    assert len(index) == 0
+
+
+@pytest.mark.parametrize("count", [1, 64, 65, 200])
+def test_growing_the_matrix_keeps_rows(count):
+    rng = np.random.default_rng(6)
+    vectors = clustered(count, rng)
+    index = IVFIndex(DIMENSIONS)
+    for start in range(0, count, 7):
+        end = min(start + 7, count)
+        index.add([str(i) for i in range(start, end)], vectors[start:end], np.full(end - start, FOREVER), [{}] * (end - start))
+    assert index.size == count
+    np.testing.assert_allclose(index.vectors[:count], vectors, rtol=1e-5, atol=1e-6)
+
+
+def test_backends_missing_a_storage_hook_cannot_be_created():
+    class Incomplete(LocalBackend):
+        def search_partition(self, passphrase_hash, query, top_k, threshold, now, with_embeddings=False):
+            return []
+
+    with pytest.raises(TypeError, match="add_items"):
+        Incomplete(None)
+    assert isinstance(IndexBackend(None), LocalBackend)
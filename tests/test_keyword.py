@@ -0,0 +1,111 @@
+import asyncio
+import math
+
+import numpy as np
+import pytest
+from fake_cosmos import FakeContainer
+from prepare.keyword import InvertedIndex, KeywordBackend, tokenize
+
+FOREVER = np.inf
+
+
+def build(texts, **kwargs):
+    index = InvertedIndex(**kwargs)
+    ids = [str(i) for i in range(len(texts))]
+    index.add(ids, texts, np.full(len(texts), FOREVER), [{"content": text} for text in texts])
+    return index
+
+
+def test_tokenize_keeps_codes_whole_and_by_part():
+    assert tokenize("What is the rating of PN-4821/B?") == ["rating", "pn-4821/b", "pn", "4821", "b"]
+
+
+def test_tokenize_drops_stopwords_but_not_code_parts():
+    assert tokenize("The pump and the valve") == ["pump", "valve"]
+    assert tokenize("A-12") == ["a-12", "a", "12"]
+
+
+def test_bm25_scores_match_the_formula():
+    texts = ["gear gear pump", "pump valve", "valve filter hose"]
+    index = build(texts, k1=1.2, b=0.75)
+    hits = dict(index.search(["gear", "pump"], top_k=3, now=0.0))
+
+    lengths = [3, 2, 3]
+    average = sum(lengths) / 3
+
+    def term(frequency, document_frequency, length):
+        idf = math.log1p((3 - document_frequency + 0.5) / (document_frequency + 0.5))
+        return idf * frequency * 2.2 / (frequency + 1.2 * (0.25 + 0.75 * length / average))
+
+    assert hits[0] == pytest.approx(term(2, 1, 3) + term(1, 2, 3), rel=1e-5)
+    assert hits[1] == pytest.approx(term(1, 2, 2), rel=1e-5)
+    assert 2 not in hits
+
+
+def test_results_are_best_first_and_limited_to_top_k():
+    index = build([f"pump {'gear ' * i}" for i in range(10)])
+    hits = index.search(["gear"], top_k=3, now=0.0)
+    assert len(hits) == 3
+    assert [score for _, score in hits] == sorted((score for _, score in hits), reverse=True)
+
+
+def test_expired_and_removed_rows_are_not_hits():
+    index = InvertedIndex()
+    index.add(["old", "new", "gone"], ["gear pump"] * 3, np.array([10.0, 100.0, 100.0]), [{}] * 3)
+    index.remove(["gone"])
+    assert [index.ids[row] for row, _ in index.search(["gear"], 5, now=50.0)] == ["new"]
+
+
+def test_removal_updates_document_frequencies_and_compaction_keeps_scores():
+    texts = [f"gear {'pump' if i % 2 else 'valve'} filter{i}" for i in range(30)]
+    index = build(texts)
+    reference = build([text for i, text in enumerate(texts) if i >= 12])
+    index.remove([str(i) for i in range(12)])
+    assert index.size == 18 and index.tombstones == 0  # Compacted past a third
+    assert len(index) == 18
+    scores = sorted(score for _, score in index.search(["gear", "pump"], 30, 0.0))
+    expected = sorted(score for _, score in reference.search(["gear", "pump"], 30, 0.0))
+    assert scores == pytest.approx(expected)
+
+
+def test_replacing_a_row_reindexes_its_text():
+    index = build(["gear pump", "valve"])
+    index.add(["0"], ["filter hose"], np.array([FOREVER]), [{"content": "filter hose"}])
+    assert index.search(["gear"], 5, 0.0) == []
+    assert [index.ids[row] for row, _ in index.search(["hose"], 5, 0.0)] == ["0"]
+
+
+def corpus():
+    rng = np.random.default_rng(0)
+    common = [f"word{i}" for i in range(200)]
+    texts = [" ".join(rng.choice(common, 40)) + f" torque gearbox GX-{i} rated" for i in range(50)]
+    texts += [" ".join(rng.choice(common, 40)) + " filter pump replacement" for _ in range(50)]
+    return build(texts)
+
+
+def test_coverage_floor_drops_rows_sharing_only_common_words():
+    index = corpus()
+    off_topic = tokenize("Who won the football world cup in 1998? word3 word17")
+    assert index.search(off_topic, 10, 0.0)  # Without a floor, common words are enough
+    assert index.search(off_topic, 10, 0.0, min_coverage=0.4) == []
+
+
+def test_coverage_floor_keeps_rows_matching_the_question():
+    index = corpus()
+    hits = index.search(tokenize("What is the rated torque of the GX-17 gearbox?"), 5, 0.0, min_coverage=0.4)
+    assert index.ids[hits[0][0]] == "17"
+    assert all(int(index.ids[row]) < 50 for row, _ in hits)
+
+
+def test_keyword_backend_applies_its_floor():
+    container = FakeContainer(latency=0)
+    container.partitions["p"] = {
+        str(i): {"id": str(i), "passphrase_hash": "p", "content": text, "document_name": "/tmp/a.pdf", "page": i,
+                 "metadata": {}, "keep_until": "2999-01-01T00:00:00", "_ts": 1}
+        for i, text in enumerate(["the gearbox GX-200 has a rated torque of 450 Nm", "replace the pump filter every year"])
+    }
+    backend = KeywordBackend(container, min_coverage=0.4)
+
+    results = asyncio.run(backend.keyword_search_many("p", ["rated torque of GX-200", "capital of France", "the year"], 5))
+
+    assert [[hit["page"] for hit in hits] for hits in results] == [[0], [], [1]]
@@ -0,0 +1,64 @@
+import math
+
+import numpy as np
+import pytest
+from prepare.retrieve import maximal_marginal_relevance
+
+
+def reference(relevance, vectors, k, lambda_mult):
+    """Standard MMR, pair by pair."""
+    def cosine(a, b):
+        norms = math.sqrt(sum(x * x for x in a) * sum(y * y for y in b))
+        return sum(x * y for x, y in zip(a, b)) / norms if norms else 0.0
+
+    picked = []
+    while len(picked) < min(k, len(relevance)):
+        scores = {
+            i: lambda_mult * relevance[i] - ((1 - lambda_mult) * max(cosine(vectors[i], vectors[j]) for j in picked) if picked else 0)
+            for i in range(len(relevance)) if i not in picked
+        }
+        picked.append(max(scores, key=scores.get))
+    return picked
+
+
+@pytest.mark.parametrize("lambda_mult", [0.0, 0.3, 0.7, 1.0])
+def test_picks_match_a_pairwise_reference(lambda_mult):
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        vectors = rng.standard_normal((30, 8))
+        relevance = rng.random(30)
+        assert maximal_marginal_relevance(relevance, vectors, 6, lambda_mult) == \
+            reference(relevance.tolist(), vectors.tolist(), 6, lambda_mult)
+
+
+def test_near_copies_give_way_to_other_passages():
+    passage = np.array([1.0, 0.0, 0.0])
+    vectors = np.array([passage, passage + [0, 0.01, 0], passage + [0, 0, 0.01], [0.0, 1.0, 0.0]])
+    relevance = np.array([1.0, 0.99, 0.98, 0.6])
+    assert maximal_marginal_relevance(relevance, vectors, 2, 0.7) == [0, 3]
+    assert maximal_marginal_relevance(relevance, vectors, 2, 1.0) == [0, 1]
+
+
+def test_dissimilar_candidates_are_favoured_over_orthogonal_ones():
+    # Negative redundancy is not clamped to zero
+    vectors = np.array([[1.0, 0.0], [0.0, 1.0], [-1.0, 0.0]])
+    relevance = np.array([1.0, 0.5, 0.5])
+    assert maximal_marginal_relevance(relevance, vectors, 2, 0.5) == [0, 2]
+
+
+def test_candidates_without_an_embedding_have_no_redundancy():
+    vectors = np.array([[1.0, 0.0], [0.0, 0.0], [1.0, 0.1]])
+    relevance = np.array([1.0, 0.5, 0.9])
+    assert maximal_marginal_relevance(relevance, vectors, 3, 0.5) == [0, 1, 2]
+
+
+@pytest.mark.parametrize("k, expected", [(0, []), (-1, []), (5, [1, 0])])
+def test_k_is_bounded_by_the_pool(k, expected):
+    assert maximal_marginal_relevance(np.array([0.2, 0.9]), np.eye(2), k) == expected
+
+
+def test_relevance_is_not_modified():
+    relevance = np.array([0.3, 0.9, 0.5], dtype=np.float32)
+    original = relevance.copy()
+    maximal_marginal_relevance(relevance, np.eye(3), 3, 1.0)
+    np.testing.assert_array_equal(relevance, original)
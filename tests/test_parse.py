@@ -0,0 +1,37 @@
+import asyncio
+import time
+
+import pytest
+from prepare.parse import ParseError, ParserPool
+
+
+def test_timeout_counts_from_when_a_worker_runs_the_task():
+    async def run():
+        pool = ParserPool(None, workers=1, timeout=0.5, max_memory_bytes=None)
+        try:
+            executor = pool._executor()
+            # With one worker, the second task waits in the executor's call queue behind the first
+            slow = asyncio.ensure_future(pool._run("slow.pdf", time.sleep, 5))
+            queued = [asyncio.ensure_future(pool._run(f"quick_{i}.pdf", time.sleep, 0.3)) for i in range(3)]
+            with pytest.raises(ParseError, match="slow.pdf took longer than 0s"):
+                await slow
+            assert await asyncio.gather(*queued) == [None] * 3
+            # The overdue task freed its worker; the pool was not restarted
+            assert pool.executor is executor
+            assert await pool._run("after.pdf", abs, -3) == 3
+        finally:
+            await pool.stop()
+
+    asyncio.run(run())
+
+
+def test_worker_errors_raise_parse_error():
+    async def run():
+        pool = ParserPool(None, workers=1, timeout=5, max_memory_bytes=None)
+        try:
+            with pytest.raises(ParseError, match="Could not parse bad.pdf"):
+                await pool._run("bad.pdf", int, "not a number")
+        finally:
+            await pool.stop()
+
+    asyncio.run(run())
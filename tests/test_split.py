@@ -0,0 +1,74 @@
+from types import SimpleNamespace
+import random
+
+import pytest
+from prepare.split import Split, TextSplitter
+
+
+def sample_text(seed: int = 0, paragraphs: int = 30) -> str:
+    rng = random.Random(seed)
+    words = ["gear", "pump", "PN-4821/B", "torque", "filter", "valve", "rated", "hours", "  ", "replace"]
+    lines = [" ".join(rng.choice(words) for _ in range(rng.randint(3, 40))) for _ in range(paragraphs * 3)]
+    return "\n\n".join("\n".join(lines[i:i + 3]) for i in range(0, len(lines), 3))
+
+
+@pytest.mark.parametrize("chunk_size, chunk_overlap", [(200, 40), (80, 0), (1000, 200), (25, 10)])
+def test_spans_index_the_text(chunk_size, chunk_overlap):
+    text = sample_text()
+    splitter = TextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    spans = splitter.split_spans(text)
+    assert spans
+    for start, end in spans:
+        chunk = text[start:end]
+        assert chunk == chunk.strip() and chunk
+        assert len(chunk) <= chunk_size
+    # Chunks come in order and cover every non-whitespace character
+    starts = [start for start, _ in spans]
+    assert starts == sorted(starts)
+    covered = set()
+    for start, end in spans:
+        covered.update(range(start, end))
+    assert all(i in covered for i, character in enumerate(text) if not character.isspace())
+
+
+def test_consecutive_chunks_overlap():
+    text = " ".join(f"word{i}" for i in range(400))
+    spans = TextSplitter(chunk_size=200, chunk_overlap=60).split_spans(text)
+    assert len(spans) > 2
+    for (_, end), (start, _) in zip(spans, spans[1:]):
+        assert 0 < end - start <= 60
+
+
+def test_same_chunks_as_langchain():
+    text_splitters = pytest.importorskip("langchain_text_splitters")
+    text = sample_text(seed=2)
+    for chunk_size, chunk_overlap in [(200, 40), (500, 100), (50, 0)]:
+        reference = text_splitters.RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        assert TextSplitter(chunk_size, chunk_overlap).split_text(text) == reference.split_text(text)
+
+
+def test_length_function_measures_chunks():
+    text = sample_text(seed=3)
+    words = TextSplitter(chunk_size=20, chunk_overlap=5, length_function=lambda piece: len(piece.split()))
+    for chunk in words.split_text(text):
+        assert len(chunk.split()) <= 20
+
+
+def test_whitespace_only_text_has_no_chunks():
+    assert TextSplitter(chunk_size=10, chunk_overlap=2).split_spans(" \n\n \n  ") == []
+
+
+def test_split_document_records_offsets():
+    text = sample_text(seed=4, paragraphs=5)
+    document = SimpleNamespace(page_content=text, metadata={"source": "/tmp/a.pdf", "page": 3})
+    chunks = Split(chunk_size=150, chunk_overlap=30).split_document(document)
+    assert [chunk['metadata']['chunk'] for chunk in chunks] == list(range(len(chunks)))
+    for chunk in chunks:
+        metadata = chunk['metadata']
+        assert metadata['page'] == 3 and metadata['source'] == "/tmp/a.pdf"
+        assert text[metadata['start_index']:metadata['end_index']] == chunk['page_content']
+
+
+def test_unknown_length_unit():
+    with pytest.raises(ValueError):
+        Split(length_unit="words")
@@ -0,0 +1,108 @@
+import asyncio
+import datetime as dt
+
+from fake_cosmos import FakeContainer
+from prepare.store import CATALOG_ID, Store
+
+
+class InterferingContainer:
+    """Lets another writer add a catalog entry right before each of our first `conflicts` catalog replaces."""
+    def __init__(self, container: FakeContainer, conflicts: int):
+        self.container = container
+        self.conflicts = conflicts
+        self.replaces = 0
+
+    def __getattr__(self, name):
+        return getattr(self.container, name)
+
+    async def replace_item(self, item, body, **kwargs):
+        self.replaces += 1
+        if self.conflicts:
+            self.conflicts -= 1
+            current = await self.container.read_item(item, partition_key=body["passphrase_hash"])
+            current["documents"][f"/tmp/other{self.conflicts}.pdf"] = body["documents"][next(iter(body["documents"]))]
+            await self.container.upsert_item(current)
+        return await self.container.replace_item(item, body, **kwargs)
+
+
+def keep_until(hours: float = 1) -> dt.datetime:
+    return dt.datetime.now() + dt.timedelta(hours=hours)
+
+
+def chunks(document_name: str, count: int, pages: int):
+    return [{"metadata": {}, "embedding": [0.1, 0.2], "document_name": document_name, "page": i % pages, "chunk": i,
+             "page_content": f"{document_name} {i}"} for i in range(count)]
+
+
+def names(documents):
+    return sorted(document["document_name"] for document in documents or [])
+
+
+def test_catalog_update_is_redone_when_another_writer_changed_it():
+    container = InterferingContainer(FakeContainer(latency=0), conflicts=2)
+    store = Store(container, catalog_cache_seconds=0)
+    asyncio.run(store.record_document("secret", "/tmp/a.pdf", chunks=3, pages=1, size_bytes=10, keep_until=keep_until()))
+    asyncio.run(store.record_document("secret", "/tmp/b.pdf", chunks=4, pages=2, size_bytes=20, keep_until=keep_until()))
+
+    # Both conflicting writes were kept, and so was ours
+    assert container.replaces == 3
+    assert names(asyncio.run(store.get_documents("secret"))) == ["/tmp/a.pdf", "/tmp/b.pdf", "/tmp/other0.pdf", "/tmp/other1.pdf"]
+
+
+def test_concurrent_records_all_land_in_the_catalog():
+    store = Store(FakeContainer(latency=0.001), catalog_cache_seconds=0)
+
+    async def record_all():
+        await asyncio.gather(*(
+            store.record_document("secret", f"/tmp/{i}.pdf", chunks=1, pages=1, size_bytes=1, keep_until=keep_until())
+            for i in range(8)
+        ))
+
+    asyncio.run(record_all())
+    assert names(asyncio.run(store.get_documents("secret"))) == sorted(f"/tmp/{i}.pdf" for i in range(8))
+
+
+def test_expired_entries_are_hidden_and_dropped_on_write():
+    container = FakeContainer(latency=0)
+    store = Store(container, catalog_cache_seconds=0)
+    asyncio.run(store.record_document("secret", "/tmp/old.pdf", 1, 1, 1, keep_until(hours=-1)))
+    asyncio.run(store.record_document("secret", "/tmp/new.pdf", 1, 1, 1, keep_until()))
+
+    assert names(asyncio.run(store.get_documents("secret"))) == ["/tmp/new.pdf"]
+    catalog = container.partitions[store._hash_passphrase("secret")][CATALOG_ID]
+    assert list(catalog["documents"]) == ["/tmp/new.pdf"]
+
+
+def test_missing_catalog_is_built_from_the_chunks():
+    container = FakeContainer(latency=0)
+    store = Store(container, catalog_cache_seconds=0)
+    # Chunks written before the catalog existed
+    asyncio.run(store.store_embeddings("secret", chunks("/tmp/a.pdf", 6, pages=3)))
+    asyncio.run(store.store_embeddings("secret", chunks("/tmp/b.pdf", 2, pages=1)))
+    partition = container.partitions[store._hash_passphrase("secret")]
+    assert CATALOG_ID not in partition
+
+    documents = {document["document_name"]: document for document in asyncio.run(store.get_documents("secret"))}
+
+    assert {name: (entry["chunks"], entry["pages"]) for name, entry in documents.items()} == {"/tmp/a.pdf": (6, 3), "/tmp/b.pdf": (2, 1)}
+    assert set(partition[CATALOG_ID]["documents"]) == {"/tmp/a.pdf", "/tmp/b.pdf"}
+    # A new upload adds to the rebuilt catalog rather than replacing it
+    asyncio.run(store.record_document("secret", "/tmp/c.pdf", 1, 1, 1, keep_until()))
+    assert names(asyncio.run(store.get_documents("secret"))) == ["/tmp/a.pdf", "/tmp/b.pdf", "/tmp/c.pdf"]
+
+
+def test_empty_partition_has_no_documents():
+    store = Store(FakeContainer(latency=0))
+    assert asyncio.run(store.get_documents("nobody")) is None
+
+
+def test_delete_document_removes_its_entry():
+    container = FakeContainer(latency=0)
+    store = Store(container, catalog_cache_seconds=0)
+    for name in ("/tmp/a.pdf", "/tmp/b.pdf"):
+        asyncio.run(store.store_embeddings("secret", chunks(name, 2, pages=1)))
+        asyncio.run(store.record_document("secret", name, 2, 1, 1, keep_until(hours=6)))
+
+    asyncio.run(store.delete_document("secret", "/tmp/a.pdf"))
+
+    assert names(asyncio.run(store.get_documents("secret"))) == ["/tmp/b.pdf"]